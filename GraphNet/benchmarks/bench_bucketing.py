@@ -0,0 +1,144 @@
+from __future__ import print_function
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+import os
+import sys
+import time
+import argparse
+import functools
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset import PackedECalHitsDataset, HitCountBucketBatchSampler, collate_wrapper, _real_lengths, MAX_NUM_ECAL_HITS
+from utils.SplitNet import SplitNet
+
+"""
+bench_bucketing.py
+
+Purpose:  Measure what hit-count bucketing (dataset.HitCountBucketBatchSampler + collate_wrapper(min_nodes=...), i.e.
+train.py --bucket-by-hits) saves on CPU.  Uses a packed sample (pack_dataset.py output) if --packed-dir is given,
+otherwise synthetic events with a falling hit count distribution below the file_processor.py preselection cut.
+
+- Checks that the model outputs (eval mode) of trimmed batches match the fully padded ones.
+- Runs one training epoch (forward + backward + optimizer step) each with:  random batches padded to
+  MAX_NUM_ECAL_HITS (the default), random batches trimmed to their longest event, and bucketed + trimmed batches.
+  Prints the forward pass FLOPs (SplitNet.flops) and the time per epoch of each.
+
+Usage (from the GraphNet directory):  python benchmarks/bench_bucketing.py [--packed-dir DIR] [--num-regions 1] [--threads 4]
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--packed-dir', type=str, default='',
+                    help='packed sample to use (e.g. <packed-dir>/train); synthetic events if not given')
+parser.add_argument('--num-events', type=int, default=20000,
+                    help='number of events per epoch (the first events of the packed sample)')
+parser.add_argument('--num-regions', type=int, default=1)
+parser.add_argument('--batch-size', type=int, default=128)
+parser.add_argument('--bucket-width', type=int, default=8)
+parser.add_argument('--threads', type=int, default=4)
+parser.add_argument('--seed', type=int, default=0)
+
+conv_params = [(7, (32, 32, 32)), (7, (64, 64, 64))]  # particle-net-lite
+fc_params = [(128, 0.1)]
+
+
+class _InMemory(Dataset):
+    # Synthetic events shaped like ECalHitsDataset.__getitem__ output:  hit j at position j of one region
+    def __init__(self, n, nRegions, seed=0):
+        rng = np.random.default_rng(seed)
+        nHits = np.minimum(1 + rng.geometric(1 / 14., n), 49)  # Mostly well below the nReadoutHits < 50 cut
+        self.features = np.zeros((n, nRegions, 5, MAX_NUM_ECAL_HITS), dtype='float32')
+        for i, nh in enumerate(nHits):
+            region = rng.integers(0, nRegions, nh)
+            hits = np.arange(nh)
+            self.features[i, region, 0, hits] = rng.normal(0, 40, nh)
+            self.features[i, region, 1, hits] = rng.normal(0, 40, nh)
+            self.features[i, region, 2, hits] = rng.uniform(240, 600, nh)
+            self.features[i, region, 3, hits] = rng.integers(0, 34, nh)
+            self.features[i, region, 4, hits] = rng.normal(1, 1, nh)
+        self.label = rng.integers(0, 2, n)
+
+    def __len__(self):
+        return len(self.label)
+
+    def __getitem__(self, i):
+        features = self.features[i]
+        return np.ascontiguousarray(features[:, :3]), features, int(self.label[i])
+
+    def hit_counts(self):
+        return _real_lengths(self.features)
+
+
+def run_epoch(model, loader):
+    # One training epoch; returns (seconds, forward FLOPs)
+    model.train()
+    opt = torch.optim.Adam(model.parameters(), lr=1e-3)
+    loss_func = torch.nn.CrossEntropyLoss()
+    flops = 0
+    start = time.perf_counter()
+    for batch in loader:
+        flops += model.flops(batch.features.shape[-1]) * len(batch.label)
+        opt.zero_grad()
+        loss = loss_func(model(batch.coordinates, batch.features, pad_to=MAX_NUM_ECAL_HITS), batch.label)
+        loss.backward()
+        opt.step()
+    return time.perf_counter() - start, flops
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    if args.packed_dir:
+        data = torch.utils.data.Subset(PackedECalHitsDataset(args.packed_dir), range(args.num_events))
+        hit_counts = data.dataset.hit_counts()[:args.num_events]
+        nRegions = data.dataset.nRegions
+    else:
+        data = _InMemory(args.num_events, args.num_regions, args.seed)
+        hit_counts = data.hit_counts()
+        nRegions = args.num_regions
+    print("{} events, {} regions, hits per event:  mean {:.1f}, median {:.0f}, max {}".format(
+        len(hit_counts), nRegions, hit_counts.mean(), np.median(hit_counts), hit_counts.max()))
+
+    model = SplitNet(input_dims=5, num_classes=2, conv_params=conv_params, fc_params=fc_params, use_fusion=True,
+                     nRegions=nRegions)
+    initial_state = {k: v.clone() for k, v in model.state_dict().items()}
+    min_nodes = max(k for k, _ in conv_params) + 1
+    trim = functools.partial(collate_wrapper, min_nodes=min_nodes)
+
+    # Trimmed batches give the same outputs as padded ones (eval mode:  BatchNorm uses the running stats)
+    sampler = HitCountBucketBatchSampler(hit_counts, args.batch_size, bucket_width=args.bucket_width, seed=args.seed)
+    model.eval()
+    max_diff = 0
+    with torch.no_grad():
+        for i, indices in enumerate(sampler):
+            items = [data[j] for j in indices]
+            padded, trimmed = collate_wrapper(items), trim(items)
+            max_diff = max(max_diff, (torch.softmax(model(padded.coordinates, padded.features), 1) -
+                                      torch.softmax(model(trimmed.coordinates, trimmed.features, pad_to=MAX_NUM_ECAL_HITS), 1)).abs().max().item())
+            if i == 20:
+                break
+    print("Max |score difference| trimmed vs padded (eval mode):  {:.2e}".format(max_diff))
+
+    generator = torch.Generator().manual_seed(args.seed)
+    loaders = {
+        'padded':           DataLoader(data, batch_size=args.batch_size, shuffle=True, generator=generator,
+                                       collate_fn=collate_wrapper, drop_last=True),
+        'trimmed':          DataLoader(data, batch_size=args.batch_size, shuffle=True, generator=generator,
+                                       collate_fn=trim, drop_last=True),
+        'bucketed+trimmed': DataLoader(data, collate_fn=trim, batch_sampler=HitCountBucketBatchSampler(
+            hit_counts, args.batch_size, bucket_width=args.bucket_width, drop_last=True, seed=args.seed)),
+        }
+    results = {}
+    for name, loader in loaders.items():
+        model.load_state_dict(initial_state)
+        results[name] = run_epoch(model, loader)
+    base_time, base_flops = results['padded']
+    for name, (seconds, flops) in results.items():
+        print("{:>16}:  {:.2f} s/epoch ({:.0f} events/s), forward {:.1f} GFLOP/epoch ({:.1f}% of padded), time {:.1f}% of padded".format(
+            name, seconds, len(hit_counts) / seconds, flops / 1e9, 100. * flops / base_flops, 100. * seconds / base_time))
+
+
+if __name__ == '__main__':
+    run(parser.parse_args())
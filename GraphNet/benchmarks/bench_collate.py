@@ -0,0 +1,88 @@
+from __future__ import print_function
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset import collate_wrapper, MAX_NUM_ECAL_HITS
+
+"""
+bench_collate.py
+
+Purpose:  Compare the batch collation in dataset.collate_wrapper (preallocated float32 buffers + torch.from_numpy)
+with the original torch.tensor() on tuples of per-event arrays.  Checks that both give identical tensors, then times
+the collate function alone and a full DataLoader pass over an in-memory dataset (so that only collation and
+worker->main process transfer are measured) at batch sizes 128 and 1024 (the train.py and eval.py defaults).
+
+Usage (from the GraphNet directory):  python benchmarks/bench_collate.py [--num-regions 3] [--num-workers 4]
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num-events', type=int, default=50000)
+parser.add_argument('--num-regions', type=int, default=1)
+parser.add_argument('--num-workers', type=int, default=4)
+parser.add_argument('--batch-sizes', type=int, nargs='+', default=[128, 1024])
+
+
+class _OldBatch:
+    # The original _SimpleCustomBatch
+    def __init__(self, data):
+        pts, fts, labels = list(zip(*data))
+        self.coordinates = torch.tensor(pts)
+        self.features = torch.tensor(fts)
+        self.label = torch.tensor(labels)
+
+
+def old_collate(batch):
+    return _OldBatch(batch)
+
+
+class _InMemory(Dataset):
+    # Per-event arrays shaped like ECalHitsDataset.__getitem__ output
+    def __init__(self, n, nRegions, seed=0):
+        rng = np.random.default_rng(seed)
+        self.features = rng.normal(size=(n, nRegions, 5, MAX_NUM_ECAL_HITS)).astype('float32')
+        self.label = rng.integers(0, 2, n)
+
+    def __len__(self):
+        return len(self.label)
+
+    def __getitem__(self, i):
+        features = self.features[i].copy()
+        return features[:, :3].copy(), features, int(self.label[i])
+
+
+def run(args):
+    data = _InMemory(args.num_events, args.num_regions)
+    for batch_size in args.batch_sizes:
+        items = [data[i] for i in range(batch_size)]
+        old, new = old_collate(items), collate_wrapper(items)
+        for name in ['coordinates', 'features', 'label']:
+            assert(torch.equal(getattr(old, name), getattr(new, name))), "Mismatch in {}".format(name)
+            assert(getattr(old, name).dtype == getattr(new, name).dtype), "dtype mismatch in {}".format(name)
+
+        timings = {}
+        for name, collate in [('torch.tensor', old_collate), ('preallocated', collate_wrapper)]:
+            start = time.perf_counter()
+            for _ in range(20):
+                collate(items)
+            collate_time = (time.perf_counter() - start) / 20
+
+            loader = DataLoader(data, batch_size=batch_size, num_workers=args.num_workers, collate_fn=collate,
+                                shuffle=False, drop_last=False)
+            start = time.perf_counter()
+            for batch in loader:
+                pass
+            timings[name] = (collate_time, len(data) / (time.perf_counter() - start))
+        print("batch size {}:  ".format(batch_size) + ",  ".join(
+            "{} {:.2f} ms/batch, loader {:.0f} events/s".format(name, 1000 * t, rate) for name, (t, rate) in timings.items()))
+
+
+if __name__ == '__main__':
+    run(parser.parse_args())
@@ -0,0 +1,125 @@
+from __future__ import print_function
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from export_model import make_batch, networks
+from utils.SplitNet import SplitNet
+from utils.focal_loss import FocalLoss
+from utils.ranger import Ranger
+
+"""
+bench_ddp_scaling.py
+
+Purpose:  Measure how training throughput scales with the number of processes of train.py --distributed (CPU data
+parallel with the gloo backend), on synthetic batches.  For 1, 2, ... --max-procs processes, runs the training steps
+of the default 20-epoch configuration (--batch-size events per step in total, split over the processes, Ranger,
+focal loss with gamma 2) and prints the events/s, the speedup and the scaling efficiency (events/s with N processes /
+(N * events/s with 1 process)), plus the training time of --num-epochs epochs of --events-per-epoch events this
+implies.  Also checks that all processes end with identical parameters.
+
+1 process is the plain (non-distributed) training of train.py.  With --threads 1 (the default), N processes need N
+free cores; on a machine with fewer cores the efficiency measures oversubscription, not the training.
+
+Usage (from the GraphNet directory):  python benchmarks/bench_ddp_scaling.py [--max-procs 4] [--threads 1]
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--network', type=str, default='particle-net-lite', choices=list(networks))
+parser.add_argument('--num-regions', type=int, default=3)
+parser.add_argument('--batch-size', type=int, default=128,
+                    help='events per step, in total over the processes')
+parser.add_argument('--max-procs', type=int, default=4)
+parser.add_argument('--threads', type=int, default=1,
+                    help='torch CPU threads per process')
+parser.add_argument('--num-steps', type=int, default=20,
+                    help='timed training steps per process count')
+parser.add_argument('--warmup-steps', type=int, default=3)
+parser.add_argument('--events-per-epoch', type=int, default=1600000,
+                    help='training events per epoch for the time estimate (the train.py defaults:  800k background + 4 x 200k signal)')
+parser.add_argument('--num-epochs', type=int, default=20)
+parser.add_argument('--seed', type=int, default=0)
+
+
+def run_steps(rank, world_size, args, init_file, results):
+    # One training process:  args.warmup_steps + args.num_steps steps on its own synthetic batches of
+    # args.batch_size // world_size events.  Process 0 puts (events/s in total, max parameter difference) in results.
+    torch.set_num_threads(args.threads)
+    if world_size > 1:
+        dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=world_size)
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng([args.seed, rank])
+
+    conv_params, fc_params = networks[args.network]
+    model = SplitNet(input_dims=5, num_classes=2, conv_params=conv_params, fc_params=fc_params, use_fusion=True,
+                     nRegions=args.num_regions)
+    if world_size > 1:
+        model = torch.nn.parallel.DistributedDataParallel(model, static_graph=True)
+    model.train()
+    opt = Ranger(model.parameters(), lr=5e-3)
+    loss_func = FocalLoss(gamma=2)
+    batch_size = args.batch_size // world_size
+    batches = [make_batch(batch_size, args.num_regions, rng) + (torch.from_numpy(rng.integers(0, 2, batch_size)),)
+               for _ in range(min(args.num_steps, 8))]
+
+    def step(i):
+        coordinates, features, label = batches[i % len(batches)]
+        opt.zero_grad()
+        loss_func(model(coordinates, features), label).backward()
+        opt.step()
+
+    for i in range(args.warmup_steps):
+        step(i)
+    if world_size > 1:
+        dist.barrier()
+    start = time.perf_counter()
+    for i in range(args.num_steps):
+        step(i)
+    if world_size > 1:
+        dist.barrier()
+    elapsed = time.perf_counter() - start
+
+    # Max difference of the parameters from those of process 0
+    max_diff = 0.
+    if world_size > 1:
+        params = torch.cat([p.detach().flatten() for p in model.parameters()])
+        reference = params.clone()
+        dist.broadcast(reference, 0)
+        diff = (params - reference).abs().max()
+        dist.all_reduce(diff, op=dist.ReduceOp.MAX)
+        max_diff = diff.item()
+        dist.destroy_process_group()
+    if rank == 0:
+        results.put((args.num_steps * batch_size * world_size / elapsed, max_diff))
+
+
+def run(args):
+    print('{}, {} regions, {} events per step, {} threads per process, {} CPU cores'.format(
+        args.network, args.num_regions, args.batch_size, args.threads, os.cpu_count()))
+    ctx = mp.get_context('spawn')
+    rates = {}
+    for world_size in range(1, args.max_procs + 1):
+        if args.batch_size % world_size:
+            continue
+        results = ctx.SimpleQueue()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mp.spawn(run_steps, args=(world_size, args, os.path.join(tmpdir, 'init'), results), nprocs=world_size)
+        rate, max_diff = results.get()
+        rates[world_size] = rate
+        hours = args.num_epochs * args.events_per_epoch / rate / 3600
+        print("{} processes:  {:.0f} events/s, speedup {:.2f}x, efficiency {:.2f}, {} epochs in {:.1f} h; "
+              "max parameter difference between processes {:.1e}".format(
+                  world_size, rate, rate / rates[1], rate / (world_size * rates[1]), args.num_epochs, hours, max_diff))
+
+
+if __name__ == '__main__':
+    run(parser.parse_args())
@@ -0,0 +1,145 @@
+from __future__ import print_function
+
+import numpy as np
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset import ECalHitsDataset, MAX_NUM_ECAL_HITS, radius_68
+
+"""
+bench_fill_regions.py
+
+Purpose:  Compare the vectorized ECalHitsDataset._fill_regions() against the original per-hit loop from _read_event(),
+checking that both give identical outputs for 1, 2 and 3 regions and timing them on synthetic v13 events.
+
+Usage (from the GraphNet directory):  python benchmarks/bench_fill_regions.py [--num-events N]
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num-events', type=int, default=20000)
+parser.add_argument('--seed', type=int, default=0)
+
+
+def fill_regions_loop(self, x, y, z, layer_id, energy):
+    # The original per-hit implementation (body of ECalHitsDataset._read_event before vectorization)
+    x_          = np.zeros((self.nRegions, MAX_NUM_ECAL_HITS), dtype='float32')
+    y_          = np.zeros((self.nRegions, MAX_NUM_ECAL_HITS), dtype='float32')
+    z_          = np.zeros((self.nRegions, MAX_NUM_ECAL_HITS), dtype='float32')
+    log_energy_ = np.zeros((self.nRegions, MAX_NUM_ECAL_HITS), dtype='float32')
+    layer_id_   = np.zeros((self.nRegions, MAX_NUM_ECAL_HITS), dtype='float32')
+
+    for j in range(len(layer_id)):
+        delta_z = z[j] - self.etraj_sp[2]
+        if self.etraj_sp[2] != -999:
+            etraj_point = (self.etraj_sp[0] + self.enorm_sp[0]*delta_z, self.etraj_sp[1] + self.enorm_sp[1]*delta_z)
+            ptraj_point = (self.ptraj_sp[0] + self.pnorm_sp[0]*delta_z, self.ptraj_sp[1] + self.pnorm_sp[1]*delta_z)
+            recoilangle = self.enorm_sp[2] / np.sqrt(self.enorm_sp[0]**2 + self.enorm_sp[1]**2 + self.enorm_sp[2]**2)
+            recoil_p = np.sqrt(self.enorm_sp[0]**2 + self.enorm_sp[1]**2 + self.enorm_sp[2]**2)
+        else:
+            etraj_point = self.etraj_sp
+            ptraj_point = self.ptraj_sp
+            recoilangle = -999
+            recoil_p    = -999
+        if recoilangle < 10 and recoil_p < 500:
+            ir = 1
+        elif recoilangle < 10 and recoil_p >= 500:
+            ir = 2
+        elif recoilangle <= 20:
+            ir = 3
+        else:
+            ir = 4
+        insideElectronRadius = np.sqrt((etraj_point[0] - x[j])**2 + \
+                (etraj_point[1] - y[j])**2) < 2.0 * radius_68[ir][layer_id[j]]
+        insidePhotonRadius   = np.sqrt((ptraj_point[0] - x[j])**2 + \
+                (ptraj_point[1] - y[j])**2) < 2.0 * radius_68[ir][layer_id[j]]
+        if self.enorm_sp[2] == -999:
+            insideElectronRadius = False
+            insidePhotonRadius   = True
+
+        regions = []
+        if self.nRegions == 1:
+            regions.append(0)
+        elif self.nRegions == 2:
+            if insideElectronRadius:
+                regions.append(0)
+            else:
+                regions.append(1)
+        elif self.nRegions == 3:
+            if insideElectronRadius:
+                regions.append(0)
+            if insidePhotonRadius:
+                regions.append(1)
+            if not insideElectronRadius and not insidePhotonRadius:
+                regions.append(2)
+
+        for r in range(self.nRegions):
+            if r in regions:
+                x_[r][j] = x[j] - etraj_point[0]
+                y_[r][j] = y[j] - etraj_point[1]
+                z_[r][j] = z[j]
+                layer_id_[r][j] = layer_id[j]
+                log_energy_[r][j] = np.log(energy[j]) if energy[j] > 0 else -1
+
+    return {'x_':x_, 'y_':y_, 'z_':z_,
+            'layer_id_':layer_id_,
+            'log_energy_':log_energy_,
+           }
+
+
+def make_events(n, rng):
+    # Synthetic v13-like events:  hits scattered around a recoil electron/photon, 20% without an SP electron
+    layer_z = np.loadtxt('data/v13/layer.txt')
+    events = []
+    for _ in range(n):
+        nHits = rng.integers(1, 50)
+        layer_id = rng.integers(0, len(layer_z), nHits)
+        z = layer_z[layer_id].astype('float32')
+        x = rng.normal(0, 60, nHits).astype('float32')
+        y = rng.normal(0, 60, nHits).astype('float32')
+        energy = rng.exponential(5, nHits).astype('float32') * (rng.random(nHits) > 0.05)
+        if rng.random() < 0.8:
+            px, py, pz = rng.normal(0, 50), rng.normal(0, 50), rng.uniform(50, 3000)
+            sp = {'etraj_sp': np.array((rng.normal(0, 30), rng.normal(0, 30), 240.5)),
+                  'enorm_sp': np.array((px/pz, py/pz, 1.0)),
+                  'ptraj_sp': np.array((rng.normal(0, 30), rng.normal(0, 30), 245.5)),
+                  'pnorm_sp': np.array((-px/(4000 - pz), -py/(4000 - pz), 1.0))}
+        else:
+            sp = {k: np.array((-999, -999, -999)) for k in ['etraj_sp', 'enorm_sp', 'ptraj_sp', 'pnorm_sp']}
+        events.append((sp, (x, y, z, list(layer_id), energy)))
+    return events
+
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    events = make_events(args.num_events, rng)
+    nHits = sum(len(hits[-1]) for _, hits in events)
+    print("{} events, {} hits".format(len(events), nHits))
+
+    for nRegions in [1, 2, 3]:
+        ds = ECalHitsDataset.__new__(ECalHitsDataset)  # Only the attributes used by _fill_regions are needed
+        ds.nRegions = nRegions
+        timings = {}
+        outputs = {}
+        for name, fill in [('loop', lambda *hits: fill_regions_loop(ds, *hits)), ('vectorized', ds._fill_regions)]:
+            outputs[name] = []
+            start = time.perf_counter()
+            for sp, hits in events:
+                ds.__dict__.update(sp)
+                ds.radius_category = ds._radius_category()
+                outputs[name].append(fill(*hits))
+            timings[name] = time.perf_counter() - start
+
+        for out_loop, out_vec in zip(outputs['loop'], outputs['vectorized']):
+            for k in out_loop:
+                assert(np.array_equal(out_loop[k], out_vec[k])), "Mismatch in {} for nRegions={}".format(k, nRegions)
+        print("nRegions={}:  outputs identical.  loop {:.2f} s ({:.0f} evt/s), vectorized {:.2f} s ({:.0f} evt/s), speedup {:.1f}x".format(
+            nRegions, timings['loop'], len(events)/timings['loop'], timings['vectorized'],
+            len(events)/timings['vectorized'], timings['loop']/timings['vectorized']))
+
+
+if __name__ == '__main__':
+    run(parser.parse_args())
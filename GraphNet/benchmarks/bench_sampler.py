@@ -0,0 +1,79 @@
+from __future__ import print_function
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, RandomSampler
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset import ECalHitsDataset, FileBlockShuffleSampler
+from dataset import collate_wrapper as collate_fn
+
+"""
+bench_sampler.py
+
+Purpose:  Compare the data loading rate of the plain random sampler (DataLoader shuffle=True) with
+FileBlockShuffleSampler on real file_processor.py output, and check that the file-block order still mixes the
+samples within each batch.
+
+For each sampler, prints events/s over --num-batches batches, the open-file pool hit rate, the mean number of
+distinct files per batch, and the mean/std of the signal fraction per batch (for the random sampler, the std is
+~sqrt(f(1-f)/batch_size)).
+
+Usage (from the GraphNet directory):
+    python benchmarks/bench_sampler.py --sample 0 '/path/to/*pn*.root' 200000 --sample 1000 '/path/to/*1.0*.root' 200000
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sample', nargs=3, action='append', required=True, metavar=('LABEL', 'FILEPATH', 'MAX_EVENTS'),
+                    help='sample to load:  extra label (0 for background, mass in MeV for signal), file glob, max events (-1 for all)')
+parser.add_argument('--num-regions', type=int, default=1)
+parser.add_argument('--batch-size', type=int, default=128)
+parser.add_argument('--num-workers', type=int, default=8)
+parser.add_argument('--num-batches', type=int, default=200)
+parser.add_argument('--max-open-files', type=int, default=64)
+parser.add_argument('--shuffle-block-size', type=int, default=1024)
+parser.add_argument('--shuffle-window', type=int, default=16384)
+
+
+def run(args):
+    siglist = {}
+    bkglist = {}
+    for label, filepath, max_events in args.sample:
+        (bkglist if int(label) == 0 else siglist)[int(label)] = (filepath, int(max_events))
+    data = ECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=(0.2, 1), nRegions=args.num_regions,
+                           max_open_files=args.max_open_files)
+
+    samplers = {
+        'random':     RandomSampler(data, generator=torch.Generator().manual_seed(0)),
+        'file-block': FileBlockShuffleSampler(data, block_size=args.shuffle_block_size, window_size=args.shuffle_window),
+        }
+    for name, sampler in samplers.items():
+        # The events of the first num_batches batches (the loader is given exactly this order)
+        indices = np.array(list(sampler))[:args.num_batches * args.batch_size]
+        batches = indices[:len(indices) // args.batch_size * args.batch_size].reshape(-1, args.batch_size)
+        files_per_batch = np.mean([len(np.unique(data.file_ids[b])) for b in batches])
+        sig_frac = data.label[batches].mean(axis=1)
+
+        loader = DataLoader(data, num_workers=args.num_workers, batch_size=args.batch_size, sampler=indices.tolist(),
+                            collate_fn=collate_fn, drop_last=True)
+        data.reset_pool_stats()
+        start = time.perf_counter()
+        nEvents = 0
+        for i, batch in enumerate(loader):
+            nEvents += len(batch.label)
+            if i + 1 == args.num_batches:
+                break
+        elapsed = time.perf_counter() - start
+        stats = data.pool_stats()
+        print("{:>10}:  {:.0f} events/s, pool hit rate {:.4f}, {:.1f} files/batch, signal fraction per batch {:.3f} +- {:.3f}".format(
+            name, nEvents / elapsed, stats['hits'] / max(stats['hits'] + stats['misses'], 1), files_per_batch,
+            sig_frac.mean(), sig_frac.std()))
+
+
+if __name__ == '__main__':
+    run(parser.parse_args())
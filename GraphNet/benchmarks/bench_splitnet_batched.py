@@ -0,0 +1,119 @@
+from __future__ import print_function
+
+import numpy as np
+import torch
+
+import os
+import sys
+import copy
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset import MAX_NUM_ECAL_HITS
+from utils.SplitNet import SplitNet
+
+"""
+bench_splitnet_batched.py
+
+Purpose:  Compare SplitNet's default forward pass (pn0, pn1, ... called one after another) with batched_regions=True
+(all regions in one batched EdgeConv/BatchNorm pass) on CPU.  Checks that both give the same outputs, gradients and
+BatchNorm running stats, then prints the events/s of inference (eval mode) and of training steps (forward +
+backward + optimizer step) for each network.
+
+Usage (from the GraphNet directory):  python benchmarks/bench_splitnet_batched.py [--num-regions 3] [--threads 4]
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num-regions', type=int, default=3)
+parser.add_argument('--batch-size', type=int, default=32,
+                    help='events per batch (particle-net training needs several GB at 128)')
+parser.add_argument('--num-batches', type=int, default=10)
+parser.add_argument('--threads', type=int, default=4)
+parser.add_argument('--seed', type=int, default=0)
+
+networks = {
+    'particle-net-lite': ([(7, (32, 32, 32)), (7, (64, 64, 64))], [(128, 0.1)]),
+    'particle-net':      ([(16, (64, 64, 64)), (16, (128, 128, 128)), (16, (256, 256, 256))], [(256, 0.1)]),
+    }
+
+
+def make_batch(batch_size, nRegions, rng):
+    # Synthetic padded batch:  hit j of each event at position j of one region
+    features = np.zeros((batch_size, nRegions, 5, MAX_NUM_ECAL_HITS), dtype='float32')
+    for i in range(batch_size):
+        nh = rng.integers(1, 50)
+        hits = np.arange(nh)
+        region = rng.integers(0, nRegions, nh)
+        features[i, region, :, hits] = rng.normal(size=(nh, 5)) * np.array([40, 40, 100, 10, 1], dtype='float32')
+    features = torch.from_numpy(features)
+    return features[:, :, :3].contiguous(), features, torch.from_numpy(rng.integers(0, 2, batch_size))
+
+
+def max_rel_diff(a, b):
+    return ((a - b).abs().max() / a.abs().max().clamp(min=1e-30)).item()
+
+
+def check(model, batched, batch):
+    # Same outputs, gradients (relative to the largest gradient of each tensor) and running stats after one step.
+    # Not bit-for-bit:  the stacked matmuls sum in a different order than the separate convolutions.
+    coordinates, features, label = batch
+    diffs = {}
+    for mode in ['train', 'eval']:
+        getattr(model, mode)()
+        getattr(batched, mode)()
+        torch.manual_seed(0)
+        out = model(coordinates, features)
+        torch.manual_seed(0)
+        out_batched = batched(coordinates, features)
+        diffs['output ({})'.format(mode)] = max_rel_diff(out, out_batched)
+        if mode == 'train':
+            torch.nn.functional.cross_entropy(out, label).backward()
+            torch.nn.functional.cross_entropy(out_batched, label).backward()
+            diffs['gradients'] = max(max_rel_diff(p.grad, q.grad) for p, q in zip(model.parameters(), batched.parameters())
+                                     if p.grad is not None and p.grad.abs().max() > 1e-6)
+            # Absolute:  some running means are ~1e-10, i.e. only rounding noise
+            diffs['running stats (abs)'] = max((p.float() - q.float()).abs().max().item() for p, q in
+                                         zip(model.state_dict().values(), batched.state_dict().values()))
+    assert(list(model.state_dict()) == list(batched.state_dict()))
+    return diffs
+
+
+def throughput(model, batches, train):
+    model.train(train)
+    opt = torch.optim.SGD(model.parameters(), lr=1e-3)
+    start = time.perf_counter()
+    for coordinates, features, label in batches:
+        if train:
+            opt.zero_grad()
+            torch.nn.functional.cross_entropy(model(coordinates, features), label).backward()
+            opt.step()
+        else:
+            with torch.no_grad():
+                model(coordinates, features)
+    return sum(len(b[2]) for b in batches) / (time.perf_counter() - start)
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    batches = [make_batch(args.batch_size, args.num_regions, rng) for _ in range(args.num_batches)]
+    for name, (conv_params, fc_params) in networks.items():
+        model = SplitNet(input_dims=5, num_classes=2, conv_params=conv_params, fc_params=fc_params, use_fusion=True,
+                         nRegions=args.num_regions)
+        batched = copy.deepcopy(model)
+        batched.batched_regions = True
+        diffs = check(model, batched, batches[0])
+        print("{}, {} regions:  max difference ".format(name, args.num_regions) +
+              ", ".join("{} {:.1e}".format(k, v) for k, v in diffs.items()))
+
+        throughput(model, batches[:1], False)  # Warm up
+        for mode, train in [('inference', False), ('training', True)]:
+            rates = {label: throughput(m, batches, train) for label, m in [('per-region', model), ('batched', batched)]}
+            print("    {:>9}:  per-region {:.0f} events/s, batched {:.0f} events/s, speedup {:.2f}x".format(
+                mode, rates['per-region'], rates['batched'], rates['batched'] / rates['per-region']))
+
+
+if __name__ == '__main__':
+    run(parser.parse_args())
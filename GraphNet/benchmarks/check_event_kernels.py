@@ -0,0 +1,140 @@
+from __future__ import print_function
+
+import numpy as np
+import awkward
+import uproot
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.event_kernels import recoil_pt, num_hits, num_positive
+
+"""
+check_event_kernels.py
+
+Purpose:  Regression check for the vectorized kernels in utils/event_kernels.py used by file_processor.py.  Writes a
+synthetic file with TargetScoringPlaneHits/EcalScoringPlaneHits/EcalRecHits-like branches, reads it back with uproot,
+and checks that recoil_pt/num_hits/num_positive give the same results as the original per-event loops.
+
+Usage (from the GraphNet directory):  python benchmarks/check_event_kernels.py [--num-events N]
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num-events', type=int, default=5000)
+parser.add_argument('--seed', type=int, default=0)
+
+
+def loops(data):
+    # The original per-event loops from file_processor.processFile
+    nEvents = len(data['nReadoutHits_'])
+    pdgID_ = data['pdgID_tsp_']
+    z_     = data['z_tsp_']
+    px_    = data['px_tsp_']
+    py_    = data['py_tsp_']
+    pz_    = data['pz_tsp_']
+    tspRecoil = []
+    for i in range(nEvents):
+        max_pz = 0
+        recoil_index = 0  # Store the index of the recoil electron
+        for j in range(len(pdgID_[i])):
+            # Constraint on z ensures that the SP downstream of the target is used
+            if pdgID_[i][j] == 11 and z_[i][j] > 0.176 and z_[i][j] < 0.178 and pz_[i][j] > max_pz:
+                max_pz = pz_[i][j]
+                recoil_index = j
+        # Calculate the recoil SP
+        tspRecoil.append(np.sqrt(px_[i][recoil_index]**2 + py_[i][recoil_index]**2))
+
+    nSPHits = np.zeros(nEvents)
+    nTSPHits = np.zeros(nEvents)
+    nRecHits = np.zeros(nEvents)
+    x_data = data['x_']
+    xsp_data = data['x_tsp_']
+    E_data = data['energy_rec_']
+    for i in range(nEvents):
+        nSPHits[i] = len(x_data[i])
+        nTSPHits[i] = len(xsp_data[i])
+        nRecHits[i] = sum(E_data[i] > 0)
+        if len(E_data[i]) == 0:
+            nRecHits[i] = 0
+    return {'TargetSPRecoilE_pt': np.array(tspRecoil), 'nSPHits': nSPHits, 'nTSPHits': nTSPHits, 'nRecHits': nRecHits}
+
+
+def kernels(data):
+    return {'TargetSPRecoilE_pt': recoil_pt(data['pdgID_tsp_'], data['z_tsp_'], data['px_tsp_'], data['py_tsp_'], data['pz_tsp_']),
+            'nSPHits':  num_hits(data['x_']),
+            'nTSPHits': num_hits(data['x_tsp_']),
+            'nRecHits': num_positive(data['energy_rec_'])}
+
+
+def jagged(counts, values, dtype):
+    return awkward.unflatten(np.asarray(values, dtype=dtype), counts)
+
+
+def make_file(path, n, rng):
+    # Target SP hits:  a mix of electrons/photons, upstream (z=-0.177) and downstream (z=0.177) of the target, some
+    # with pz <= 0 and some tied pz values.  Every event has at least one target SP hit, since the loop fails otherwise.
+    # Ecal SP and rec hits only need their counts checked.  Same layout/branch names as the file_processor output.
+    nTSP = rng.integers(1, 8, n)
+    nTot = nTSP.sum()
+    pz = rng.uniform(-100, 4000, nTot)
+    pz[rng.random(nTot) < 0.05] = 1000.  # Ties:  the first maximum is the recoil electron
+    nSP = rng.integers(0, 6, n)
+    nRec = rng.integers(0, 60, n)
+    energy = rng.exponential(5, nRec.sum()) * (rng.random(nRec.sum()) > 0.1)
+    with uproot.recreate(path) as f:
+        f.mktree('skimmed_events', {'nReadoutHits_': 'int32',
+                                    'TSPHits': 'var * {pdgID_tsp_: int32, x_tsp_: float32, z_tsp_: float32, px_tsp_: float32, py_tsp_: float32, pz_tsp_: float32}',
+                                    'SPHits': 'var * {x_: float32}',
+                                    'RecHits': 'var * {energy_rec_: float32}'},
+                 counter_name=lambda counted: 'n' + counted, field_name=lambda outer, inner: inner)
+        f['skimmed_events'].extend({
+            'nReadoutHits_': rng.integers(0, 100, n).astype('int32'),
+            'TSPHits': awkward.zip({
+                'pdgID_tsp_': jagged(nTSP, rng.choice([11, 22, -11], nTot, p=[0.6, 0.3, 0.1]), 'int32'),
+                'x_tsp_':     jagged(nTSP, rng.normal(0, 20, nTot), 'float32'),
+                'z_tsp_':     jagged(nTSP, rng.choice([0.177, -0.177], nTot, p=[0.8, 0.2]), 'float32'),
+                'px_tsp_':    jagged(nTSP, rng.normal(0, 50, nTot), 'float32'),
+                'py_tsp_':    jagged(nTSP, rng.normal(0, 50, nTot), 'float32'),
+                'pz_tsp_':    jagged(nTSP, pz, 'float32')}),
+            'SPHits':  awkward.zip({'x_': jagged(nSP, rng.normal(0, 100, nSP.sum()), 'float32')}),
+            'RecHits': awkward.zip({'energy_rec_': jagged(nRec, energy, 'float32')}),
+            })
+
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    path = os.path.join(tempfile.mkdtemp(), 'event_kernels.root')
+    make_file(path, args.num_events, rng)
+    with uproot.open(path) as f:
+        tree = f['skimmed_events']
+        data = {branch: tree[branch].array() for branch in ['nReadoutHits_', 'pdgID_tsp_', 'x_tsp_', 'z_tsp_', 'px_tsp_',
+                                                             'py_tsp_', 'pz_tsp_', 'x_', 'energy_rec_']}
+    print("{} events, {} target SP hits, {} rec hits".format(
+        args.num_events, awkward.sum(num_hits(data['pdgID_tsp_'])), awkward.sum(num_hits(data['energy_rec_']))))
+
+    start = time.perf_counter()
+    out_loop = loops(data)
+    t_loop = time.perf_counter() - start
+    start = time.perf_counter()
+    out_vec = kernels(data)
+    t_vec = time.perf_counter() - start
+
+    for k in ['nSPHits', 'nTSPHits', 'nRecHits']:
+        assert(np.array_equal(out_loop[k], out_vec[k])), "Mismatch in {}".format(k)
+    # Same recoil electron, same float32 arithmetic; numpy's scalar float32 ** 2 (used by the loop) can round an exact
+    # tie the other way than the array square, so allow 1 ulp.
+    pt_loop, pt_vec = out_loop['TargetSPRecoilE_pt'], out_vec['TargetSPRecoilE_pt']
+    assert(pt_loop.dtype == pt_vec.dtype), "Mismatch in TargetSPRecoilE_pt dtype"
+    assert(np.all(np.abs(pt_loop - pt_vec) <= np.spacing(pt_loop))), "Mismatch in TargetSPRecoilE_pt"
+    print("{} of {} TargetSPRecoilE_pt values bit-identical, the rest within 1 ulp".format(
+        np.sum(pt_loop == pt_vec), len(pt_loop)))
+    print("Outputs match.  loop {:.2f} s ({:.0f} evt/s), vectorized {:.3f} s ({:.0f} evt/s), speedup {:.0f}x".format(
+        t_loop, args.num_events/t_loop, t_vec, args.num_events/t_vec, t_loop/t_vec))
+
+
+if __name__ == '__main__':
+    run(parser.parse_args())
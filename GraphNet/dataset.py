@@ -3,8 +3,13 @@ from __future__ import print_function
 import numpy as np
 import torch
 import torch.nn.functional as F
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
 import glob
+import os
+import json
+import itertools
+import collections
+import multiprocessing as mp
 import tqdm
 import uproot
 import awkward
@@ -12,6 +17,9 @@ import concurrent.futures
 # NEW:
 import ROOT as r
 
+from utils.event_kernels import sp_trajectories, TRAJECTORY_BRANCHES, RADIUS_CATEGORY_BRANCH
+from utils.ParticleNet import first_layer_knn
+
 # Note:  I suggest downloading+importing the psutil module if you need to monitor RAM/GPU usage.
 
 # Create ThreadPoolExecutor to accelerate loading with uproot
@@ -23,6 +31,17 @@ torch.set_default_dtype(torch.float32)
 # Should match value in the preselection.  Determines size of ParticleNet position arrays.
 MAX_NUM_ECAL_HITS = 60  #110  # NOW REDUCED!
 
+# Cache of the number of events in each input file (keyed by path, size and mtime), so the event index can be built
+# without opening every file again.  Kept in $GRAPHNET_CACHE_DIR (default ~/.cache/graphnet), so it doesn't depend on
+# the working directory.  None disables the cache.
+INDEX_CACHE_PATH = os.path.join(os.environ.get('GRAPHNET_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'graphnet'),
+                                'entry_counts.json')
+# Number of threads used to read the entry counts of files that aren't in the cache
+NUM_INDEX_THREADS = 16
+# k of the first EdgeConv layer of the train.py --network presets; pack_dataset.py stores the first layer
+# neighbour indices (see first_layer_knn) for each of these
+KNN_KS = [5, 7, 16]
+
 # NEW: Radius of containment data
 # Note:  Should still be valid for 2e ParticleNet unless the shower shape has changed
 radius_beam_68 = [4.73798004, 4.80501156, 4.77108164, 4.53839401, 4.73273021,
@@ -43,6 +62,7 @@ radius_recoil_68_theta_10_20 = [4.0251896715647115, 4.071661598616328, 4.3576900
 radius_recoil_68_theta_20_end = [4.0754238481177705, 4.193693485630508, 5.14209420056253, 6.114996249971468, 7.7376807326481645, 8.551663213602291, 11.129110612057813, 13.106293737495639, 17.186617323282082, 19.970887612094604, 25.04088272634407, 28.853696411302344, 34.72538105333071, 40.21218694947545, 46.07344239520299, 50.074953583805346, 62.944045771758645, 61.145621459396814, 69.86940198299047, 74.82378572939959, 89.4528387422834, 93.18228303096758, 92.51751129204555, 98.80228884380018, 111.17537347472128, 120.89712563907408, 133.27021026999518, 142.99196243434795, 155.36504706526904, 165.08679922962185, 177.45988386054293, 187.18163602489574, 199.55472065581682, 209.2764728201696]
 
 radius_68 = [radius_beam_68,radius_recoil_68_p_0_500_theta_0_10, radius_recoil_68_p_500_1500_theta_0_10,radius_recoil_68_theta_10_20,radius_recoil_68_theta_20_end]
+_radius_68_array = np.array(radius_68)  # [radius category, layer]
 
 
 
@@ -56,11 +76,229 @@ def _concat(arrays, axis=0):
 
 
 
+def _read_entry_counts(files, cache_path=INDEX_CACHE_PATH, treename='skimmed_events'):
+    # Returns {filename: number of entries in treename} for every file.  Counts are looked up in the cache at
+    # cache_path first; the remaining files are opened with uproot (only the tree metadata is read) in parallel.
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    def key(fp):
+        stat = os.stat(fp)
+        return [stat.st_size, stat.st_mtime]
+
+    def count(fp):
+        with uproot.open(fp) as f:
+            return f[treename].num_entries
+
+    keys = {fp: key(fp) for fp in files}
+    counts = {}
+    missing = []
+    for fp in files:
+        entry = cache.get(os.path.abspath(fp))
+        if entry is not None and entry['key'] == keys[fp]:
+            counts[fp] = entry['entries']
+        else:
+            missing.append(fp)
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor(NUM_INDEX_THREADS) as executor:
+            for fp, n in zip(missing, executor.map(count, missing)):
+                counts[fp] = n
+                cache[os.path.abspath(fp)] = {'key': keys[fp], 'entries': n}
+        if cache_path:
+            # Write to a temporary file and rename it, so concurrent jobs never see a half-written cache
+            if os.path.dirname(cache_path) and not os.path.exists(os.path.dirname(cache_path)):
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(cache, f)
+                f.write('\n')
+            os.replace(tmp_path, cache_path)
+    print("   Read entry counts for {} files ({} from cache)".format(len(files), len(files) - len(missing)))
+    return counts
+
+
+# Geometry lookup tables by detector version, loaded once per process (see _load_geometry)
+_geometry_cache = {}
+
+
+def _load_geometry(version):
+    # Dense lookup tables for decoding hit positions:
+    # - layer_z[layer]:  z of each ecal layer
+    # - z_to_layer[round(z) - z_offset]:  layer at (rounded) z, -1 where there is none (v13)
+    # - cell_xy[10*cell + module]:  xy of each cell, NaN where there is no cell (v12)
+    if version not in _geometry_cache:
+        layer_z = np.loadtxt('data/%s/layer.txt' % version)
+        geometry = {'layer_z': layer_z}
+        rounded = np.rint(layer_z).astype('int64')
+        geometry['z_offset'] = rounded.min()
+        geometry['z_to_layer'] = np.full(rounded.max() - rounded.min() + 1, -1, dtype='int64')
+        geometry['z_to_layer'][rounded - rounded.min()] = np.arange(len(layer_z))
+        if version == 'v12':
+            cellmodule = np.loadtxt('data/%s/cellmodule.txt' % version)
+            ids = cellmodule[:, 0].astype('int64')
+            geometry['cell_xy'] = np.full((ids.max() + 1, 2), np.nan)
+            geometry['cell_xy'][ids] = cellmodule[:, 1:3]
+        _geometry_cache[version] = geometry
+    return _geometry_cache[version]
+
+
+class _TreePool:
+    # Bounded LRU pool of open (TFile, TTree) handles, keyed by file path.
+    # Opening a TFile and parsing its header for every event used to be the main bottleneck in __getitem__;
+    # the pool keeps the most recently used max_open_files files open instead.
+    # Each process owns its own handles:  after a fork (e.g. into a DataLoader worker), the inherited handles
+    # share file offsets with the parent, so they're dropped and the pool is rebuilt from scratch in the child.
+    # The hit/miss counters live in shared memory, so counts from all workers are visible in the parent.
+
+    def __init__(self, max_open_files=64, treename='skimmed_events'):
+        assert(max_open_files > 0)
+        self.max_open_files = max_open_files
+        self.treename = treename
+        self._counts = mp.Array('q', 2)  # [hits, misses]
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._handles = collections.OrderedDict()  # filename -> (tfile, ttree), least recently used first
+
+    def __getstate__(self):
+        # ROOT handles can't be pickled (spawn-based workers); the receiving process reopens files as needed
+        state = self.__dict__.copy()
+        del state['_handles']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def get(self, filename):
+        if os.getpid() != self._pid:
+            self._reset()
+        if filename in self._handles:
+            self._handles.move_to_end(filename)
+            self._count(0)
+            return self._handles[filename][1]
+        self._count(1)
+        if len(self._handles) >= self.max_open_files:
+            _, (old_tfile, _) = self._handles.popitem(last=False)
+            old_tfile.Close()
+        tfile = r.TFile(filename)
+        ttree = tfile.Get(self.treename)
+        self._handles[filename] = (tfile, ttree)
+        return ttree
+
+    def _count(self, i):
+        with self._counts.get_lock():
+            self._counts[i] += 1
+
+    def stats(self):
+        hits, misses = self._counts[:]
+        return {'hits': hits, 'misses': misses}
+
+    def reset_stats(self):
+        with self._counts.get_lock():
+            self._counts[0] = 0
+            self._counts[1] = 0
+
+
+def static_knn(coordinates, features, k):
+    # first_layer_knn for arrays with any number of leading (event/region) dims:  (..., 3, P) coordinates and
+    # (..., num_features, P) features -> int8 (..., P, k) neighbour indices (P = MAX_NUM_ECAL_HITS < 128)
+    shape = coordinates.shape[:-2]
+    with torch.no_grad():
+        idx = first_layer_knn(torch.from_numpy(np.ascontiguousarray(coordinates, dtype='float32').reshape(-1, *coordinates.shape[-2:])),
+                              torch.from_numpy(np.ascontiguousarray(features, dtype='float32').reshape(-1, *features.shape[-2:])), k)
+    return idx.numpy().astype('int8').reshape(*shape, coordinates.shape[-1], k)
+
+
+class _FeatureCache:
+    # Cache of featurized events (the padded (nRegions, 5, MAX_NUM_ECAL_HITS) feature arrays; coordinates are the
+    # first 3 features) in one shared-memory arena, so events only have to be read and featurized once rather than
+    # every epoch.  The arena is allocated before the DataLoader workers are forked, so all workers and epochs share
+    # it.  It holds up to max_mb of features; when it's full, the oldest entries are overwritten (FIFO ring).
+    # Lookups/inserts are serialized by one lock (they're just a ~KB copy).
+    # fields:  {name: (shape, dtype)} of the arrays stored for every event (e.g. features and first layer knn indices).
+
+    def __init__(self, num_events, fields, max_mb):
+        self.fields = collections.OrderedDict((name, (tuple(shape), np.dtype(dtype))) for name, (shape, dtype) in fields.items())
+        self._slot_size = sum(int(np.prod(shape)) * dtype.itemsize for shape, dtype in self.fields.values())  # bytes
+        self.num_slots = min(num_events, int(max_mb * 1e6) // self._slot_size)
+        assert(self.num_slots > 0), "Feature cache of {} MB is too small for a single event".format(max_mb)
+        self._lock = mp.Lock()
+        self._arenas = [mp.RawArray('b', self.num_slots * int(np.prod(shape)) * dtype.itemsize)
+                        for shape, dtype in self.fields.values()]
+        self._slot_of_event = mp.RawArray('i', num_events)  # -1 if not cached
+        self._event_of_slot = mp.RawArray('q', self.num_slots)  # -1 if empty
+        np.frombuffer(self._slot_of_event, dtype='int32')[:] = -1
+        np.frombuffer(self._event_of_slot, dtype='int64')[:] = -1
+        self._counts = mp.RawArray('q', 3)  # [hits, misses, inserts]; inserts % num_slots is the next slot to fill
+        self._views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_views'] = None
+        return state
+
+    def _view(self):
+        # numpy views of the shared arrays (created lazily in each process)
+        if self._views is None:
+            arenas = {name: np.frombuffer(arena, dtype=dtype).reshape((self.num_slots,) + shape)
+                      for (name, (shape, dtype)), arena in zip(self.fields.items(), self._arenas)}
+            self._views = (arenas,
+                           np.frombuffer(self._slot_of_event, dtype='int32'),
+                           np.frombuffer(self._event_of_slot, dtype='int64'),
+                           np.frombuffer(self._counts, dtype='int64'))
+        return self._views
+
+    def get(self, i):
+        # Returns {name: copy of the cached array} for event i, or None
+        arenas, slot_of_event, _, counts = self._view()
+        with self._lock:
+            slot = slot_of_event[i]
+            if slot < 0:
+                counts[1] += 1
+                return None
+            counts[0] += 1
+            return {name: arena[slot].copy() for name, arena in arenas.items()}
+
+    def put(self, i, arrays):
+        # arrays:  {name: array} for every field
+        arenas, slot_of_event, event_of_slot, counts = self._view()
+        with self._lock:
+            if slot_of_event[i] >= 0:  # Another worker got there first
+                return
+            slot = counts[2] % self.num_slots
+            if event_of_slot[slot] >= 0:
+                slot_of_event[event_of_slot[slot]] = -1  # Evict the oldest entry
+            for name, arena in arenas.items():
+                arena[slot] = arrays[name]
+            slot_of_event[i] = slot
+            event_of_slot[slot] = i
+            counts[2] += 1
+
+    def stats(self):
+        _, _, _, counts = self._view()
+        hits, misses, inserts = [int(c) for c in counts]
+        return {'hits': hits, 'misses': misses, 'events': min(inserts, self.num_slots),
+                'mb': min(inserts, self.num_slots) * self._slot_size / 1e6}
+
+    def reset_stats(self):
+        _, _, _, counts = self._view()
+        with self._lock:
+            counts[0] = 0
+            counts[1] = 0
+
+
 class ECalHitsDataset(Dataset):
 
-    def __init__(self, siglist, bkglist, load_range=(0, 1), obs_branches=[], coord_ref=None, detector_version='v13', nRegions=1, regSizes=None):
+    def __init__(self, siglist, bkglist, load_range=(0, 1), obs_branches=[], coord_ref=None, detector_version='v13', nRegions=1, regSizes=None,
+                 max_open_files=64, index_cache=INDEX_CACHE_PATH, cache_mb=0, knn_k=None):
         super(ECalHitsDataset, self).__init__()
         print("Initializing EcalHitsDataset")
+        # Pool of open files/trees used by __getitem__ (see _TreePool)
+        self._tree_pool = _TreePool(max_open_files)
         # load cell map (for calculating xyz+layer from hit IDs)
         self._load_cellMap(version=detector_version)
         self.detector_version = detector_version
@@ -73,12 +311,8 @@ class ECalHitsDataset(Dataset):
         else:
             self._branches = [self._id_branch] + [self._pos_branch.format(v) for v in ['x', 'y', 'z']]
 
+        # Scalar branches saved alongside the predictions for plotting; read in bulk by get_obs_data()
         self.obs_branches = obs_branches
-        # NOTE:  Need to explicitly keep track of and save all obs_dict data!  Fortunately, order doesn't matter.
-        self.obs_dict = {br:[] for br in self.obs_branches}
-        # Also need to keep track of events that have been loaded into obs_dict, to ensure no duplicates
-        # Just store a list of the event numbers
-        self.loaded_events = []
 
         self.coord_ref = coord_ref
         assert(detector_version != 'v9')  # v9 compatibility would be nontrivial to add, and is probably unnecessary
@@ -89,13 +323,12 @@ class ECalHitsDataset(Dataset):
         # - Input events have all been preselected.
         # - All event data is stored in a "simple" root tree with no sub-branches
         # - Need to create a mapping:  event number -> returns sig/bkg, root file, and evt number within that file
-        #    - [[mass, filename, i_file], ...]
-        #    - Get element i of the list whenever PN requests an event, and find the event location based on that info
+        #    - Stored as flat arrays:  self._file_id[i] (index into self._files), self._entry[i], self.label[i]
+        #    - Look up element i of the arrays whenever PN requests an event, and find the event location based on that info
+        #    - (These are much smaller than a list of [label, filename, i_file] lists, and are shared with DataLoader
+        #      workers after the fork without being copied.)
 
-        self.event_list = []  # == [[mass, filename, i_file], ...]
-        self.extra_labels = []  # mass in MeV if sig, 0 if bkg; converted to np array below
-        print("Filling event_list")
-        # fill event_list to make event access easy
+        print("Filling event index")
         filelist = {}
         for label, fname in bkglist.items():
             filelist[label] = fname
@@ -103,36 +336,54 @@ class ECalHitsDataset(Dataset):
             filelist[label] = fname
         print("Using filelist=", filelist)
 
+        # Files are sorted so the same events are selected regardless of the order glob returns them in
+        globbed = {extra_label: sorted(glob.glob(filelist[extra_label][0])) for extra_label in filelist}
+        entry_counts = _read_entry_counts([fp for files in globbed.values() for fp in files], index_cache)
+
+        self._files = []  # == [filename, ...], indexed by self._file_id
+        file_ids, entries, extra_labels = [], [], []
         for extra_label in filelist:  # For each mass:
-            filepath, max_events = filelist[extra_label]
+            max_events = filelist[extra_label][1]
             if max_events == -1:
                 max_events = 1e8  # Unrealistically large so it never constrains the results
             num_loaded_events = 0  # Number of events so far for this mass
-            #print("   Filling for m={}".format(extra_label))
-            for fp in glob.glob(filepath):
-                # For each file, check the number of events, then add to event_list accordingly
+            for fp in globbed[extra_label]:
+                # For each file, check the number of events, then add to the index accordingly
                 if num_loaded_events == max_events:  break
-                tfile = r.TFile(fp)
-                ttree = tfile.Get('skimmed_events')
-                f_events = ttree.GetEntries()  # Num events in file
+                f_events = entry_counts[fp]  # Num events in file
                 # load_range specifies fraction of file to load from.
                 start, stop = [int(x * f_events) for x in load_range]
-
-                f_event = start
-                while num_loaded_events < max_events and f_event < stop:
-                    self.event_list.append([extra_label if extra_label <= 1 else 1, fp, f_event])
-                    self.extra_labels.append(extra_label)
-                    num_loaded_events += 1
-                    f_event += 1
-                #print("      {} events in file, {} total for current mass".format(f_event, num_loaded_events))
+                stop = int(min(stop, start + max_events - num_loaded_events))
+                if stop <= start:
+                    continue
+                file_ids.append(np.full(stop - start, len(self._files), dtype='int32'))
+                entries.append(np.arange(start, stop, dtype='int64'))
+                extra_labels.append(np.full(stop - start, extra_label, dtype='int32'))
+                self._files.append(fp)
+                num_loaded_events += stop - start
             print("   Loaded m={}:  using {} events".format(extra_label, num_loaded_events))
 
-        self.extra_labels = np.array(self.extra_labels)
-        self.label = np.array([1 if l > 0 else 0 for l in self.extra_labels])  # 1 if sig, 0 if bkg
+        self._file_id = np.concatenate(file_ids) if file_ids else np.zeros(0, dtype='int32')
+        self._entry = np.concatenate(entries) if entries else np.zeros(0, dtype='int64')
+        self.extra_labels = np.concatenate(extra_labels) if extra_labels else np.zeros(0, dtype='int32')  # mass in MeV if sig, 0 if bkg
+        self.label = (self.extra_labels > 0).astype('int8')  # 1 if sig, 0 if bkg
 
         if regSizes:  assert(nRegions == len(regSizes))
         self.regSizes = regSizes
 
+        # If set, __getitem__ also returns the first layer knn indices for this k (see first_layer_knn)
+        self.knn_k = knn_k
+
+        # Optional shared-memory cache of the featurized events (see _FeatureCache)
+        self._feature_cache = None
+        if cache_mb > 0 and len(self) > 0:
+            fields = {'features': ((nRegions, self.num_features, MAX_NUM_ECAL_HITS), 'float32')}
+            if knn_k:
+                fields['knn'] = ((nRegions, MAX_NUM_ECAL_HITS, knn_k), 'int8')
+            self._feature_cache = _FeatureCache(len(self), fields, cache_mb)
+            print("Feature cache:  up to {} of {} events ({} MB)".format(
+                self._feature_cache.num_slots, len(self), cache_mb))
+
         print("Initialization finished.")
 
 
@@ -143,7 +394,12 @@ class ECalHitsDataset(Dataset):
         return 5
 
     def __len__(self):
-        return len(self.event_list)
+        return len(self._entry)
+
+    @property
+    def file_ids(self):
+        # Input file of every event (events of a file are contiguous and in entry order); see FileBlockShuffleSampler
+        return self._file_id
 
 
     def __getitem__(self, i):
@@ -151,40 +407,53 @@ class ECalHitsDataset(Dataset):
         # By assumption, events have already been preselected!
         # returns:  label (sig/bkg), coords (xyz), features (xyzLE)
 
-        # Get info on event location from event_list:
-        label, filename, file_index = self.event_list[i]
+        # Get info on event location from the index:
+        label, filename, file_index = int(self.label[i]), self._files[self._file_id[i]], int(self._entry[i])
 
-        self.obs_data = {k:[] for k in self.obs_branches}
+        if self._feature_cache is not None:
+            cached = self._feature_cache.get(i)
+            if cached is not None:
+                features = cached['features']
+                if self.knn_k:
+                    return np.ascontiguousarray(features[:, :3]), features, label, cached['knn']
+                return np.ascontiguousarray(features[:, :3]), features, label
 
-        tfile = r.TFile(filename)  # NOTE:  This is the bottleneck!  (Slow, limits performance)
-        # ...could theoretically speed up by maintaining a list of all TFiles in use
-        self.ttree = tfile.Get('skimmed_events')
+        # Reuse an already-open file/tree if possible; opening the TFile used to be the bottleneck here
+        self.ttree = self._tree_pool.get(filename)
         # Prepare to load data from event [file_index]:
         self.ttree.GetEntry(file_index)
         # load_sp_data():  Need to get info from TargetScoringPlanes to compute projected electron/photon
         # trajectories -> decide what region each event goes into
         self._load_sp_data()
-        # read_event():  Fills var_dict and obs_dict
-        # obs_dict contains obs_branches info loaded from train.py; saved for plotting
+        # read_event():  Fills var_dict
         # var_dict contains feature info necessary for PN:  x, y, z, layer, log(E); multi-dimensional
         # if other regions included
-        var_data, obs_data = self._read_event()
-        # o_d data must be saved for plotting/etc.  Ensure data from that event hasn't been recorded first:
-        if not i in self.loaded_events:
-            for branch in self.obs_branches:
-                self.obs_dict[branch].append(obs_data[branch])
-            self.loaded_events.append(i)
+        var_data = self._read_event()
 
         # create features and coordinates:
         # NOTE:  Always 3-dimensional!  [[a, b...]] for 1-region PN
         coordinates = np.stack((var_data['x_'], var_data['y_'], var_data['z_']), axis=1)
         features    = np.stack((var_data['x_'], var_data['y_'], var_data['z_'],
                                 var_data['layer_id_'], var_data['log_energy_']), axis=1)
+        knn_idx = static_knn(coordinates, features, self.knn_k) if self.knn_k else None
+        if self._feature_cache is not None:
+            self._feature_cache.put(i, {'features': features, 'knn': knn_idx})
+        if self.knn_k:
+            return coordinates, features, label, knn_idx
         return coordinates, features, label
 
 
     # _load_sp_data():  calculate the projected/predicted electron/photon trajectories from SPHits data
     def _load_sp_data(self):
+        if self.ttree.GetBranch(RADIUS_CATEGORY_BRANCH):
+            # Trajectories were already computed by file_processor.py; just read them
+            traj = {b: self.ttree.GetLeaf(b).GetValue(0) for b in TRAJECTORY_BRANCHES}
+            for name in ['etraj_sp', 'enorm_sp', 'ptraj_sp', 'pnorm_sp']:
+                setattr(self, name, np.array([traj['{}_{}'.format(name, v)] for v in ['x', 'y', 'z']]))
+            self.radius_category = int(self.ttree.GetLeaf(RADIUS_CATEGORY_BRANCH).GetValue(0))
+            return
+
+        # Older input files:  compute them from the scoring plane hits
         pdgID_leaf = self.ttree.GetLeaf('pdgID_')
         z_leaf     = self.ttree.GetLeaf('z_')
         pz_leaf    = self.ttree.GetLeaf('pz_')
@@ -255,12 +524,12 @@ class ECalHitsDataset(Dataset):
             self.enorm_sp = np.array((-999,-999,-999))
             self.pnorm_sp = np.array((-999,-999,-999))
             self.ptraj_sp = np.array((-999,-999,-999))
+        self.radius_category = self._radius_category()
 
 
 
     def _read_event(self):
-        # Read data from event and fill var_dict and obs_dict:
-        # obs_dict contains obs_branches info (branches specified in train.py); saved for plotting
+        # Read data from event and fill var_dict:
         # var_dict contains info necessary for PN:  x, y, z, layer, log(E); more if other regions included
         if self.detector_version == 'v12':
             eid_leaf    = self.ttree.GetLeaf(self._id_branch)
@@ -281,176 +550,692 @@ class ECalHitsDataset(Dataset):
             layer_id = self._getlayer(z)
 
 
-        # Now, work with table['etraj_ref'] and table['ptraj_ref'].
-        # Create lists:  x/y/z_e, p
-        # For each event, look through all hits.
-        # - Determine whether hit falls inside either the e or p RoCs
-        # - If so, fill corresp xyzlayer, energy, eid lists...
+        # Sort the hits into regions and build the (padded) feature arrays:
+        var_dict = self._fill_regions(x, y, z, layer_id, energy)
+
+        return var_dict
+
+
+    def _radius_category(self):
+        # Select the class of containment radii (index into radius_68) based on the recoil trajectory.
+        # Note that recoilangle is really cos(theta) and recoil_p is |enorm_sp| (~1), so this is normally 1.
+        if self.etraj_sp[2] != -999:  # If fiducial
+            recoil_p = np.sqrt(self.enorm_sp[0]**2 + self.enorm_sp[1]**2 + self.enorm_sp[2]**2)
+            recoilangle = self.enorm_sp[2] / recoil_p
+        else:
+            recoilangle = -999
+            recoil_p    = -999
+        if recoilangle < 10 and recoil_p < 500:
+            return 1
+        elif recoilangle < 10 and recoil_p >= 500:
+            return 2
+        elif recoilangle <= 20:
+            return 3
+        else:
+            return 4
+
+    def _fill_regions(self, x, y, z, layer_id, energy):
+        # Determine which region(s) each hit falls into and fill the padded (nRegions, MAX_NUM_ECAL_HITS) feature
+        # arrays.  Hit j is stored at position j of every region it belongs to (other regions stay 0-padded).
+        # Vectorized over all hits of the event; the per-event quantities (trajectories, radius category) are only
+        # computed once.
+        x        = np.asarray(x)
+        y        = np.asarray(y)
+        z        = np.asarray(z)
+        layer_id = np.asarray(layer_id, dtype='int')
+        energy   = np.asarray(energy)
+
         x_          = np.zeros((self.nRegions, MAX_NUM_ECAL_HITS), dtype='float32')
         y_          = np.zeros((self.nRegions, MAX_NUM_ECAL_HITS), dtype='float32')
         z_          = np.zeros((self.nRegions, MAX_NUM_ECAL_HITS), dtype='float32')
         log_energy_ = np.zeros((self.nRegions, MAX_NUM_ECAL_HITS), dtype='float32')
         layer_id_   = np.zeros((self.nRegions, MAX_NUM_ECAL_HITS), dtype='float32')
 
-        regionIndices = [0, 0, 0]  # Indices of last hit added to feature arrays
+        # xy coords of the projected electron/photon trajectories in the layer of each hit
+        if self.etraj_sp[2] != -999:  # If fiducial
+            delta_z = z - self.etraj_sp[2]
+            etraj_x = self.etraj_sp[0] + self.enorm_sp[0]*delta_z
+            etraj_y = self.etraj_sp[1] + self.enorm_sp[1]*delta_z
+            ptraj_x = self.ptraj_sp[0] + self.pnorm_sp[0]*delta_z
+            ptraj_y = self.ptraj_sp[1] + self.pnorm_sp[1]*delta_z
+        else:
+            etraj_x, etraj_y = self.etraj_sp[0], self.etraj_sp[1]  # (-999, -999)
+            ptraj_x, ptraj_y = self.ptraj_sp[0], self.ptraj_sp[1]
+
+        # Determine what regions the hits fall into:
+        radius = 2.0 * np.asarray(radius_68[self.radius_category])[layer_id]
+        insideElectronRadius = np.sqrt((etraj_x - x)**2 + (etraj_y - y)**2) < radius
+        insidePhotonRadius   = np.sqrt((ptraj_x - x)**2 + (ptraj_y - y)**2) < radius
+        # If an SP electron hit is missing, place all hits in the event into the ~~"other"~~ PHOTON region
+        if self.enorm_sp[2] == -999:
+            insideElectronRadius[:] = False
+            insidePhotonRadius[:]   = True
+
+        if self.nRegions == 1:
+            in_region = [np.ones_like(insideElectronRadius)]
+        elif self.nRegions == 2:
+            in_region = [insideElectronRadius, ~insideElectronRadius]
+        elif self.nRegions == 3:
+            # (Hits can be inside both the electron and photon regions)
+            in_region = [insideElectronRadius, insidePhotonRadius, ~insideElectronRadius & ~insidePhotonRadius]
+
+        log_energy = np.full(energy.shape, -1, dtype='float32')  # Note:  E<1 is very uncommon, so -1 is okay to round to.
+        log_energy[energy > 0] = np.log(energy[energy > 0])
+
+        # Scatter every (region, hit) pair into place
+        reg, hit = np.nonzero(np.stack(in_region))
+        x_[reg, hit] = (x - etraj_x)[hit]  # Store relative to xy distance from trajectory
+        y_[reg, hit] = (y - etraj_y)[hit]
+        z_[reg, hit] = z[hit]  # Used to be defined relative to the ecal face; changed to absolute bc of Huilin's old results
+        layer_id_[reg, hit] = layer_id[hit]
+        log_energy_[reg, hit] = log_energy[hit]
 
-        for j in range(len(layer_id)):  #eid_leaf.GetLen()):  # For every hit...
+        # Create and fill var_dict w/ feature information:
+        return {'x_':x_, 'y_':y_, 'z_':z_,
+                'layer_id_':layer_id_,
+                'log_energy_':log_energy_,
+               }
 
-            # Calculate xy coord of point on projected trajectory in same layer
-            delta_z = z[j] - self.etraj_sp[2]
-            if self.etraj_sp[2] != -999:  # If fiducial
-                etraj_point = (self.etraj_sp[0] + self.enorm_sp[0]*delta_z, self.etraj_sp[1] + self.enorm_sp[1]*delta_z)
-                ptraj_point = (self.ptraj_sp[0] + self.pnorm_sp[0]*delta_z, self.ptraj_sp[1] + self.pnorm_sp[1]*delta_z)
-                # Additionally, calculate recoil angle (angle of pnorm_sp):
-                recoilangle = self.enorm_sp[2] / np.sqrt(self.enorm_sp[0]**2 + self.enorm_sp[1]**2 + self.enorm_sp[2]**2)
-                recoil_p = np.sqrt(self.enorm_sp[0]**2 + self.enorm_sp[1]**2 + self.enorm_sp[2]**2) 
-            else:
-                etraj_point = self.etraj_sp  # (-999, -999, -999)
-                ptraj_point = self.ptraj_sp
-
-                recoilangle = -999
-                recoil_p    = -999
-            ir = -1
-            #if recoilangle==-1 or recoil_p==-1:  ir = 1  # Not used for now
-            # Select the class of containment radii based on trajectory angle/energy:
-            if recoilangle < 10 and recoil_p < 500:
-                ir = 1
-            elif recoilangle < 10 and recoil_p >= 500:
-                ir = 2
-            elif recoilangle <= 20:
-                ir = 3
-            else:
-                ir = 4
-            # Determine what regions the hit falls into:
-            insideElectronRadius = np.sqrt((etraj_point[0] - x[j])**2 + \
-                    (etraj_point[1] - y[j])**2) < 2.0 * radius_68[ir][layer_id[j]]
-            insidePhotonRadius   = np.sqrt((ptraj_point[0] - x[j])**2 + \
-                    (ptraj_point[1] - y[j])**2) < 2.0 * radius_68[ir][layer_id[j]]
-            # If an SP electron hit is missing, place all hits in the event into the ~~"other"~~ PHOTON region
-            # 3-region:
-            if self.enorm_sp[2] == -999:
-                insideElectronRadius = False
-                insidePhotonRadius   = True
-            
-            regions = []  # Regions hit falls inside
-            if self.nRegions == 1:
-                regions.append(0)
-            elif self.nRegions == 2:
-                if insideElectronRadius:
-                    regions.append(0)
-                else:
-                    regions.append(1)
-            elif self.nRegions == 3:
-                if insideElectronRadius:
-                    regions.append(0)
-                if insidePhotonRadius:
-                    regions.append(1)
-                if not insideElectronRadius and not insidePhotonRadius:
-                    regions.append(2)
-            # Add to each region (need multiple in case inside electron and photon in 3-region)
-
-            
-            for r in range(self.nRegions):
-                if r in regions:
-                    x_[r][j] = x[j] - etraj_point[0]  # Store relative to xy distance from trajectory
-                    y_[r][j] = y[j] - etraj_point[1]
-                    z_[r][j] = z[j]  # - self._layerZs[0]  # Used to be defined relative to the ecal face; changed to absolute bc of Huilin's old results
-                    layer_id_[r][j] = layer_id[j]
-                    log_energy_[r][j] = np.log(energy[j]) if energy[j] > 0 else -1  # Note:  E<1 is very uncommon, so -1 is okay to round to.
-            """
-            for r in range(self.nRegions):
-                # Note location of previous hit added to array.  Add after it.
-                if r in regions:  # if hit belongs in region r:
-                    k = regionIndices[r]
-                    x_[r][k] = x[j] - etraj_point[0]  # Store relative to xy distance from trajectory
-                    y_[r][k] = y[j] - etraj_point[1]
-                    z_[r][k] = z[j]  # - self._layerZs[0]  # Used to be defined relative to the ecal face; changed to absolute bc of Huilin's old results
-                    layer_id_[r][k] = layer_id[j]
-                    log_energy_[r][k] = np.log(energy[j]) if energy[j] > 0 else -1  # Note:  E<1 is very uncommon, so -1 is okay to round to.
-                    regionIndices[r] += 1
-            """
-        # NOTE:  TESTING
-        #print("current x_1: (should be 0-padded) "+str(x_[0]))
 
 
-        # Create and fill var_dict w/ feature information:
-        var_dict = {'x_':x_, 'y_':y_, 'z_':z_,
-                    'layer_id_':layer_id_,
-                    'log_energy_':log_energy_,
-                   }
+        
+    def pool_stats(self):
+        # Number of __getitem__ calls that reused an open file (hits) or had to open one (misses),
+        # summed over all DataLoader workers since the last reset_pool_stats()
+        return self._tree_pool.stats()
 
-        # Lastly, create and fill obs_dict w/ branches specified in train.py:
-        o_dict = {}
-        for branch in self.obs_branches:
-            o_leaf = self.ttree.GetLeaf(branch)
-            o_arr = np.array([o_leaf.GetValue(i) for i in range(o_leaf.GetLen())], dtype='float32')
-            o_dict[branch] = o_arr
+    def reset_pool_stats(self):
+        self._tree_pool.reset_stats()
 
-        return var_dict, o_dict
+    def cache_stats(self):
+        # Feature cache hits/misses since the last reset_cache_stats() (all workers), and the number of events/MB
+        # currently cached.  None if the cache is disabled.
+        if self._feature_cache is None:
+            return None
+        return self._feature_cache.stats()
 
+    def reset_cache_stats(self):
+        if self._feature_cache is not None:
+            self._feature_cache.reset_stats()
 
 
-        
-    # NOTE/WARNING:  After use, obs_dict will consist of np arrays, not lists, and cannot be appended to.
-    # Shouldn't be an issue--should never need to call get_obs_data() before alll events have been added.
-    # Could just return a new array instead, ofc, but unnecessary+eats up a lot of ram.
     def get_obs_data(self):
-        for branch in self.obs_branches:
-            if self.obs_dict[branch] is list:
-                self.obs_dict[branch] = np.concatenate(self.obs_dict[branch])
-        return self.obs_dict
+        # Returns {branch: float32 array with one value per event, in dataset order} for every obs branch.
+        # The branches are read directly with uproot, one bulk read per file (only the range of entries used by the
+        # dataset), so nothing has to be loaded event by event through __getitem__.
+        return self._read_branches(self.obs_branches)
+
+    def hit_counts(self):
+        # Number of (padded) points every event fills:  the rec hits with E>0, capped at MAX_NUM_ECAL_HITS.
+        # Read in bulk from the nRecHits branch written by file_processor.py; see HitCountBucketBatchSampler.
+        counts = self._read_branches(['nRecHits'])['nRecHits']
+        return np.minimum(counts, MAX_NUM_ECAL_HITS).astype('int32')
+
+    def _read_branches(self, branches):
+        # {branch: float32 array with one value per event, in dataset order} for the given scalar branches
+        data = {branch: np.zeros(len(self), dtype='float32') for branch in branches}
+        if not branches or len(self) == 0:
+            return data
+
+        # Events of each file are stored contiguously in the index; find the span of every file
+        boundaries = np.flatnonzero(np.diff(self._file_id)) + 1
+        starts = np.concatenate(([0], boundaries))
+        stops = np.concatenate((boundaries, [len(self)]))
+
+        def read(span):
+            start, stop = span
+            entries = self._entry[start:stop]
+            with uproot.open(self._files[self._file_id[start]]) as f:
+                arrays = f['skimmed_events'].arrays(branches, entry_start=entries.min(),
+                                                    entry_stop=entries.max() + 1, library='np')
+            for branch in branches:
+                data[branch][start:stop] = arrays[branch][entries - entries.min()]
+
+        with concurrent.futures.ThreadPoolExecutor(NUM_INDEX_THREADS) as executor:
+            list(executor.map(read, zip(starts, stops)))
+        return data
 
 
     def _load_cellMap(self, version='v13'):
-        self._cellMap = {}  # cellMap used for v12 only
-        if version=='v12':
-            for i, x, y in np.loadtxt('data/%s/cellmodule.txt' % version):
-                self._cellMap[i] = (x, y)
-            self._layerZs = np.loadtxt('data/%s/layer.txt' % version)
-        if version=='v13':
-            zd = np.loadtxt('data/%s/layer.txt' % version)
-            self._layerZs = {round(zd[i]):i for i in range(len(zd))}
+        # Geometry lookup tables (cell positions for v12, z -> layer for v13), shared by every dataset in the process
+        self._geometry = _load_geometry(version)
         print("Loaded geometry info")
 
     def _getlayer(self, zarr):
         # Pass in multidim array of z positions, return array of layer numbers
-        #print(self._layerZs)
-        #print(zarr[:10])
-        def roundreturn(val):
-            return self._layerZs[round(val)]
-        return list(map(roundreturn, zarr))  #self._layerZs.__getitem__, zarr))
+        # (round(z) is looked up in the dense table; np.rint rounds half to even like round())
+        geometry = self._geometry
+        iz = np.rint(np.asarray(zarr, dtype='float64')).astype('int64') - geometry['z_offset']
+        valid = (iz >= 0) & (iz < len(geometry['z_to_layer']))
+        layer = np.where(valid, geometry['z_to_layer'][np.where(valid, iz, 0)], -1)
+        if (layer < 0).any():
+            raise KeyError("No ecal layer at z = {}".format(np.asarray(zarr)[layer < 0][:5]))
+        return layer
 
     def _parse_cid(self, cid):  # Retooled for v12
         # Translate hit IDs into xyz+layer data
         # For id details, see (?):  ldmx-sw/DetDescr/src/EcalID.cxx
-
-        cell   = (cid >> 0)  & 0xFFF #(awkward.to_numpy(awkward.flatten(cid)) >> 0)  & 0xFFF
-        module = (cid >> 12) & 0x1F  #(awkward.to_numpy(awkward.flatten(cid)) >> 12) & 0x1F
-        layer  = (cid >> 17) & 0x3F  #(awkward.to_numpy(awkward.flatten(cid)) >> 17) & 0x3F
+        cid = np.asarray(cid, dtype='int64')
+        cell   = (cid >> 0)  & 0xFFF
+        module = (cid >> 12) & 0x1F
+        layer  = (cid >> 17) & 0x3F
         mcid = 10 * cell + module
-        #if len(mcid) == 1:
-        #    print("FOUND ONE-HIT EVENT...{}".format(mcid))
-        #if len(mcid) == 0:
-        #    print("FOUND ZERO-HIT EVENT, this shouldn't happen...{}".format(mcid))
-        x, y = zip(*map(self._cellMap.__getitem__, mcid))
-        z = list(map(self._layerZs.__getitem__, layer))
+        cell_xy = self._geometry['cell_xy']
+        valid = mcid < len(cell_xy)
+        xy = cell_xy[np.where(valid, mcid, 0)]
+        if not valid.all() or np.isnan(xy).any():
+            raise KeyError("Unknown ecal cell/module id {}".format(mcid[~valid | np.isnan(xy[:, 0])][:5]))
+        x, y = xy[:, 0], xy[:, 1]
+        z = self._geometry['layer_z'][layer]
         return (x, y, z), layer
 
 
+class PackedECalHitsDataset(Dataset):
+    # Reads events written by pack_dataset.py instead of ROOT files.
+    # The padded coordinate/feature arrays are built once at packing time and stored in fixed-stride .npy shards,
+    # which are memory-mapped here; __getitem__ returns views into the maps, so there's no ROOT I/O or feature
+    # building during training.  Provides the same interface as ECalHitsDataset (label, extra_labels,
+    # num_features, get_obs_data()).
+    # knn_k:  also return the first layer knn indices for this k, which must have been stored by pack_dataset.py.
+
+    def __init__(self, packed_dir, knn_k=None):
+        super(PackedECalHitsDataset, self).__init__()
+        print("Initializing PackedEcalHitsDataset from {}".format(packed_dir))
+        self.packed_dir = packed_dir
+        with open(os.path.join(packed_dir, 'index.json')) as f:
+            self.index = json.load(f)
+        self.knn_k = knn_k
+        if knn_k and knn_k not in self.index.get('knn_k', []):
+            raise ValueError("{} has no first layer knn indices for k={} (packed with k={})".format(
+                packed_dir, knn_k, self.index.get('knn_k', [])))
+        self.nRegions = self.index['nRegions']
+        self.obs_branches = self.index['obs_branches']
+        self._shard_size = self.index['shard_size']
+        self._shards = None  # Memory maps are opened lazily in each process (see _open_shards)
+
+        # Labels are small, so keep them in memory:
+        self.extra_labels = np.concatenate([self._load(shard, 'extra_label') for shard in self.index['shards']])
+        self.label = (self.extra_labels > 0).astype(int)  # 1 if sig, 0 if bkg
+        assert(len(self.extra_labels) == self.index['num_events'])
+        print("Initialization finished:  {} events in {} shards".format(len(self), len(self.index['shards'])))
+
+    def __getstate__(self):
+        # Don't pickle the memory maps (numpy would copy the full arrays); workers reopen them instead
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def _load(self, shard, name, mmap_mode=None):
+        return np.load(os.path.join(self.packed_dir, '{}_{}.npy'.format(name, shard['name'])), mmap_mode=mmap_mode)
+
+    def _open_shards(self):
+        names = ['coordinates', 'features', 'label'] + (['knn%d' % self.knn_k] if self.knn_k else [])
+        self._shards = [{name: self._load(shard, name, mmap_mode='r') for name in names}
+                        for shard in self.index['shards']]
+
+    @property
+    def num_features(self):
+        return self.index['num_features']
+
+    def __len__(self):
+        return self.index['num_events']
+
+    @property
+    def file_ids(self):
+        # Shard of every event; see FileBlockShuffleSampler
+        return (np.arange(len(self)) // self._shard_size).astype('int32')
+
+    def __getitem__(self, i):
+        if self._shards is None:
+            self._open_shards()
+        # All shards except the last have exactly shard_size events
+        shard = self._shards[i // self._shard_size]
+        j = i % self._shard_size
+        if self.knn_k:
+            return shard['coordinates'][j], shard['features'][j], int(shard['label'][j]), shard['knn%d' % self.knn_k][j]
+        return shard['coordinates'][j], shard['features'][j], int(shard['label'][j])
+
+    def get_obs_data(self):
+        return {branch: np.concatenate([self._load(shard, 'obs_' + branch) for shard in self.index['shards']])
+                for branch in self.obs_branches}
+
+    def hit_counts(self):
+        # Number of points every event fills (last nonzero position in any region + 1); see HitCountBucketBatchSampler.
+        # Computed from the features, one shard at a time.
+        return np.concatenate([_real_lengths(self._load(shard, 'features', mmap_mode='r'))
+                               for shard in self.index['shards']]).astype('int32')
+
+
+class FileBlockShuffleSampler(Sampler):
+    # Shuffled sampler that keeps reads mostly sequential within each input file.
+    # A plain random permutation jumps between hundreds of files, so nearly every event needs a seek and a fresh
+    # basket decompression.  Instead, every epoch:
+    # - Events are split into blocks of up to block_size consecutive entries of the same file.
+    # - The blocks are shuffled (this shuffles the order of the files as well as the blocks within each file).
+    # - Events are shuffled within consecutive windows of window_size events (~window_size/block_size blocks
+    #   from different files, so batches still mix files and sig/bkg).
+    # Each event is still used exactly once per epoch.  The order only depends on seed and the epoch set with
+    # set_epoch(), so runs are reproducible.
+
+    def __init__(self, dataset, block_size=1024, window_size=16384, seed=0):
+        assert(block_size > 0 and window_size > 0)
+        self.block_size = block_size
+        self.window_size = window_size
+        self.seed = seed
+        self.epoch = 0
+        # Block boundaries:  every change of file, and every block_size events within a file
+        file_ids = np.asarray(dataset.file_ids)
+        n = len(file_ids)
+        file_starts = np.concatenate(([0], np.flatnonzero(np.diff(file_ids)) + 1)) if n else np.zeros(0, dtype='int64')
+        file_stops = np.append(file_starts[1:], n)
+        starts = [np.arange(start, stop, block_size) for start, stop in zip(file_starts, file_stops)]
+        self._block_starts = np.concatenate(starts) if starts else np.zeros(0, dtype='int64')
+        self._block_stops = np.minimum(self._block_starts + block_size,
+                                       np.repeat(file_stops, [len(st) for st in starts]))
+        self._num_events = n
+
+    def set_epoch(self, epoch):
+        # Call at the start of each epoch to get a different order
+        self.epoch = epoch
+
+    def __len__(self):
+        return self._num_events
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        order = rng.permutation(len(self._block_starts))
+        indices = np.concatenate([np.arange(self._block_starts[b], self._block_stops[b]) for b in order]) \
+            if len(order) else np.zeros(0, dtype='int64')
+        for start in range(0, len(indices), self.window_size):
+            window = indices[start:start + self.window_size]
+            rng.shuffle(window)
+            for i in window:
+                yield int(i)
+
+
+class HitCountBucketBatchSampler(Sampler):
+    # Batch sampler that groups events with similar numbers of hits, for use with collate_wrapper(min_nodes=...).
+    # Every event is padded to MAX_NUM_ECAL_HITS points, but most preselected events have far fewer hits, and the
+    # knn distance matrices and EdgeConv convolutions cost as much for a padded point as for a real one.  Batches
+    # of events with similar hit counts can be trimmed to their own max length in the collate function.
+    # Every epoch:
+    # - Events are sorted into buckets of bucket_width hit counts and shuffled within each bucket.
+    # - The buckets are concatenated in hit-count order and split into batches of batch_size (so only batches on a
+    #   bucket boundary mix two buckets).
+    # - The batches are shuffled.
+    # Each event is still used exactly once per epoch; the order only depends on seed and set_epoch().
+    # NOTE:  Batches are no longer random samples of the dataset:  the sig/bkg fraction and the BatchNorm statistics
+    # of each batch depend on its hit counts.  A wider bucket_width mixes more.
+
+    def __init__(self, hit_counts, batch_size, bucket_width=8, drop_last=False, seed=0):
+        assert(batch_size > 0 and bucket_width > 0)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self._buckets = np.asarray(hit_counts) // bucket_width
+
+    def set_epoch(self, epoch):
+        # Call at the start of each epoch to get a different order
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self._buckets) // self.batch_size
+        return (len(self._buckets) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        # Random order within each bucket:  sort by bucket, breaking ties with a random permutation
+        shuffled = rng.permutation(len(self._buckets))
+        indices = shuffled[np.argsort(self._buckets[shuffled], kind='stable')]
+        batches = [indices[start:start + self.batch_size] for start in range(0, len(indices), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        for b in rng.permutation(len(batches)):
+            yield batches[b].tolist()
+
+
+class DistributedShardSampler(Sampler):
+    # Shard of another sampler for data-parallel training (train.py --distributed):  every epoch, the order of sampler
+    # (events, or batches for a batch sampler such as HitCountBucketBatchSampler) is split into num_replicas
+    # contiguous shards of equal length, and shard rank is yielded.  Every process must build the same sampler (same
+    # seed), so they all draw the same order and the shards don't overlap.  Contiguous shards keep the reads of
+    # FileBlockShuffleSampler sequential within each process.  The last len(sampler) % num_replicas items of each
+    # epoch are dropped, so all processes run the same number of steps.
+
+    def __init__(self, sampler, rank, num_replicas):
+        assert(0 <= rank < num_replicas)
+        self.sampler = sampler
+        self.rank = rank
+        self.num_replicas = num_replicas
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return len(self.sampler) // self.num_replicas
+
+    def __iter__(self):
+        order = list(self.sampler)
+        shard_size = len(order) // self.num_replicas
+        return iter(order[self.rank * shard_size:(self.rank + 1) * shard_size])
+
+
+class ResumableSampler(Sampler):
+    # Wraps the training sampler (or batch sampler) so a run can continue in the middle of an epoch (train.py
+    # --resume).  state_dict(num_done) records that num_done items of the current epoch were used;
+    # load_state_dict() makes the next pass skip them.  This relies on every pass over an epoch giving the same order:
+    # the samplers here derive it from (seed, epoch); for samplers that draw from a torch.Generator (RandomSampler),
+    # the generator state from the start of the pass is saved and restored.
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self._skip = 0
+        self._generator = None
+        s = sampler
+        while s is not None and self._generator is None:
+            if isinstance(getattr(s, 'generator', None), torch.Generator):
+                self._generator = s.generator
+            s = getattr(s, 'sampler', None)
+        self._pass_generator_state = None
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return len(self.sampler) - self._skip
+
+    def __iter__(self):
+        if self._generator is not None:
+            self._pass_generator_state = self._generator.get_state()
+        skip, self._skip = self._skip, 0
+        return itertools.islice(iter(self.sampler), skip, None)
+
+    def state_dict(self, num_done):
+        # num_done:  number of items of the current pass used so far (0 at the end of an epoch:  the next one starts
+        # from the beginning, with the generator where this pass left it)
+        if self._generator is None:
+            generator_state = None
+        else:
+            generator_state = self._pass_generator_state if num_done > 0 else self._generator.get_state()
+        return {'num_done': num_done, 'generator_state': generator_state}
+
+    def load_state_dict(self, state):
+        if state['generator_state'] is not None:
+            self._generator.set_state(state['generator_state'])
+        self._skip = state['num_done']
+
+
+class StreamingECalHitsDataset(IterableDataset):
+    # Streaming alternative to ECalHitsDataset.  Uses the same event index (samples, load_range, max events), but
+    # instead of decoding one event at a time with PyROOT, reads skimmed_events with uproot in chunks of up to
+    # chunk_size consecutive entries of a file, builds the padded coordinate/feature arrays for the whole chunk at
+    # once, and yields ready-made batches:  (coordinates, features, labels, indices), where indices are the positions
+    # of the events in the dataset (used to put predictions back in dataset order, see get_obs_data()).
+    # Use with DataLoader(dataset, batch_size=None, collate_fn=collate_batches).
+    # Chunks are split across DataLoader workers.  With shuffle=True, the chunk order is shuffled every epoch
+    # (set_epoch()), and events are shuffled within groups of shuffle_chunks chunks (from different files, so
+    # batches still mix sig/bkg) before being split into batches.
+
+    def __init__(self, siglist, bkglist, load_range=(0, 1), obs_branches=[], detector_version='v13', nRegions=1,
+                 batch_size=128, chunk_size=4096, shuffle=False, shuffle_chunks=8, drop_last=False, seed=0,
+                 index_cache=INDEX_CACHE_PATH):
+        super(StreamingECalHitsDataset, self).__init__()
+        # The map-style dataset provides the event index, geometry and obs branches; its files are never opened by PyROOT
+        self._events = ECalHitsDataset(siglist, bkglist, load_range=load_range, obs_branches=obs_branches,
+                                       detector_version=detector_version, nRegions=nRegions, max_open_files=1,
+                                       index_cache=index_cache)
+        self.nRegions = nRegions
+        self.detector_version = detector_version
+        self.obs_branches = obs_branches
+        self.label = self._events.label
+        self.extra_labels = self._events.extra_labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_chunks = shuffle_chunks
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+        # Chunks:  (start, stop) positions in the index, never crossing a file boundary
+        file_ids = self._events.file_ids
+        file_starts = np.concatenate(([0], np.flatnonzero(np.diff(file_ids)) + 1)) if len(file_ids) else []
+        file_stops = np.append(file_starts[1:], len(file_ids)) if len(file_ids) else []
+        self._chunks = [(start, min(start + chunk_size, stop)) for file_start, stop in zip(file_starts, file_stops)
+                        for start in range(file_start, stop, chunk_size)]
+        print("Streaming {} events in {} chunks".format(len(self.label), len(self._chunks)))
+
+    @property
+    def num_features(self):
+        return self._events.num_features
+
+    @property
+    def file_ids(self):
+        return self._events.file_ids
+
+    def get_obs_data(self):
+        return self._events.get_obs_data()
+
+    def read_branches(self, branches):
+        # {branch: float32 array with one value per event, in index order} for any scalar branches of the input
+        # files (e.g. discValue_ for eval.py's cascade), read in bulk
+        return self._events._read_branches(branches)
+
+    def set_epoch(self, epoch):
+        # Call at the start of each epoch to get a different order (shuffle=True)
+        self.epoch = epoch
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, self.epoch]).permutation(len(self._chunks))
+        else:
+            order = np.arange(len(self._chunks))
+        mine = order[worker_id::num_workers]
+        rng = np.random.default_rng([self.seed, self.epoch, worker_id])
+        group_size = self.shuffle_chunks if self.shuffle else 1
+
+        # Events left over from the previous group (fewer than batch_size)
+        pending = (np.zeros(0, dtype='int64'),
+                   np.zeros((0, self.nRegions, 3, MAX_NUM_ECAL_HITS), dtype='float32'),
+                   np.zeros((0, self.nRegions, self.num_features, MAX_NUM_ECAL_HITS), dtype='float32'))
+        for g in range(0, len(mine), group_size):
+            chunks = [pending] + [self._read_chunk(*self._chunks[c]) for c in mine[g:g + group_size]]
+            indices, coordinates, features = [np.concatenate(arrays) for arrays in zip(*chunks)]
+            if self.shuffle:
+                perm = rng.permutation(len(indices))
+                indices, coordinates, features = indices[perm], coordinates[perm], features[perm]
+            num_full = len(indices) // self.batch_size * self.batch_size
+            for b in range(0, num_full, self.batch_size):
+                yield self._batch(indices[b:b + self.batch_size], coordinates[b:b + self.batch_size], features[b:b + self.batch_size])
+            pending = (indices[num_full:], coordinates[num_full:], features[num_full:])
+        if len(pending[0]) > 0 and not self.drop_last:
+            yield self._batch(*pending)
+
+    def read_chunks(self):
+        # (indices, coordinates, features) of every chunk, in index order and without batching/shuffling; e.g. for
+        # eval.py's reader processes, which batch the events of several files together
+        for start, stop in self._chunks:
+            yield self._read_chunk(start, stop)
+
+    def _batch(self, indices, coordinates, features):
+        return coordinates, features, self.label[indices].astype('int64'), indices
+
+    def _read_chunk(self, start, stop):
+        # Returns (indices, coordinates, features) for the events at positions [start, stop) of the index
+        filename = self._events._files[self._events._file_id[start]]
+        entries = self._events._entry[start:stop]  # Consecutive entries of one file
+        with uproot.open(filename) as f:
+            tree = f['skimmed_events']
+            if self.detector_version == 'v12':
+                hit_branches = ['id_rec_', 'energy_rec_']
+            else:
+                hit_branches = ['xpos_rec_', 'ypos_rec_', 'zpos_rec_', 'energy_rec_']
+            has_traj = RADIUS_CATEGORY_BRANCH in tree
+            sp_leaves = ['pdgID_', 'x_', 'y_', 'z_', 'px_', 'py_', 'pz_']
+            if has_traj:
+                traj_branches = TRAJECTORY_BRANCHES + [RADIUS_CATEGORY_BRANCH]
+            else:
+                traj_branches = sp_leaves + [leaf + 'tsp_' for leaf in sp_leaves]
+            data = tree.arrays(hit_branches + traj_branches, entry_start=entries[0], entry_stop=entries[-1] + 1)
+
+        if has_traj:
+            traj = {b: awkward.to_numpy(data[b]) for b in traj_branches}
+        else:
+            # Older input files:  compute the trajectories from the scoring plane hits (as _load_sp_data() does)
+            traj = sp_trajectories({leaf: data[leaf] for leaf in sp_leaves}, {leaf: data[leaf + 'tsp_'] for leaf in sp_leaves})
+
+        if self.detector_version == 'v12':
+            energy = data['energy_rec_']
+            eid = data['id_rec_'][energy > 0]  # Gets rid of all (AND ONLY) hits with 0 energy
+            energy = energy[energy > 0]
+            counts = awkward.to_numpy(awkward.num(energy))
+            (x, y, z), layer_id = self._events._parse_cid(awkward.to_numpy(awkward.flatten(eid)).astype('int'))  # float64, as in _read_event()
+        else:
+            counts = awkward.to_numpy(awkward.num(data['energy_rec_']))
+            x, y, z = [awkward.to_numpy(awkward.flatten(data[b])).astype('float32') for b in hit_branches[:3]]
+            layer_id = self._events._getlayer(z)
+        energy = awkward.to_numpy(awkward.flatten(energy if self.detector_version == 'v12' else data['energy_rec_'])).astype('float32')
+
+        coordinates, features = self._fill_regions_chunk(counts, x, y, z, np.asarray(layer_id, dtype='int'), energy, traj)
+        return np.arange(start, stop), coordinates, features
+
+    def _fill_regions_chunk(self, counts, x, y, z, layer_id, energy, traj):
+        # Same as ECalHitsDataset._fill_regions(), for all hits of a chunk of events at once.
+        # counts:  number of hits in each event; x, y, z, layer_id, energy:  flat arrays with the hits of all events;
+        # traj:  per-event arrays of TRAJECTORY_BRANCHES + RADIUS_CATEGORY_BRANCH.
+        # Returns coordinates (nEvents, nRegions, 3, MAX_NUM_ECAL_HITS) and features (nEvents, nRegions, 5, MAX_NUM_ECAL_HITS).
+        nEvents = len(counts)
+        ev = np.repeat(np.arange(nEvents), counts)  # Event of each hit
+        hit = np.arange(len(ev)) - np.repeat(np.cumsum(counts) - counts, counts)  # Position of each hit in its event
+        t = {k: np.asarray(traj[k])[ev] for k in TRAJECTORY_BRANCHES + [RADIUS_CATEGORY_BRANCH]}
+
+        # xy coords of the projected electron/photon trajectories in the layer of each hit
+        fiducial = t['etraj_sp_z'] != -999
+        delta_z = z - t['etraj_sp_z']
+        etraj_x = np.where(fiducial, t['etraj_sp_x'] + t['enorm_sp_x']*delta_z, t['etraj_sp_x'])
+        etraj_y = np.where(fiducial, t['etraj_sp_y'] + t['enorm_sp_y']*delta_z, t['etraj_sp_y'])
+        ptraj_x = np.where(fiducial, t['ptraj_sp_x'] + t['pnorm_sp_x']*delta_z, t['ptraj_sp_x'])
+        ptraj_y = np.where(fiducial, t['ptraj_sp_y'] + t['pnorm_sp_y']*delta_z, t['ptraj_sp_y'])
+
+        # Determine what regions the hits fall into:
+        radius = 2.0 * _radius_68_array[t[RADIUS_CATEGORY_BRANCH], layer_id]
+        insideElectronRadius = np.sqrt((etraj_x - x)**2 + (etraj_y - y)**2) < radius
+        insidePhotonRadius   = np.sqrt((ptraj_x - x)**2 + (ptraj_y - y)**2) < radius
+        # If an SP electron hit is missing, place all hits in the event into the PHOTON region
+        no_electron = t['enorm_sp_z'] == -999
+        insideElectronRadius[no_electron] = False
+        insidePhotonRadius[no_electron]   = True
+
+        if self.nRegions == 1:
+            in_region = [np.ones_like(insideElectronRadius)]
+        elif self.nRegions == 2:
+            in_region = [insideElectronRadius, ~insideElectronRadius]
+        elif self.nRegions == 3:
+            in_region = [insideElectronRadius, insidePhotonRadius, ~insideElectronRadius & ~insidePhotonRadius]
+
+        log_energy = np.full(energy.shape, -1, dtype='float32')
+        log_energy[energy > 0] = np.log(energy[energy > 0])
+
+        features = np.zeros((nEvents, self.nRegions, 5, MAX_NUM_ECAL_HITS), dtype='float32')
+        reg, h = np.nonzero(np.stack(in_region))
+        features[ev[h], reg, 0, hit[h]] = (x - etraj_x)[h]
+        features[ev[h], reg, 1, hit[h]] = (y - etraj_y)[h]
+        features[ev[h], reg, 2, hit[h]] = z[h]
+        features[ev[h], reg, 3, hit[h]] = layer_id[h]
+        features[ev[h], reg, 4, hit[h]] = log_energy[h]
+        return np.ascontiguousarray(features[:, :, :3]), features
+
+
+def _stack_float32(arrays):
+    # Stack equally-shaped per-event arrays into one preallocated, contiguous float32 buffer (a single copy per event,
+    # instead of torch.tensor() walking the nested sequences element by element)
+    out = np.empty((len(arrays),) + np.shape(arrays[0]), dtype='float32')
+    return np.stack(arrays, out=out)
+
+
+def _real_lengths(features, chunk_size=16384):
+    # Number of points filled in each event of features (N, nRegions, num_features, P):  last position where any
+    # region has a nonzero feature + 1 (the same points ParticleNet.forward masks in), or 0 for an empty event.
+    # Processed in chunks of events so memory-mapped inputs aren't read in whole.
+    lengths = np.zeros(len(features), dtype='int64')
+    for start in range(0, len(features), chunk_size):
+        filled = np.any(np.asarray(features[start:start + chunk_size]) != 0, axis=(1, 2))  # (n, P)
+        lengths[start:start + chunk_size] = np.where(filled.any(axis=1), filled.shape[1] - np.argmax(filled[:, ::-1], axis=1), 0)
+    return lengths
+
+
+def _num_points(features, min_nodes):
+    # Number of points to keep for a batch trimmed to its longest event; at least min_nodes (knn needs k+1 points)
+    return int(min(features.shape[-1], max(min_nodes, _real_lengths(features).max(initial=0))))
+
+
+def _remap_knn(knn_idx, features, num_points):
+    # First layer knn indices (N, nRegions, P, k) for a batch trimmed to num_points points.  Neighbours at or beyond
+    # num_points can only be 0-padded points (regions with <= k real points); they're replaced by the first padded
+    # point of the same region within the batch, which is identical to them (same features and shifted coordinates).
+    knn_idx = knn_idx[:, :, :num_points]
+    if not (knn_idx >= num_points).any():
+        return knn_idx
+    padded = np.all(features == 0, axis=2)  # (N, nRegions, num_points)
+    first_padded = np.argmax(padded, axis=-1)[:, :, None, None]
+    return np.where(knn_idx >= num_points, first_padded, knn_idx)
+
+
 class _SimpleCustomBatch:
+    # With min_nodes set, the padded points beyond the longest event of the batch are dropped (keeping at least
+    # min_nodes points).  Only padding is removed, so ParticleNet's mask/coord_shift still exclude the same points.
+    # Events may come with first layer knn indices as a 4th item (datasets with knn_k set); they're in knn_idx
+    # (int64, None otherwise).
 
     def __init__(self, data, min_nodes=None):
-        pts, fts, labels = list(zip(*data))
-        self.coordinates = torch.tensor(pts)
-        self.features = torch.tensor(fts)
-        self.label = torch.tensor(labels)
+        pts, fts, labels, *knn = list(zip(*data))
+        features = _stack_float32(fts)
+        num_points = features.shape[-1] if min_nodes is None else _num_points(features, min_nodes)
+        if num_points < features.shape[-1]:
+            features = np.ascontiguousarray(features[..., :num_points])
+        self.coordinates = torch.from_numpy(_stack_float32([p[..., :num_points] for p in pts]))
+        self.features = torch.from_numpy(features)
+        self.label = torch.from_numpy(np.asarray(labels, dtype='int64'))
+        self.knn_idx = None
+        if knn:
+            self.knn_idx = torch.from_numpy(_remap_knn(np.stack(knn[0]), features, num_points).astype('int64'))
+
+    @classmethod
+    def from_arrays(cls, coordinates, features, labels, indices=None, min_nodes=None):
+        # Batch from already-stacked arrays (StreamingECalHitsDataset); no copies unless trimmed
+        batch = cls.__new__(cls)
+        if min_nodes is not None:
+            num_points = _num_points(features, min_nodes)
+            if num_points < features.shape[-1]:
+                coordinates = np.ascontiguousarray(coordinates[..., :num_points])
+                features = np.ascontiguousarray(features[..., :num_points])
+        batch.coordinates = torch.from_numpy(coordinates)
+        batch.features = torch.from_numpy(features)
+        batch.label = torch.from_numpy(labels)
+        batch.knn_idx = None
+        if indices is not None:
+            batch.index = indices  # Dataset positions of the events, to restore the dataset order of the outputs
+        return batch
 
     def pin_memory(self):
         self.coordinates = self.coordinates.pin_memory()
         self.features = self.features.pin_memory()
         self.label = self.label.pin_memory()
+        if self.knn_idx is not None:
+            self.knn_idx = self.knn_idx.pin_memory()
         return self
 
 
-def collate_wrapper(batch):
-    return _SimpleCustomBatch(batch)
+def collate_wrapper(batch, min_nodes=None):
+    # min_nodes:  trim the padding of each batch (see _SimpleCustomBatch); use functools.partial to set it
+    return _SimpleCustomBatch(batch, min_nodes=min_nodes)
+
+
+def collate_batches(batch, min_nodes=None):
+    # For DataLoader(StreamingECalHitsDataset, batch_size=None):  batch is already (coordinates, features, labels, indices)
+    return _SimpleCustomBatch.from_arrays(*batch, min_nodes=min_nodes)
@@ -16,13 +16,20 @@ torch.set_default_dtype(torch.float32)
 import tqdm
 import glob
 import os
+import time
+import queue
+import threading
+import traceback
+import multiprocessing as mp
 import datetime
 import argparse
 
 from utils.ParticleNet import ParticleNet
 from utils.SplitNet import SplitNet
-from dataset import ECalHitsDataset
+from dataset import ECalHitsDataset, StreamingECalHitsDataset
 from dataset import collate_wrapper as collate_fn
+from dataset import collate_batches
+from export_model import build_model, load_exported
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--test-sig', type=str, default='')
@@ -32,10 +39,46 @@ parser.add_argument('--save-extra', action='store_true', default=False)
 parser.add_argument('--network', type=str, default='particle-net-lite', choices=['particle-net', 'particle-net-lite', 'particle-net-k5', 'particle-net-k7'])
 parser.add_argument('--load-model-path', type=str, default='')
 parser.add_argument('--test-output-path', type=str, default='')
-parser.add_argument('--num-workers', type=int, default=2)
+parser.add_argument('--num-workers', type=int, default=2,
+                    help='number of reader processes (DataLoader workers with --sequential)')
+parser.add_argument('--max-open-files', type=int, default=64)
 parser.add_argument('--batch-size', type=int, default=1024)
 parser.add_argument('--device', type=str, default='cuda:0')
 parser.add_argument('--num-regions', type=int, default=1)
+parser.add_argument('--batched-regions', action='store_true', default=False,
+                    help='run the SplitNet regions in one batched pass instead of one after another (same parameters and outputs)')
+parser.add_argument('--streaming', action='store_true', default=False,
+                    help='read the inputs in chunks with uproot and build whole batches at once (dataset.StreamingECalHitsDataset)')
+parser.add_argument('--stream-chunk-size', type=int, default=4096,
+                    help='number of consecutive events read at once with --streaming')
+parser.add_argument('--max-inflight-files', type=int, default=8,
+                    help='max number of files being read or scored at once (bounds the memory used by the pipeline)')
+parser.add_argument('--sequential', action='store_true', default=False,
+                    help='evaluate one file at a time with a DataLoader (ECalHitsDataset, or StreamingECalHitsDataset with '
+                         '--streaming) instead of the multi-file pipeline')
+parser.add_argument('--engine', type=str, default='eager', choices=['eager', 'exported'],
+                    help='eager:  build the SplitNet in Python; exported:  run an export_model.py file on CPU')
+parser.add_argument('--exported-model-path', type=str, default='',
+                    help='export_model.py output to run with --engine exported (the network and number of regions come from it)')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                    help='bf16:  run the eager model under bfloat16 autocast (knn stays float32); check the scores with '
+                         'validate_precision.py first')
+parser.add_argument('--threads', type=int, default=0,
+                    help='torch CPU threads (default:  the export_model.py --threads setting with --engine exported, else the torch default)')
+parser.add_argument('--check-batches', type=int, default=1,
+                    help='with --engine exported, compare the scores of the first N batches of each file with the eager model '
+                         '(--load-model-path, or the model the file was exported from); 0 to skip')
+parser.add_argument('--score-tolerance', type=float, default=1e-4,
+                    help='max |score difference| between --engine exported and eager that counts as a match')
+parser.add_argument('--cascade-band', type=float, nargs=2, default=None, metavar=('LOW', 'HIGH'),
+                    help='cascade:  only run the network on events with LOW <= discValue_ (the EcalVeto BDT score) <= HIGH; '
+                         'events below get the pass-through score 0, events above 1 (see cascade_tiers()).  '
+                         'E.g. --cascade-band 0.01 1.1 skips only the events the BDT finds clearly background-like')
+parser.add_argument('--cascade-check', action='store_true', default=False,
+                    help='with --cascade-band, also run the network on the skipped events, and compare the signal efficiencies '
+                         'of the cascade scores with those of the network alone at the --cascade-mistags background efficiencies')
+parser.add_argument('--cascade-mistags', type=str, default='1e-3,1e-4,1e-5',
+                    help='background efficiencies for --cascade-check')
 args = parser.parse_args()
 
 obs_branches = []
@@ -87,9 +130,33 @@ elif args.network == 'particle-net-k7':
         ]
     fc_params = [(256, 0.1)]
 
+assert(not (args.cascade_band and args.sequential)), '--cascade-band needs the pipeline (no --sequential)'
+assert(not args.cascade_check or args.cascade_band), '--cascade-check needs --cascade-band'
+
+# A traced and frozen model runs its float32 graph faster than autocast can make it
+assert(not (args.engine == 'exported' and args.precision == 'bf16')), '--precision bf16 is for --engine eager'
+
+if args.engine == 'exported':
+    print('Loading exported model %s' % args.exported_model_path)
+    exported_model, export_config = load_exported(args.exported_model_path)
+    print('Exported config: %s' % export_config)
+    # The exported file fixes the network and the number of regions
+    args.network, args.num_regions = export_config['network'], export_config['num_regions']
+    conv_params = [(k, tuple(channels)) for k, channels in export_config['conv_params']]
+    fc_params = [tuple(p) for p in export_config['fc_params']]
+    if args.device != 'cpu':
+        print('Exported models run on CPU; ignoring --device %s' % args.device)
+    args.device = 'cpu'
+    if not args.threads:
+        args.threads = export_config['threads']
+
 print('conv_params: %s' % conv_params)
 print('fc_params: %s' % fc_params)
 
+if args.threads:
+    torch.set_num_threads(args.threads)
+print('Using %d CPU threads' % torch.get_num_threads())
+
 # device
 dev = torch.device(args.device)
 
@@ -102,21 +169,35 @@ input_dims = 5
 #                    conv_params=conv_params,
 #                    fc_params=fc_params,
 #                    use_fusion=True)
-print("Initializing model")
-model = SplitNet(input_dims=input_dims, num_classes=2,
-                 conv_params=conv_params,
-                 fc_params=fc_params,
-                 use_fusion=True,
-                 nRegions=args.num_regions)
-model = model.to(dev)
-
-
-def evaluate(model, test_loader, dev, return_scores=False):
+if args.engine == 'exported':
+    model = exported_model
+else:
+    print("Initializing model")
+    model = SplitNet(input_dims=input_dims, num_classes=2,
+                     conv_params=conv_params,
+                     fc_params=fc_params,
+                     use_fusion=True,
+                     nRegions=args.num_regions,
+                     batched_regions=args.batched_regions)
+    model = model.to(dev)
+
+
+def autocast():
+    # Context for the forward passes:  bfloat16 autocast with --precision bf16, nothing otherwise
+    return torch.autocast(dev.type, dtype=torch.bfloat16, enabled=args.precision == 'bf16')
+
+
+def evaluate(model, test_loader, dev, return_scores=False, reference_model=None, check_batches=0):
+    # reference_model:  if given, the scores of the first check_batches batches are compared with it (e.g. the eager
+    # model for an exported one), and the max |difference| is printed
     model.eval()
 
     total_correct = 0
     count = 0
     scores = []
+    indices = []
+    model_time = 0
+    max_diff = None
 
     with torch.no_grad():
         with tqdm.tqdm(test_loader) as tq:
@@ -124,11 +205,24 @@ def evaluate(model, test_loader, dev, return_scores=False):
                 label = batch.label
                 num_examples = label.shape[0]
                 label = label.to(dev).squeeze().long()
-                logits = model(batch.coordinates.to(dev), batch.features.to(dev))
+                coordinates, features = batch.coordinates.to(dev), batch.features.to(dev)
+                start = time.perf_counter()
+                with autocast():
+                    logits = model(coordinates, features).float()
+                if dev.type == 'cuda':
+                    torch.cuda.synchronize(dev)
+                model_time += time.perf_counter() - start
                 _, preds = logits.max(1)
 
+                if reference_model is not None and check_batches > 0:
+                    check_batches -= 1
+                    diff = (torch.softmax(logits, dim=1) - torch.softmax(reference_model(coordinates, features), dim=1)).abs().max().item()
+                    max_diff = diff if max_diff is None else max(max_diff, diff)
+
                 if return_scores:
                     scores.append(torch.softmax(logits, dim=1).cpu().detach().numpy())
+                    if hasattr(batch, 'index'):
+                        indices.append(batch.index)
 
                 correct = (preds == label).sum().item()
                 total_correct += correct
@@ -138,79 +232,351 @@ def evaluate(model, test_loader, dev, return_scores=False):
                     'Acc': '%.5f' % (correct / num_examples),
                     'AvgAcc': '%.5f' % (total_correct / count)})
 
+    threads = torch.get_num_threads()
+    print('Model time %.2f s for %d events:  %.0f events/s, %.0f events/s per core (%d threads)' % (
+        model_time, count, count / model_time, count / model_time / threads, threads))
+    if max_diff is not None:
+        print('Max |score difference| from eager:  %.2e (%s the tolerance %.1e)' % (
+            max_diff, 'within' if max_diff <= args.score_tolerance else 'EXCEEDS', args.score_tolerance))
+
     if return_scores:
-        return np.concatenate(scores)
+        scores = np.concatenate(scores)
+        if indices:
+            # Streaming batches arrive in no particular order; put the scores back in dataset order
+            ordered = np.empty_like(scores)
+            ordered[np.concatenate(indices)] = scores
+            scores = ordered
+        return scores
     else:
         return total_correct / count
 
 
 # load saved model
 model_path = args.load_model_path
+if args.engine == 'exported' and not model_path:
+    model_path = export_config['model_path']
 if not model_path.endswith('.pt'):
     model_path += '_state.pt'
-print('Loading model %s for eval' % model_path)
-model.load_state_dict(torch.load(model_path))
+reference_model = None
+if args.engine == 'eager':
+    print('Loading model %s for eval' % model_path)
+    model.load_state_dict(torch.load(model_path))
+elif args.check_batches > 0:
+    # The eager model, to check the exported scores against
+    if os.path.exists(model_path):
+        print('Loading model %s to check the exported scores' % model_path)
+        reference_model = build_model(export_config, model_path)
+    else:
+        print('No eager model at %s; not checking the exported scores' % model_path)
 
 # evaluate model on test dataset
 path = args.test_output_path
 if not os.path.exists(path):
     os.makedirs(path)
 
+test_frac = (0, 1) if args.test_sig or args.test_bkg else (0, 0.2)
 
-def run_one_file(filepath, extra_label=0):
-    pred_file = os.path.join(path, os.path.basename(filepath).replace('.root', '.parquet')) #'.awkd'))
-    if os.path.exists(pred_file):
-        print('skip %s' % filepath)
-        return
-
-    siglist = {}
-    bkglist = {}
-    if extra_label == 0:
-        bkglist = {0:(filepath, -1)}
-    else:
-        siglist = {extra_label:(filepath, -1)}
 
-    test_frac = (0, 1) if args.test_sig or args.test_bkg else (0, 0.2)
-    test_data = ECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=test_frac, obs_branches=obs_branches, nRegions=args.num_regions)
-                                #, veto_branches=veto_branches, coord_ref=args.coord_ref)
-    test_loader = DataLoader(test_data, num_workers=args.num_workers, batch_size=args.batch_size,
-                            collate_fn=collate_fn, shuffle=False, drop_last=False, pin_memory=True)
+def output_file(filepath):
+    return os.path.join(path, os.path.basename(filepath).replace('.root', '.parquet')) #'.awkd'))
 
-    test_preds = evaluate(model, test_loader, dev, return_scores=True)
-    #print("First 10 pred values:", test_preds[:10])
-    test_labels = test_data.label
-    print("EXTRA LABELS:", test_data.extra_labels[:10])
 
-    test_extra_labels = test_data.extra_labels
+def file_lists(filepath, extra_label):
+    # (siglist, bkglist) selecting all events of one file
+    if extra_label == 0:
+        return {}, {0:(filepath, -1)}
+    return {extra_label:(filepath, -1)}, {}
 
-    for i in range(len(test_data)):
-        if i % 1000 == 0:  print("Getting event", i)
-        temp_var = test_data[i]
 
+def write_output(pred_file, out_data, extra_labels, scores):
+    # out_data:  {obs branch: array} (get_obs_data()); everything in dataset order.  Written to a temporary file and
+    # renamed, so an interrupted job never leaves a partial output behind (which later jobs would skip).
     import awkward
-    out_data = test_data.get_obs_data()
-    out_data['ParticleNet_extra_label'] = test_extra_labels
+    out_data['ParticleNet_extra_label'] = extra_labels
     #print("PRINTING BRANCHES")
     #for branch in out_data:
     #    print(out_data[branch][:10])
-    out_data['ParticleNet_disc'] = test_preds[:, 1]
+    out_data['ParticleNet_disc'] = scores
     #print("Test preds", out_data['ParticleNet_disc'][:20])
     # OLD:
     #awkward.save(pred_file, out_data, mode='w')
     #print('Written pred to %s' % pred_file)
     out_data = awkward.copy(awkward.Array(out_data))
 
-    awkward.to_parquet(out_data, pred_file)
+    tmp_file = pred_file + '.tmp'
+    awkward.to_parquet(out_data, tmp_file)
+    os.replace(tmp_file, pred_file)
+
+
+def run_one_file(filepath, extra_label=0):
+    pred_file = output_file(filepath)
+    if os.path.exists(pred_file):
+        print('skip %s' % filepath)
+        return
+
+    siglist, bkglist = file_lists(filepath, extra_label)
+    if args.streaming:
+        test_data = StreamingECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=test_frac, obs_branches=obs_branches,
+                                             nRegions=args.num_regions, batch_size=args.batch_size, chunk_size=args.stream_chunk_size)
+        test_loader = DataLoader(test_data, num_workers=args.num_workers, batch_size=None,
+                                 collate_fn=collate_batches, pin_memory=True)
+    else:
+        test_data = ECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=test_frac, obs_branches=obs_branches, nRegions=args.num_regions,
+                                    max_open_files=args.max_open_files)
+                                    #, veto_branches=veto_branches, coord_ref=args.coord_ref)
+        test_loader = DataLoader(test_data, num_workers=args.num_workers, batch_size=args.batch_size,
+                                collate_fn=collate_fn, shuffle=False, drop_last=False, pin_memory=True)
+
+    test_preds = evaluate(model, test_loader, dev, return_scores=True, reference_model=reference_model,
+                          check_batches=args.check_batches)
+    #print("First 10 pred values:", test_preds[:10])
+    print("EXTRA LABELS:", test_data.extra_labels[:10])
+
+    out_data = test_data.get_obs_data()  # Read in bulk, in the same order as test_preds
+    write_output(pred_file, out_data, test_data.extra_labels, test_preds[:, 1])
+
+
+# Pipeline (default):  reader processes featurize several files at once and send their events in chunks to the main
+# process, which scores them in full batches (mixing files) and hands each finished file to a writer thread.
+# At most --max-inflight-files files are being read or scored at a time, which bounds the memory used.
+
+# Cascade (--cascade-band):  the readers also read the stored discValue_ BDT score of every event, and only the events
+# in the band are sent on and scored by the network; the others get a pass-through score.
+
+def cascade_tiers(disc):
+    # -1 for events below the --cascade-band (pass-through score 0), 1 above it (score 1), 0 in it (network score)
+    low, high = args.cascade_band
+    return np.where(disc < low, -1, np.where(disc > high, 1, 0)).astype('int8')
+
+
+def report_cascade(results):
+    # results:  [(is_signal, tiers, cascade scores, network scores or None), ...] for every file
+    is_signal, tiers, scores = [np.concatenate(arrays) for arrays in list(zip(*results))[:3]]
+    skipped = tiers != 0
+    print('Cascade:  %d of %d events (%.2f%%) skipped the network:  %d below the band %s, %d above it' % (
+        skipped.sum(), len(tiers), 100. * skipped.mean(), (tiers < 0).sum(), args.cascade_band, (tiers > 0).sum()))
+    for name, events in [('signal', is_signal), ('background', ~is_signal)]:
+        if events.any():
+            print('    %s:  %.3f%% below, %.3f%% in, %.3f%% above the band' % (
+                name, 100. * (tiers[events] < 0).mean(), 100. * (tiers[events] == 0).mean(), 100. * (tiers[events] > 0).mean()))
+    if not args.cascade_check:
+        return
+    if is_signal.all() or not is_signal.any():
+        print('Need both signal and background events to compare the signal efficiencies')
+        return
+    # Signal efficiency at fixed background efficiency (ROC of all signal vs background events, without the
+    # preselection efficiencies), network alone vs cascade
+    from sklearn.metrics import roc_curve
+    from utils.plot_utils import get_signal_effs
+    mistags = [float(m) for m in args.cascade_mistags.split(',')]
+    network = np.concatenate([r[3] for r in results])
+    effs = {}
+    for name, s in [('network', network), ('cascade', scores)]:
+        fpr, tpr, _ = roc_curve(is_signal, s)
+        effs[name] = get_signal_effs(fpr, tpr, mistags)
+    for m, (fpr_net, eff_net), (fpr_cas, eff_cas) in zip(mistags, effs['network'], effs['cascade']):
+        print('    Signal eff. at bkg eff. %.0e:  network %.4f (at %.2e), cascade %.4f (at %.2e), change %+.4f' % (
+            m, eff_net, fpr_net, eff_cas, fpr_cas, eff_cas - eff_net))
+
+
+def read_files(task_queue, result_queue):
+    # Reader process:  for every (key, filepath, extra_label) task, sends ('start', key, num_events, tiers), then
+    # ('chunk', key, indices, coordinates, features) for every chunk of the file (see StreamingECalHitsDataset), then
+    # ('done', key, obs_data, extra_labels).  Stops at a None task.  tiers:  cascade_tiers() of the events with
+    # --cascade-band (None otherwise); the chunks then only have the events in the band, unless --cascade-check.
+    torch.set_num_threads(1)
+    for key, filepath, extra_label in iter(task_queue.get, None):
+        try:
+            siglist, bkglist = file_lists(filepath, extra_label)
+            test_data = StreamingECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=test_frac, obs_branches=obs_branches,
+                                                 nRegions=args.num_regions, chunk_size=args.stream_chunk_size)
+            tiers = None
+            if args.cascade_band:
+                tiers = cascade_tiers(test_data.read_branches(['discValue_'])['discValue_'])
+            result_queue.put(('start', key, len(test_data.label), tiers))
+            for indices, coordinates, features in test_data.read_chunks():
+                if tiers is not None and not args.cascade_check:
+                    keep = tiers[indices] == 0
+                    if not keep.any():
+                        continue
+                    indices, coordinates, features = indices[keep], coordinates[keep], features[keep]
+                result_queue.put(('chunk', key, indices, coordinates, features))
+            result_queue.put(('done', key, test_data.get_obs_data(), test_data.extra_labels))
+        except Exception:
+            result_queue.put(('error', key, traceback.format_exc()))
+
+
+def write_files(writer_queue, errors):
+    # Writer thread:  writes every (pred_file, out_data, extra_labels, scores) until None
+    for pred_file, out_data, extra_labels, scores in iter(writer_queue.get, None):
+        try:
+            write_output(pred_file, out_data, extra_labels, scores)
+            tqdm.tqdm.write('Written %s' % pred_file)
+        except Exception:
+            errors.append(traceback.format_exc())
+
+
+def run_pipeline(files):
+    # files:  [(filepath, extra_label), ...]
+    todo = []
+    for filepath, extra_label in files:
+        if os.path.exists(output_file(filepath)):
+            print('skip %s' % filepath)
+        else:
+            todo.append((len(todo), filepath, extra_label))
+    if not todo:
+        return
+    num_readers = max(1, args.num_workers)
+    print('Evaluating %d files with %d reader processes, up to %d files in flight' % (len(todo), num_readers, args.max_inflight_files))
+
+    ctx = mp.get_context('fork')
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue(maxsize=2 * num_readers)  # Chunks waiting to be scored
+    readers = [ctx.Process(target=read_files, args=(task_queue, result_queue), daemon=True) for _ in range(num_readers)]
+    for reader in readers:
+        reader.start()
+    writer_queue = queue.Queue()
+    writer_errors = []
+    writer = threading.Thread(target=write_files, args=(writer_queue, writer_errors), daemon=True)
+    writer.start()
+
+    states = {}  # key -> state of the files in flight
+    pending = []  # (keys, indices, coordinates, features) of the events received but not scored yet
+    num_pending = 0
+    num_dispatched = 0
+    check_batches = args.check_batches if reference_model is not None else 0
+    model_time, total_correct, count, max_diff = 0, 0, 0, None
+    cascade_results = []
+    start_time = time.perf_counter()
+    model.eval()
+
+    def score_pending(key=None):
+        # Scores the pending events in batches of --batch-size; the remainder stays pending.  With key (a file that
+        # has been read completely), all of that file's pending events are scored instead, the last batch partial, so
+        # the file can be written and its slot freed without waiting for other files.
+        nonlocal pending, num_pending
+        arrays = [np.concatenate(a) for a in zip(*pending)]  # keys, indices, coordinates, features
+        if key is None:
+            num = num_pending // args.batch_size * args.batch_size
+            todo, rest = [a[:num] for a in arrays], [a[num:] for a in arrays]
+        else:
+            mine = arrays[0] == key
+            todo, rest = [a[mine] for a in arrays], [a[~mine] for a in arrays]
+        for b in range(0, len(todo[0]), args.batch_size):
+            score(*[a[b:b + args.batch_size] for a in todo])
+        num_pending = len(rest[0])
+        pending = [tuple(rest)] if num_pending > 0 else []
+
+    def score(keys, indices, coordinates, features):
+        nonlocal check_batches, model_time, total_correct, count, max_diff
+        coordinates, features = torch.from_numpy(coordinates).to(dev), torch.from_numpy(features).to(dev)
+        with torch.no_grad():
+            start = time.perf_counter()
+            with autocast():
+                logits = model(coordinates, features).float()
+            if dev.type == 'cuda':
+                torch.cuda.synchronize(dev)
+            model_time += time.perf_counter() - start
+            scores = torch.softmax(logits, dim=1)
+            if check_batches > 0:
+                check_batches -= 1
+                diff = (scores - torch.softmax(reference_model(coordinates, features), dim=1)).abs().max().item()
+                max_diff = diff if max_diff is None else max(max_diff, diff)
+        scores = scores.cpu().numpy()
+        for key in np.unique(keys):
+            mine = keys == key
+            state = states[key]
+            if 'network_scores' in state:
+                # --cascade-check:  all events are scored; the cascade only keeps the scores of those in the band
+                file_indices, file_scores = indices[mine], scores[mine, 1]
+                state['network_scores'][file_indices] = file_scores
+                in_band = state['tiers'][file_indices] == 0
+                state['scores'][file_indices[in_band]] = file_scores[in_band]
+            else:
+                state['scores'][indices[mine]] = scores[mine, 1]
+            state['num_scored'] += int(mine.sum())
+            total_correct += int(((scores[mine, 1] > 0.5) == (state['extra_label'] > 0)).sum())
+        count += len(keys)
+        tq.update(len(keys))
+        tq.set_postfix({'AvgAcc': '%.5f' % (total_correct / count)})
+
+    with tqdm.tqdm(unit=' events') as tq:
+        while num_dispatched < len(todo) or states:
+            # Start reading more files, up to --max-inflight-files
+            while num_dispatched < len(todo) and len(states) < args.max_inflight_files:
+                key, filepath, extra_label = todo[num_dispatched]
+                states[key] = {'filepath': filepath, 'extra_label': extra_label, 'done': False, 'num_scored': 0}
+                task_queue.put(todo[num_dispatched])
+                num_dispatched += 1
+
+            message = result_queue.get()
+            kind, key, data = message[0], message[1], message[2:]
+            state = states[key]
+            if kind == 'error':
+                raise RuntimeError('Reading %s failed:\n%s' % (state['filepath'], data[0]))
+            elif kind == 'start':
+                state['scores'] = np.zeros(data[0], dtype='float32')
+                state['tiers'] = data[1]
+                if state['tiers'] is not None:
+                    state['scores'][state['tiers'] > 0] = 1.  # Pass-through scores; 0 below the band
+                    if args.cascade_check:
+                        state['network_scores'] = np.zeros(data[0], dtype='float32')
+                    else:
+                        state['num_scored'] = int((state['tiers'] != 0).sum())
+            elif kind == 'chunk':
+                indices, coordinates, features = data
+                pending.append((np.full(len(indices), key), indices, coordinates, features))
+                num_pending += len(indices)
+            else:
+                state['out_data'], state['extra_labels'] = data
+                state['done'] = True
+                if num_pending > 0:
+                    score_pending(key)  # All chunks of the file arrived before 'done'
+
+            if num_pending >= args.batch_size:
+                score_pending()
+
+            for key in [k for k, s in states.items() if s['done'] and s['num_scored'] == len(s['scores'])]:
+                state = states.pop(key)
+                if state['tiers'] is not None:
+                    state['out_data']['ParticleNet_cascade_tier'] = state['tiers']
+                    cascade_results.append((np.full(len(state['tiers']), state['extra_label'] > 0), state['tiers'],
+                                            state['scores'], state.get('network_scores')))
+                writer_queue.put((output_file(state['filepath']), state['out_data'], state['extra_labels'], state['scores']))
+
+    for reader in readers:
+        task_queue.put(None)
+    writer_queue.put(None)
+    for reader in readers:
+        reader.join()
+    writer.join()
+    if writer_errors:
+        raise RuntimeError('Writing the outputs failed:\n%s' % writer_errors[0])
+
+    threads = torch.get_num_threads()
+    elapsed = time.perf_counter() - start_time
+    total = sum(len(r[1]) for r in cascade_results) if cascade_results else count
+    print('Evaluated %d events from %d files in %.1f s (%.0f events/s)' % (total, len(todo), elapsed, total / elapsed))
+    if count > 0:
+        print('Model time %.2f s for %d events:  %.0f events/s, %.0f events/s per core (%d threads)' % (
+            model_time, count, count / model_time, count / model_time / threads, threads))
+    if cascade_results:
+        report_cascade(cascade_results)
+    if max_diff is not None:
+        print('Max |score difference| from eager:  %.2e (%s the tolerance %.1e)' % (
+            max_diff, 'within' if max_diff <= args.score_tolerance else 'EXCEEDS', args.score_tolerance))
 
 
 
 
 info_dict = {'model_name':args.network,
              'model_params': {'conv_params':conv_params, 'fc_params':fc_params},
+             'engine': args.engine if args.engine == 'eager' else '%s (%s)' % (args.engine, args.exported_model_path),
              'date': str(datetime.date.today()),
              'model_path': args.load_model_path,
              'siglist': args.test_sig,
              'bkglist': args.test_bkg,
+             'cascade_band': args.cascade_band,
              }
 
 info_file = os.path.join(path, 'eval_INFO.txt')
@@ -220,11 +586,7 @@ with open(info_file, 'w') as f:
 
 print("bkg", args.test_bkg)
 print("sig", args.test_sig)
-bkg_filelist = sorted(glob.glob(args.test_bkg))
-for idx, f in enumerate(bkg_filelist):
-    print('%d/%d' % (idx, len(bkg_filelist)))
-    print("Running file", f)
-    run_one_file(f, 0)
+files = [(f, 0) for f in sorted(glob.glob(args.test_bkg))]
 
 masses = {str(m):m for m in [0.001, 0.01, 0.1, 1.0]}
 for f in sorted(glob.glob(args.test_sig)):
@@ -232,8 +594,16 @@ for f in sorted(glob.glob(args.test_sig)):
     for m in masses.keys():
         if m in f:  mass = masses[m]
     if mass:
-        run_one_file(f, int(mass*1000))  #-1)
+        files.append((f, int(mass*1000)))  #-1)
     else:
         print("ERROR: unrecognized mass in filename {}".format(f))
 
+if args.sequential:
+    for idx, (f, extra_label) in enumerate(files):
+        print('%d/%d' % (idx, len(files)))
+        print("Running file", f)
+        run_one_file(f, extra_label)
+else:
+    run_pipeline(files)
+
 print("PROGRAM FINISHED")
@@ -0,0 +1,148 @@
+from __future__ import print_function
+
+import numpy as np
+import torch
+
+import os
+import json
+import time
+import datetime
+import argparse
+
+from utils.SplitNet import SplitNet
+from dataset import MAX_NUM_ECAL_HITS
+
+"""
+export_model.py
+
+Purpose:  Turn a trained SplitNet (train.py's <save-model-path>_state.pt plus the --network/--num-regions it was
+trained with) into a self-contained TorchScript file for CPU inference, which eval.py can run with --engine exported.
+
+Outline:
+- Build the SplitNet for --network/--num-regions and load the state dict (in eval mode).
+- Optionally (--quantize) replace the nn.Linear layers (the final fully connected layers) with dynamically quantized
+  int8 versions.  PyTorch's dynamic quantization doesn't cover the 1x1 convolutions of the EdgeConv blocks, which do
+  most of the work, so this mainly shrinks the fc layers; check the score differences before using it.
+- Trace the model on a synthetic padded batch and freeze it (torch.jit.freeze:  parameters become constants and the
+  BatchNorms are folded into the convolutions), then save it with the configuration in a config.json extra file.
+- Reload the saved file and compare its scores with the eager model on synthetic batches of a different batch size,
+  printing the max |score difference| and the events/s per core of both.
+
+Example:
+    python export_model.py --network particle-net-lite --num-regions 3 --load-model-path models/ecal_coord_state.pt --threads 4
+    python eval.py --engine exported --exported-model-path models/ecal_coord_exported.pt --test-sig ... --test-bkg ...
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--network', type=str, default='particle-net-lite', choices=['particle-net', 'particle-net-lite', 'particle-net-lite-k5', 'particle-net-k5', 'particle-net-k7'])
+parser.add_argument('--num-regions', type=int, default=1)
+parser.add_argument('--load-model-path', type=str, required=True,
+                    help='trained state dict (train.py output); _state.pt is appended if missing')
+parser.add_argument('--output', type=str, default='',
+                    help='output file (default:  the model path with _exported.pt, or _exported_int8.pt with --quantize)')
+parser.add_argument('--quantize', action='store_true', default=False,
+                    help='dynamically quantize the nn.Linear layers to int8')
+parser.add_argument('--batched-regions', action='store_true', default=False,
+                    help='trace the SplitNet(batched_regions=True) forward pass instead of the per-region one')
+parser.add_argument('--threads', type=int, default=1,
+                    help='torch CPU threads for the checks here, stored in the file as the eval.py default')
+parser.add_argument('--batch-size', type=int, default=256,
+                    help='batch size of the synthetic batches used for the trace and the checks')
+parser.add_argument('--score-tolerance', type=float, default=1e-4,
+                    help='max |score difference| from the eager model that counts as a match')
+parser.add_argument('--seed', type=int, default=0)
+
+networks = {
+    'particle-net':         ([(16, (64, 64, 64)), (16, (128, 128, 128)), (16, (256, 256, 256))], [(256, 0.1)]),
+    'particle-net-lite':    ([(7, (32, 32, 32)), (7, (64, 64, 64))], [(128, 0.1)]),
+    'particle-net-lite-k5': ([(5, (32, 32, 32)), (5, (64, 64, 64))], [(128, 0.1)]),
+    'particle-net-k5':      ([(5, (64, 64, 64)), (5, (128, 128, 128)), (5, (256, 256, 256))], [(256, 0.1)]),
+    'particle-net-k7':      ([(7, (64, 64, 64)), (7, (128, 128, 128)), (7, (256, 256, 256))], [(256, 0.1)]),
+    }
+
+
+def build_model(config, model_path):
+    # Eager SplitNet for an export config (see export()), with the trained weights, in eval mode
+    model = SplitNet(input_dims=5, num_classes=2, conv_params=config['conv_params'], fc_params=config['fc_params'],
+                     use_fusion=True, nRegions=config['num_regions'], batched_regions=config['batched_regions'])
+    model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    return model.eval()
+
+
+def export(model, example_inputs, path, config, quantize=False):
+    # Trace + freeze model (an eager SplitNet in eval mode) on example_inputs = (coordinates, features) and save it to
+    # path, with config (a json-able dict) stored alongside.  Traced with pad_to=None and knn_idx=None, i.e. for fully
+    # padded batches, which is what eval.py uses; the batch size isn't fixed.
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, example_inputs, check_trace=False))
+    config = dict(config, quantize=quantize, torch_version=torch.__version__, date=str(datetime.date.today()))
+    torch.jit.save(traced, path, _extra_files={'config.json': json.dumps(config)})
+
+
+def load_exported(path):
+    # Returns (model, config) for an export() output
+    extra_files = {'config.json': ''}
+    model = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    return model, json.loads(extra_files['config.json'])
+
+
+def make_batch(batch_size, nRegions, rng):
+    # Synthetic padded batch (coordinates, features):  hit j of each event at position j of one region
+    features = np.zeros((batch_size, nRegions, 5, MAX_NUM_ECAL_HITS), dtype='float32')
+    for i in range(batch_size):
+        nh = rng.integers(1, 50)
+        hits = np.arange(nh)
+        region = rng.integers(0, nRegions, nh)
+        features[i, region, :, hits] = rng.normal(size=(nh, 5)) * np.array([40, 40, 100, 10, 1], dtype='float32')
+    features = torch.from_numpy(features)
+    return features[:, :, :3].contiguous(), features
+
+
+def events_per_second(model, batches):
+    with torch.no_grad():
+        for coordinates, features in batches[:2]:
+            model(coordinates, features)  # Warm up (TorchScript optimizes the graph over the first calls)
+        start = time.perf_counter()
+        for coordinates, features in batches:
+            model(coordinates, features)
+    return sum(len(b[0]) for b in batches) / (time.perf_counter() - start)
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+
+    model_path = args.load_model_path
+    if not model_path.endswith('.pt'):
+        model_path += '_state.pt'
+    output = args.output
+    if not output:
+        output = model_path.replace('_state.pt', '').replace('.pt', '') + ('_exported_int8.pt' if args.quantize else '_exported.pt')
+
+    conv_params, fc_params = networks[args.network]
+    config = {'network': args.network, 'conv_params': conv_params, 'fc_params': fc_params,
+              'num_regions': args.num_regions, 'batched_regions': args.batched_regions, 'threads': args.threads,
+              'model_path': model_path}
+    print('Loading model %s' % model_path)
+    model = build_model(config, model_path)
+
+    export(model, make_batch(args.batch_size, args.num_regions, rng), output, config, quantize=args.quantize)
+    print('Exported to %s' % output)
+
+    # Check the saved file on batches of another size than the one traced
+    exported, _ = load_exported(output)
+    batches = [make_batch(args.batch_size // 2 + 1, args.num_regions, rng) for _ in range(8)]
+    with torch.no_grad():
+        max_diff = max((torch.softmax(model(*b), 1) - torch.softmax(exported(*b), 1)).abs().max().item() for b in batches)
+    print("Max |score difference| exported vs eager:  {:.2e} ({} the tolerance {:.1e})".format(
+        max_diff, 'within' if max_diff <= args.score_tolerance else 'EXCEEDS', args.score_tolerance))
+    rates = {name: events_per_second(m, batches) for name, m in [('eager', model), ('exported', exported)]}
+    print("{} threads:  eager {:.0f} events/s/core, exported {:.0f} events/s/core, speedup {:.2f}x".format(
+        args.threads, rates['eager'] / args.threads, rates['exported'] / args.threads, rates['exported'] / rates['eager']))
+
+
+if __name__ == '__main__':
+    run(parser.parse_args())
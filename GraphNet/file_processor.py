@@ -12,11 +12,15 @@ import awkward
 import glob
 import os
 import re
+import json
+import time
 print("Importing ROOT")
 import ROOT as r
 print("Imported root.  Starting...")
 from multiprocessing import Pool
 
+from utils.event_kernels import recoil_pt, num_hits, num_positive, sp_trajectories, TRAJECTORY_BRANCHES, RADIUS_CATEGORY_BRANCH
+
 """
 file_processor.py
 
@@ -27,12 +31,19 @@ files that ParticleNet itself doesn't need, and would substantially increase run
 calculation for every event individually.
 
 Outline:
-- For every input file, do the following:
-   - Read all necessary data from the file into arrays using uproot.
-   - Drop all events that fail the preselection condition.
+- Schedule every (mass, file) pair in file_templates on a single pool of NUM_PROCESSES workers, largest file first.
+  Finished files are recorded in a manifest (output_dir/manifest.json), and files already marked as done there are
+  skipped, so an interrupted run can simply be restarted.
+- For every input file, do the following (in chunks of STREAM_STEP_SIZE entries):
+   - Read the two EcalVeto quantities used by the preselection using uproot.
+   - Drop all events that fail the preselection condition, and only read the remaining branches for the
+     surviving events.
    - Compute the pT of each event from the TargetScoringPlaneHit information (needed for pT bias plots, and not
      present in ROOT files), and keep track of it alongside the other arrays/branches loaded for the file.
-   - Use ROOT to create new output files and to fill them with the contents of the loaded arrays.
+   - Compute the projected electron/photon trajectories and containment radius category that ParticleNet uses to
+     split hits into regions, so that it doesn't have to redo this from the scoring plane hits every epoch.
+   - Write the contents of the loaded arrays to new output files, either in bulk with uproot (OUTPUT_WRITER =
+     'columnar') or event by event with ROOT (OUTPUT_WRITER = 'ttree').  Both produce the same skimmed_events tree.
 
 """
 
@@ -40,6 +51,11 @@ Outline:
 
 # Directory to write output files to:
 output_dir = 'processor_output'
+# Manifest with the status, event counts and timings of every output file (see __main__)
+MANIFEST_NAME = 'manifest.json'
+# Number of files processed in parallel.  Can increase this number if desired, although this depends on how many
+# threads POD will let you run at once...this number is unclear, but 20 seems right judging from the POD webpage
+NUM_PROCESSES = 20
 # Used v12/signal_230_trunk, background_230_trunk for 2.3.0
 # 3.0.0:
 """
@@ -71,6 +87,16 @@ MAX_NUM_ECAL_HITS = 50 #60  #110  #Now MUCH lower!  >99% of 1 MeV sig should pas
 MAX_ISO_ENERGY = 500  # NOTE:  650 passes 99.99% sig, ~13% bkg for 3.0.0!  Lowering...
 # Results:  >0.994 vs 0.055
 
+# How to write the output files:  'columnar' writes all preselected events in one bulk operation with uproot,
+# 'ttree' fills the output TTree one event at a time with PyROOT (much slower; kept for cross-checks)
+OUTPUT_WRITER = 'columnar'
+# Compression used by the columnar writer:  (algorithm, level), algorithm is one of 'zlib', 'lzma', 'lz4', 'zstd'
+# (lz4 needs the lz4 and xxhash packages, zstd needs zstandard)
+OUTPUT_COMPRESSION = ('zlib', 1)
+# Number of input entries read at a time.  Each chunk is preselected and written before the next one is read, so
+# memory use per process is bounded by the chunk size rather than the file size.  (None reads whole files at once.)
+STREAM_STEP_SIZE = 20000
+
 # Branches to save:
 # Quantities labeled with 'scalars' have a single value per event.  Quantities labeled with 'vectors' have
 # one value for every hit (e.g. number of ecal hits vs x position of each hit).
@@ -108,6 +134,13 @@ def blname(branch, leaf):
         return '{}/{}.{}'.format(branch, branch, leaf)
 
 
+def outputName(mass, filenum):
+    if mass == 0:
+        return "v13_pn_trigger_{}.root".format(filenum)
+    else:
+        return "v13_{}_trigger_{}.root".format(mass, filenum)
+
+
 def processFile(input_vars):
     # input_vars is a list:
     # [file_to_read, signal_mass, nth_file_in_mass_group]
@@ -116,16 +149,10 @@ def processFile(input_vars):
     filenum = input_vars[2]
 
     print("Processing file {}".format(filename))
-    if mass == 0:
-        outfile_name = "v13_pn_trigger_{}.root".format(filenum)
-    else:
-        outfile_name = "v13_{}_trigger_{}.root".format(mass, filenum)
-    outfile_path = os.sep.join([output_dir, outfile_name])
-
-    # NOTE:  Added this to ...
-    if os.path.exists(outfile_path):
-        print("FILE {} ALREADY EXISTS.  SKIPPING...".format(outfile_name))
-        return 0, 0
+    outfile_path = os.sep.join([output_dir, outputName(mass, filenum)])
+    # Write to a temporary file and only move it into place once it's complete, so an interrupted job never leaves a
+    # truncated output file behind.  (Whether a file needs to be processed is decided by the manifest, see __main__.)
+    tmpfile_path = outfile_path + '.tmp'
 
     # Fix branch names:  uproot refers to EcalVeto branches with a / ('EcalVeto_v12/nReadoutHits_', etc), while
     # all other branches are referred to with a . ('EcalRecHits_v12.energy_', etc).  This is because ldmx-sw
@@ -142,209 +169,353 @@ def processFile(input_vars):
 
     print("Branches to load:")
     print(branchList)
+    # The preselection only needs these two branches, so they're read first, for every event...
+    cutBranches = [blname('EcalVeto_v3_v13', 'nReadoutHits_'), blname('EcalVeto_v3_v13', 'summedTightIso_')]
+    # ...and everything else (mostly large jagged collections) is only read where events pass.
+    otherBranches = [branch for branch in branchList if branch not in cutBranches]
+
+    if OUTPUT_WRITER == 'columnar':
+        writer = ColumnarWriter(tmpfile_path, branchList)
+    else:
+        writer = TTreeWriter(tmpfile_path, branchList)
+
+    nEvents = 0
+    nWritten = 0
+    write_time = 0
+    # Open the file and stream through it in chunks of STREAM_STEP_SIZE entries, so memory use doesn't depend on
+    # the size of the input file:
+    with uproot.open(filename) as f:
+        t = f['LDMX_Events']
+        print("OPENED FiLE")
+        nTotalEvents = t.num_entries
+        print("Before preselection:  found {} events".format(nTotalEvents))
+        step_size = STREAM_STEP_SIZE if STREAM_STEP_SIZE else max(nTotalEvents, 1)
+
+        for entry_start in range(0, nTotalEvents, step_size):
+            entry_stop = min(entry_start + step_size, nTotalEvents)
+            # t.arrays() returns a dict-like object:
+            #    cut_data['EcalVeto_v12/nReadoutHits_'] == awkward array containing the value of
+            #    nReadoutHits_ for each event, and so on.
+            cut_data = t.arrays(cutBranches, entry_start=entry_start, entry_stop=entry_stop)
+
+            # Perform the preselection:  Drop all events with more than MAX_NUM_ECAL_HITS in the ecal,
+            # and all events with an isolated energy that exceeds MAXX_ISO_ENERGY
+            el = awkward.to_numpy((cut_data[cutBranches[0]] < MAX_NUM_ECAL_HITS) & (cut_data[cutBranches[1]] < MAX_ISO_ENERGY))
+            passing = np.nonzero(el)[0]
+            if len(passing) == 0:
+                continue
+            # Only read the other branches for the entries spanned by passing events (baskets outside of this range
+            # are never decompressed)
+            first, last = passing[0], passing[-1] + 1
+            el = el[first:last]
+            raw_data = t.arrays(otherBranches, entry_start=entry_start + first, entry_stop=entry_start + last)
+
+            preselected_data = {}
+            for branch in cutBranches:
+                preselected_data[branch] = cut_data[branch][first:last][el]
+            for branch in otherBranches:
+                preselected_data[branch] = raw_data[branch][el]
+            nEvents += len(passing)
+
+            addDerivedBranches(preselected_data)
+
+            start = time.time()
+            nWritten += writer.write(preselected_data)
+            write_time += time.time() - start
 
-    # Open the file and read all necessary data from it:
-    t = uproot.open(filename)['LDMX_Events']
-    print("OPENED FiLE")
-    # (This part is just for printing the # of pre-preselection events:)
-    #tmp = t.arrays(['EcalRecHits_v12/id_'])
-    #nTotalEvents = len(tmp)
-    #print("Before preselection:  found {} events".format(nTotalEvents))
-
-    # t.arrays() returns a dict-like object:
-    #    raw_data['EcalVeto_v12/nReadoutHits_'] == awkward array containing the value of 
-    #    nReadoutHits_ for each event, and so on.
-    raw_data = t.arrays(branchList) #, preselection)  #, aliases=alias_dict)
-    print("Check raw_data:")
-    print(raw_data[blname('EcalScoringPlaneHits_v3_v13','pdgID_')])
-
-
-    nTotalEvents = len(raw_data[blname('EcalRecHits_v3_v13', 'xpos_')])
-    print("Before preselection:  found {} events".format(nTotalEvents))
-
-    # Perform the preselection:  Drop all events with more than MAX_NUM_ECAL_HITS in the ecal, 
-    # and all events with an isolated energy that exceeds MAXX_ISO_ENERGY
-    el = (raw_data[blname('EcalVeto_v3_v13', 'nReadoutHits_')] < MAX_NUM_ECAL_HITS) * (raw_data[blname('EcalVeto_v3_v13', 'summedTightIso_')] < MAX_ISO_ENERGY)
-    preselected_data = {}
-    for branch in branchList:
-        preselected_data[branch] = raw_data[branch][el]
-    nEvents = len(preselected_data[blname('EcalVeto_v3_v13', 'summedTightIso_')])
     print("After preselection:  found {} events".format(nEvents))
 
+    # Finally, write the output file:
+    start = time.time()
+    writer.close()
+    os.replace(tmpfile_path, outfile_path)
+    write_time = max(write_time + time.time() - start, 1e-9)
+    size_mb = os.path.getsize(outfile_path) / 1e6
+    print("FINISHED.  File written to {}:  {} events, {:.1f} MB in {:.1f} s ({:.0f} events/s, {:.2f} MB/s)".format(
+        outfile_path, nWritten, size_mb, write_time, nWritten / write_time, size_mb / write_time))
+
+    return (nTotalEvents, nEvents)
+
+
+def addDerivedBranches(preselected_data):
+    # Add the branches that aren't in the input files to preselected_data (a dict of preselected arrays)
     # Next, we have to compute TargetSPRecoilE_pt here instead of in train.py.  (This involves TargetScoringPlane
     # information that ParticleNet doesn't need, and that would take a long time to load with the lazy-loading
     # approach.)
-    # For each event, find the recoil electron (maximal recoil pz):
-    pdgID_ = t[blname('TargetScoringPlaneHits_v3_v13', 'pdgID_')].array()[el]
-    z_     = t[blname('TargetScoringPlaneHits_v3_v13', 'z_')].array()[el]
-    px_    = t[blname('TargetScoringPlaneHits_v3_v13', 'px_')].array()[el]
-    py_    = t[blname('TargetScoringPlaneHits_v3_v13', 'py_')].array()[el]
-    pz_    = t[blname('TargetScoringPlaneHits_v3_v13', 'pz_')].array()[el]
-    tspRecoil = []
-    for i in range(nEvents):
-        max_pz = 0
-        recoil_index = 0  # Store the index of the recoil electron
-        for j in range(len(pdgID_[i])):
-            # Constraint on z ensures that the SP downstream of the target is used
-            if pdgID_[i][j] == 11 and z_[i][j] > 0.176 and z_[i][j] < 0.178 and pz_[i][j] > max_pz:
-                max_pz = pz_[i][j]
-                recoil_index = j
-        # Calculate the recoil SP
-        tspRecoil.append(np.sqrt(px_[i][recoil_index]**2 + py_[i][recoil_index]**2))
-    # Put it in the preselected_data and treat it as an ordinary branch from here on out
-    preselected_data['TargetSPRecoilE_pt'] = np.array(tspRecoil)
+    # For each event, find the recoil electron (maximal recoil pz), with a constraint on z to ensure that the SP
+    # downstream of the target is used.  Put it in the preselected_data and treat it as an ordinary branch from here on out
+    tsp = {leaf: preselected_data[blname('TargetScoringPlaneHits_v3_v13', leaf)] for leaf in ['pdgID_', 'z_', 'px_', 'py_', 'pz_']}
+    preselected_data['TargetSPRecoilE_pt'] = recoil_pt(tsp['pdgID_'], tsp['z_'], tsp['px_'], tsp['py_'], tsp['pz_'])
 
     # Additionally, add new branches storing the length for vector data (number of SP hits, number of ecal hits):
-    nSPHits = np.zeros(nEvents) #[]
-    nTSPHits = np.zeros(nEvents)
-    nRecHits = np.zeros(nEvents) #[]
-    x_data = preselected_data[blname('EcalScoringPlaneHits_v3_v13','x_')]
-    xsp_data = preselected_data[blname('TargetScoringPlaneHits_v3_v13','x_')]
-    E_data = preselected_data[blname('EcalRecHits_v3_v13','energy_')]
-
-    for i in range(nEvents):
-        # NOTE:  max num hits may exceed MAX_NUM...this is okay.
-        nSPHits[i] = len(x_data[i])  #nSPHits.append(len(x_data[i]))
-        nTSPHits[i] = len(xsp_data[i])
-        nRecHits[i] = sum(E_data[i] > 0)  #nRecHits.append(sum(E_data[i] > 0))  #len(E_data[i])) # NOTE:  Must be number of hits with E>0, since there's some E=0 hits out there...
-        if len(E_data[i]) == 0:
-            # ****** print("0 len! nrh was {}, i={}".format(sum(E_data[i] > 0), i))
-            nRecHits[i] = 0
-    preselected_data['nSPHits']  = np.array(nSPHits)
-    preselected_data['nTSPHits'] = np.array(nTSPHits)
-    preselected_data['nRecHits'] = np.array(nRecHits)
-
-
-    # Prepare the output tree+file:
-    outfile = r.TFile(outfile_path, "RECREATE")
-    tree = r.TTree("skimmed_events", "skimmed ldmx event data")
-    # Everything in EcalSPHits is a vector; everything in EcalVetoProcessor is a scalar
-
-    # For each branch, create an array to temporarily hold the data for each event:
-    scalar_holders = {}  # Hold ecalVeto (scalar) information
-    vector_holders = {}
-    for branch in branchList:
-        leaf = re.split(r'[./]', branch)[-1]  #Split at / or .
-        # Find whether the branch stores scalar or vector data:
-        datatype = None
-        for br, brdict in data_to_save.items():
-            #print(leaf)
-            #print(brdict['scalars'], brdict['vectors'])
-            if leaf in brdict['scalars']:
-                datatype = 'scalar'
-                continue
-            elif leaf in brdict['vectors']:
-                datatype = 'vector'
-                continue
-        assert(datatype == 'scalar' or datatype == 'vector')
-        if datatype == 'scalar':  # If scalar, temp array has a length of 1
-            scalar_holders[branch] = np.zeros((1), dtype='float32')
-        else:  # If vector, temp array must have at least one element per hit
-            # (liberally picked 2k)
-            vector_holders[branch] = np.zeros((200000), dtype='float32')
-    print("TEMP:  Scalar, vector holders keys:")
-    print(scalar_holders.keys())
-    print(vector_holders.keys())
-
-    # Create new branches to store nSPHits, pT (necessary for tree creation)...
-    scalar_holders['nSPHits'] = np.array([0], 'i')
-    scalar_holders['nTSPHits'] = np.array([0], 'i')
-    scalar_holders['nRecHits'] = np.array([0], 'i')
-    scalar_holders['TargetSPRecoilE_pt'] = np.array([0], dtype='float32')
-    branchList.append('nSPHits')
-    branchList.append('nTSPHits')
-    branchList.append('nRecHits')
-    branchList.append('TargetSPRecoilE_pt')
-    # Now, go through each branch name and a corresponding branch to the tree:
-    for branch, var in scalar_holders.items():
-        # Need to make sure that each var is stored as the correct type (floats, ints, etc):
-        if branch == 'nSPHits' or branch == 'nTSPHits' or branch == 'nRecHits':
-            branchname = branch
-            dtype = 'I'
-        elif branch == 'TargetSPRecoilE_pt':
-            branchname = branch
-            dtype = 'F'
-        else:
-            branchname = re.split(r'[./]', branch)[1]
-            dtype = 'F'
-        tree.Branch(branchname, var, branchname+"/"+dtype)
-    for branch, var in vector_holders.items():
-        # NOTE:  Can't currently handle EcalVeto branches that store vectors.  Not necessary for PN, though.
-        parent = re.split(r'[./]', branch)[0]
-        branchname = re.split(r'[./]', branch)[-1]
-        print("Found parent={}, branchname={}".format(parent, branchname))
-        if parent == 'EcalScoringPlaneHits_v3_v13':
-            tree.Branch(branchname, var, "{}[nSPHits]/F".format(branchname))
-        elif parent == 'TargetScoringPlaneHits_v3_v13':
-            tree.Branch(branchname+'tsp_', var, "{}[nTSPHits]/F".format(branchname+'tsp_'))
-        else:  # else in EcalRecHits
-            tree.Branch(branchname+'rec_', var, "{}[nRecHits]/F".format(branchname+'rec_'))
-    print("TEMP:  Branches added to tree:")
-    for b in tree.GetListOfBranches():  print(b.GetFullName())
-    print("TEMP:  Leaves added ot tree:")
-    for b in tree.GetListOfLeaves():    print(b.GetFullName())
-
-    print("All branches added.  Filling...")
-
-    for i in range(nEvents):
-        # For each event, fill the temporary arrays with data, then write them to the tree with Fill()
-        # ALSO:  If event contains no ecal hits, ignore it.
-        if preselected_data['nRecHits'][i] == 0:  continue
-
+    # NOTE:  max num hits may exceed MAX_NUM...this is okay.
+    preselected_data['nSPHits']  = num_hits(preselected_data[blname('EcalScoringPlaneHits_v3_v13','x_')])
+    preselected_data['nTSPHits'] = num_hits(preselected_data[blname('TargetScoringPlaneHits_v3_v13','x_')])
+    # NOTE:  Must be number of hits with E>0, since there's some E=0 hits out there...
+    preselected_data['nRecHits'] = num_positive(preselected_data[blname('EcalRecHits_v3_v13','energy_')])
+
+    # Projected electron/photon trajectories at the ecal (etraj_sp_x, ..., pnorm_sp_z) and radius_category, for
+    # all events at once.  These are stored as doubles so ParticleNet reads exactly what it used to compute itself.
+    sp_leaves = ['pdgID_', 'x_', 'y_', 'z_', 'px_', 'py_', 'pz_']
+    trajectories = sp_trajectories({leaf: preselected_data[blname('EcalScoringPlaneHits_v3_v13', leaf)] for leaf in sp_leaves},
+                                   {leaf: preselected_data[blname('TargetScoringPlaneHits_v3_v13', leaf)] for leaf in sp_leaves})
+    preselected_data.update(trajectories)
+
+
+class ColumnarWriter:
+    # Bulk writer:  write every output branch for a whole chunk of events at once with uproot.  Produces the same
+    # skimmed_events layout as TTreeWriter:  nSPHits/nTSPHits/nRecHits counters, EcalScoringPlaneHits leaves under
+    # their own names, TargetScoringPlaneHits leaves with a tsp_ suffix, EcalRecHits leaves with a rec_ suffix, and
+    # float scalars.
+
+    def __init__(self, outfile_path, branchList):
+        compression = {'zlib': uproot.ZLIB, 'lzma': uproot.LZMA, 'lz4': uproot.LZ4, 'zstd': uproot.ZSTD}[OUTPUT_COMPRESSION[0]]
+        # Vector leaves are grouped by the counter they share; uproot names each counter 'n' + group name
+        self.groups = {'SPHits': {}, 'TSPHits': {}, 'RecHits': {}}  # group -> {output name: input branch}
+        self.scalars = {}  # output name -> (input branch, dtype)
         for branch in branchList:
-            # Contains both vector and scalar data.  Treat them differently:
-            if branch in scalar_holders.keys():  # Scalar
-                # fill scalar data
-                if i==0:  print("filling scalar", branch)
-                scalar_holders[branch][0] = preselected_data[branch][i]
-            elif branch in vector_holders.keys():  # Vector
-                # fill vector data
-                #print("vec data i is {}".format(type(preselected_data[branch][i])))
-                #if len(preselected_data[branch][i] == 0):
-                #    print("WARNING: found 0-len data, branch={}, i={}, nrh={}".format(branch, i, preselected_data['nRecHits'][i]))
-                #    if preselected_data['nRecHits'][i] == 0:  print("  IS 0")
-
-                #print(i, preselected_data[branch][i][0])  # make sure len is 1
-                if i==0:  print("filling vector", branch)
-                for j in range(len(preselected_data[branch][i])):
-                    vector_holders[branch][j] = preselected_data[branch][i][j]
+            parent = re.split(r'[./]', branch)[0]
+            leaf = re.split(r'[./]', branch)[-1]
+            if leaf in data_to_save[parent]['vectors']:
+                if parent == 'EcalScoringPlaneHits_v3_v13':
+                    self.groups['SPHits'][leaf] = branch
+                elif parent == 'TargetScoringPlaneHits_v3_v13':
+                    self.groups['TSPHits'][leaf+'tsp_'] = branch
+                else:  # else in EcalRecHits
+                    self.groups['RecHits'][leaf+'rec_'] = branch
             else:
-                print("FATAL ERROR:  {} not found in *_holders".format(branch))
-                assert(False)
-        tree.Fill()
-
-    # Finally, write the filled tree to the ouput file:
-    outfile.Write()
-    print("FINISHED.  File written to {}.".format(outfile_path))
-
-    return (nTotalEvents, nEvents)
+                self.scalars[leaf] = (branch, np.float32)
+        self.scalars['TargetSPRecoilE_pt'] = ('TargetSPRecoilE_pt', np.float32)
+        for branch in TRAJECTORY_BRANCHES:
+            self.scalars[branch] = (branch, np.float64)
+        self.scalars[RADIUS_CATEGORY_BRANCH] = (RADIUS_CATEGORY_BRANCH, np.int32)
+
+        branch_types = {group: awkward.types.ListType(awkward.types.RecordType(
+                            [awkward.types.NumpyType('float32')] * len(leaves), list(leaves)))
+                        for group, leaves in self.groups.items()}
+        branch_types.update({name: np.dtype(dtype) for name, (_, dtype) in self.scalars.items()})
+        self.outfile = uproot.recreate(outfile_path, compression=compression(OUTPUT_COMPRESSION[1]))
+        self.tree = self.outfile.mktree('skimmed_events', branch_types, title='skimmed ldmx event data',
+                                        counter_name=lambda counted: 'n' + counted,
+                                        field_name=lambda outer, inner: inner)
+
+    def write(self, preselected_data):
+        # Returns the number of events written.  As in TTreeWriter, events that contain no ecal hits are skipped.
+        keep = preselected_data['nRecHits'] > 0
+        nRecHits = preselected_data['nRecHits'][keep].astype('int32')
+        if len(nRecHits) == 0:
+            return 0
+        out_data = {}
+        for group, leaves in self.groups.items():
+            fields = {}
+            for name, branch in leaves.items():
+                data = awkward.values_astype(preselected_data[branch][keep], np.float32)
+                if group == 'RecHits':
+                    # The TTree holds the first nRecHits (# hits with E>0) entries of each rec hit vector
+                    data = data[awkward.local_index(data) < nRecHits]
+                fields[name] = data
+            out_data[group] = awkward.zip(fields)
+        for name, (branch, dtype) in self.scalars.items():
+            out_data[name] = awkward.to_numpy(preselected_data[branch][keep]).astype(dtype)
+        self.tree.extend(out_data)
+        return len(nRecHits)
+
+    def close(self):
+        self.outfile.close()
+
+
+class TTreeWriter:
+    # Original writer:  fill the output TTree with PyROOT one event at a time.
+
+    def __init__(self, outfile_path, branchList):
+        branchList = list(branchList)
+        # Prepare the output tree+file:
+        self.outfile = r.TFile(outfile_path, "RECREATE")
+        tree = r.TTree("skimmed_events", "skimmed ldmx event data")
+        # Everything in EcalSPHits is a vector; everything in EcalVetoProcessor is a scalar
+
+        # For each branch, create an array to temporarily hold the data for each event:
+        scalar_holders = {}  # Hold ecalVeto (scalar) information
+        vector_holders = {}
+        for branch in branchList:
+            leaf = re.split(r'[./]', branch)[-1]  #Split at / or .
+            # Find whether the branch stores scalar or vector data:
+            datatype = None
+            for br, brdict in data_to_save.items():
+                #print(leaf)
+                #print(brdict['scalars'], brdict['vectors'])
+                if leaf in brdict['scalars']:
+                    datatype = 'scalar'
+                    continue
+                elif leaf in brdict['vectors']:
+                    datatype = 'vector'
+                    continue
+            assert(datatype == 'scalar' or datatype == 'vector')
+            if datatype == 'scalar':  # If scalar, temp array has a length of 1
+                scalar_holders[branch] = np.zeros((1), dtype='float32')
+            else:  # If vector, temp array must have at least one element per hit
+                # (liberally picked 2k)
+                vector_holders[branch] = np.zeros((200000), dtype='float32')
+        print("TEMP:  Scalar, vector holders keys:")
+        print(scalar_holders.keys())
+        print(vector_holders.keys())
+
+        # Create new branches to store nSPHits, pT (necessary for tree creation)...
+        scalar_holders['nSPHits'] = np.array([0], 'i')
+        scalar_holders['nTSPHits'] = np.array([0], 'i')
+        scalar_holders['nRecHits'] = np.array([0], 'i')
+        scalar_holders['TargetSPRecoilE_pt'] = np.array([0], dtype='float32')
+        for branch in TRAJECTORY_BRANCHES:
+            scalar_holders[branch] = np.array([0], dtype='float64')
+        scalar_holders[RADIUS_CATEGORY_BRANCH] = np.array([0], 'i')
+        branchList.append('nSPHits')
+        branchList.append('nTSPHits')
+        branchList.append('nRecHits')
+        branchList.append('TargetSPRecoilE_pt')
+        branchList += TRAJECTORY_BRANCHES + [RADIUS_CATEGORY_BRANCH]
+        # Now, go through each branch name and a corresponding branch to the tree:
+        for branch, var in scalar_holders.items():
+            # Need to make sure that each var is stored as the correct type (floats, ints, etc):
+            if branch == 'nSPHits' or branch == 'nTSPHits' or branch == 'nRecHits' or branch == RADIUS_CATEGORY_BRANCH:
+                branchname = branch
+                dtype = 'I'
+            elif branch == 'TargetSPRecoilE_pt':
+                branchname = branch
+                dtype = 'F'
+            elif branch in TRAJECTORY_BRANCHES:
+                branchname = branch
+                dtype = 'D'
+            else:
+                branchname = re.split(r'[./]', branch)[1]
+                dtype = 'F'
+            tree.Branch(branchname, var, branchname+"/"+dtype)
+        for branch, var in vector_holders.items():
+            # NOTE:  Can't currently handle EcalVeto branches that store vectors.  Not necessary for PN, though.
+            parent = re.split(r'[./]', branch)[0]
+            branchname = re.split(r'[./]', branch)[-1]
+            print("Found parent={}, branchname={}".format(parent, branchname))
+            if parent == 'EcalScoringPlaneHits_v3_v13':
+                tree.Branch(branchname, var, "{}[nSPHits]/F".format(branchname))
+            elif parent == 'TargetScoringPlaneHits_v3_v13':
+                tree.Branch(branchname+'tsp_', var, "{}[nTSPHits]/F".format(branchname+'tsp_'))
+            else:  # else in EcalRecHits
+                tree.Branch(branchname+'rec_', var, "{}[nRecHits]/F".format(branchname+'rec_'))
+        print("TEMP:  Branches added to tree:")
+        for b in tree.GetListOfBranches():  print(b.GetFullName())
+        print("TEMP:  Leaves added ot tree:")
+        for b in tree.GetListOfLeaves():    print(b.GetFullName())
+
+        print("All branches added.")
+        self.tree = tree
+        self.branchList = branchList
+        self.scalar_holders = scalar_holders
+        self.vector_holders = vector_holders
+
+    def write(self, preselected_data):
+        # Returns the number of events written
+        nWritten = 0
+        for i in range(len(preselected_data['nRecHits'])):
+            # For each event, fill the temporary arrays with data, then write them to the tree with Fill()
+            # ALSO:  If event contains no ecal hits, ignore it.
+            if preselected_data['nRecHits'][i] == 0:  continue
+
+            for branch in self.branchList:
+                # Contains both vector and scalar data.  Treat them differently:
+                if branch in self.scalar_holders.keys():  # Scalar
+                    # fill scalar data
+                    self.scalar_holders[branch][0] = preselected_data[branch][i]
+                elif branch in self.vector_holders.keys():  # Vector
+                    # fill vector data
+                    for j in range(len(preselected_data[branch][i])):
+                        self.vector_holders[branch][j] = preselected_data[branch][i][j]
+                else:
+                    print("FATAL ERROR:  {} not found in *_holders".format(branch))
+                    assert(False)
+            self.tree.Fill()
+            nWritten += 1
+        return nWritten
+
+    def close(self):
+        # Finally, write the filled tree to the ouput file:
+        self.outfile.Write()
+        self.outfile.Close()
+
+
+def loadManifest(path):
+    # Returns {output file name: record} from a previous run (empty if there is none)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)['files']
+
+
+def saveManifest(path, records):
+    # Write to a temporary file and rename it, so the manifest is never left half-written if the job is killed
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'files': records}, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def runTask(task):
+    # Process one file and return its manifest record (failures are recorded rather than stopping the other files)
+    filename, mass, filenum = task
+    record = {'input': filename, 'mass': mass, 'filenum': filenum, 'size': os.path.getsize(filename)}
+    start = time.time()
+    try:
+        nTotal, nPassed = processFile([filename, mass, filenum])
+        record.update(status='done', nTotal=nTotal, nPassed=nPassed)
+    except Exception as e:
+        print("FAILED to process {}:  {!r}".format(filename, e))
+        record.update(status='failed', error=repr(e))
+    record['seconds'] = round(time.time() - start, 2)
+    return outputName(mass, filenum), record
 
 
 if __name__ == '__main__':
-    # New approach:  Use multiprocessing
-    #pool = Pool(16) -> Run 16 threads/process 16 files in parallel
-    
-    presel_eff = {}
-    # For each signal mass and for PN background:
+    # New approach:  Use multiprocessing, with one pool shared by all masses.  Files are handed out one at a time
+    # (largest first, so the slowest files don't end up running alone at the end), and each result is recorded in
+    # the manifest as soon as it comes back.
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    records = loadManifest(manifest_path)
+
+    # Assemble list of function params:  [filepath, mass, file_number] for every input file.  Files are sorted so
+    # that file numbers (and so output names) stay the same between runs.
+    tasks = []
     for mass, filepath in file_templates.items():
-        print("======  m={}  ======".format(mass))
-        # Assemble list of function params
-        # These get passed to processFile() when Pool requests them
-        params = []
-        for filenum, f in enumerate(glob.glob(filepath)):
-            params.append([f, mass, filenum])  # list will be passed to ProcessFile:  processFile([filepath, mass, file_number])
-        with Pool(20) as pool:  # Can increase this number if desired, although this depends on how many threads POD will let you run at once...
-            # this number is unclear, but 20 seems right judging from the POD webpage
-            results = pool.map(processFile, params)
-        print("Finished.  Result len:", len(results))
-        print(results)
-        nTotal  = sum([r[0] for r in results])
-        nEvents = sum([r[1] for r in results])
+        for filenum, f in enumerate(sorted(glob.glob(filepath))):
+            record = records.get(outputName(mass, filenum))
+            if record is not None and record['status'] == 'done' and record['input'] == f \
+                    and os.path.exists(os.path.join(output_dir, outputName(mass, filenum))):
+                continue
+            tasks.append([f, mass, filenum])
+    tasks.sort(key=lambda task: os.path.getsize(task[0]), reverse=True)
+    print("{} files to process ({} already done)".format(len(tasks), sum(r['status'] == 'done' for r in records.values())))
+
+    start = time.time()
+    with Pool(NUM_PROCESSES) as pool:
+        for i, (outfile_name, record) in enumerate(pool.imap_unordered(runTask, tasks)):
+            records[outfile_name] = record
+            saveManifest(manifest_path, records)
+            print("[{}/{}] {} {} in {:.1f} s".format(i+1, len(tasks), outfile_name, record['status'], record['seconds']))
+    print("Finished {} files in {:.1f} s".format(len(tasks), time.time() - start))
+
+    # Preselection efficiencies, from every file recorded in the manifest (including ones done in earlier runs):
+    presel_eff = {}
+    for mass in file_templates:
+        done = [r for r in records.values() if r['mass'] == mass and r['status'] == 'done']
+        nTotal  = sum([r['nTotal'] for r in done])
+        nEvents = sum([r['nPassed'] for r in done])
         print("m = {} MeV:  Read {} events, {} passed preselection".format(int(mass*1000), nTotal, nEvents))
         if nTotal > 0:
             presel_eff[int(mass * 1000)] = float(nEvents) / nTotal
         else:
             presel_eff[int(mass * 1000)] = 'no events!'
+    failed = sorted(name for name, r in records.items() if r['status'] == 'failed')
+    if failed:
+        print("WARNING:  {} files failed (rerun to retry):  {}".format(len(failed), failed))
     print("Done.  Presel_eff: {}".format(presel_eff))
 
     # For running without multithreading (note:  will be extremely slow and is impractical unless you want to test/use 1-2 files at a time):
@@ -356,7 +527,7 @@ if __name__ == '__main__':
         nTotal = 0  # pre-preselection
         nEvents = 0 # post-preselection
         print("======  m={}  ======".format(mass))
-        for f in glob.glob(filepath):
+        for f in sorted(glob.glob(filepath)):
             # Process each file separately
             nT, nE = processFile([f, mass, filenum])
             nTotal += nT
@@ -0,0 +1,146 @@
+from __future__ import print_function
+
+import numpy as np
+from torch.utils.data import DataLoader
+
+import tqdm
+import os
+import json
+import argparse
+
+from dataset import ECalHitsDataset, MAX_NUM_ECAL_HITS, KNN_KS, static_knn
+
+"""
+pack_dataset.py
+
+Purpose:  Build the padded ParticleNet input arrays for a set of file_processor.py output files once, and save them
+to disk so that training doesn't have to redo it every epoch.  The output directory can be read with
+dataset.PackedECalHitsDataset (train.py --packed-dir).
+
+Outline:
+- Create an ordinary ECalHitsDataset for the requested samples/load_range.
+- Loop over every event (in parallel with a DataLoader) and write the (nRegions, 3, MAX_NUM_ECAL_HITS) coordinate
+  arrays, (nRegions, 5, MAX_NUM_ECAL_HITS) feature arrays, labels, extra labels and obs branches to fixed-stride
+  .npy shards:  coordinates_00000.npy, features_00000.npy, ...
+- For every --knn-k, also write the (nRegions, MAX_NUM_ECAL_HITS, k) first EdgeConv layer neighbour indices
+  (utils.ParticleNet.first_layer_knn), which only depend on the event:  knn7_00000.npy, ...
+- Write index.json describing the shards and the configuration used to make them.
+
+Example (train.py uses <output-dir>/train and <output-dir>/val):
+    python pack_dataset.py --sample 0 '/path/to/*pn*.root' 800000 --sample 1 '/path/to/*0.001*.root' 200000 ... \\
+        --load-range 0.2 1 --num-regions 3 --output-dir packed/train
+    python pack_dataset.py [same samples] --load-range 0 0.2 --num-regions 3 --output-dir packed/val
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sample', nargs=3, action='append', required=True, metavar=('LABEL', 'FILEPATH', 'MAX_EVENTS'),
+                    help='sample to pack:  extra label (0 for background, mass in MeV for signal), file glob, max events (-1 for all)')
+parser.add_argument('--load-range', type=float, nargs=2, default=[0, 1],
+                    help='fraction of each file to pack (train.py trains on 0.2 1 and validates on 0 0.2)')
+parser.add_argument('--num-regions', type=int, default=1,
+                    help='Number of regions for SplitNet')
+parser.add_argument('--detector-version', type=str, default='v13')
+parser.add_argument('--obs-branches', type=str, nargs='*', default=['discValue_', 'recoilX_', 'recoilY_', 'TargetSPRecoilE_pt'],
+                    help='scalar branches to save alongside the inputs (for the plotting output)')
+parser.add_argument('--knn-k', type=int, nargs='*', default=KNN_KS,
+                    help='k values to store the first layer knn indices for (train.py --static-knn)')
+parser.add_argument('--shard-size', type=int, default=50000,
+                    help='number of events per shard')
+parser.add_argument('--num-workers', type=int, default=8,
+                    help='number of processes used to build the inputs')
+parser.add_argument('--output-dir', type=str, required=True)
+
+
+def _stack(batch):
+    coordinates, features, labels = zip(*batch)
+    return np.stack(coordinates), np.stack(features), np.array(labels)
+
+
+def pack(args):
+    siglist = {}
+    bkglist = {}
+    for label, filepath, max_events in args.sample:
+        label = int(label)
+        if label == 0:
+            bkglist[label] = (filepath, int(max_events))
+        else:
+            siglist[label] = (filepath, int(max_events))
+
+    data = ECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=tuple(args.load_range), obs_branches=args.obs_branches,
+                           detector_version=args.detector_version, nRegions=args.num_regions)
+    nEvents = len(data)
+    obs_data = data.get_obs_data()
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    shards = []
+    for start in range(0, nEvents, args.shard_size):
+        shards.append({'name': '%05d' % len(shards), 'num_events': min(args.shard_size, nEvents - start)})
+
+    def open_shard(shard):
+        def npy(name, dtype, shape):
+            path = os.path.join(args.output_dir, '{}_{}.npy'.format(name, shard['name']))
+            return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(shard['num_events'],) + shape)
+        arrays = {
+            'coordinates': npy('coordinates', 'float32', (args.num_regions, 3, MAX_NUM_ECAL_HITS)),
+            'features':    npy('features', 'float32', (args.num_regions, data.num_features, MAX_NUM_ECAL_HITS)),
+            'label':       npy('label', 'int8', ()),
+            'extra_label': npy('extra_label', 'int32', ()),
+            }
+        for branch in args.obs_branches:
+            arrays['obs_' + branch] = npy('obs_' + branch, 'float32', ())
+        for k in args.knn_k:
+            arrays['knn%d' % k] = npy('knn%d' % k, 'int8', (args.num_regions, MAX_NUM_ECAL_HITS, k))
+        return arrays
+
+    # Events come out of the loader in order, so event i ends up at position i % shard_size of shard i // shard_size
+    loader = DataLoader(data, batch_size=1024, num_workers=args.num_workers,
+                        collate_fn=_stack, shuffle=False, drop_last=False)
+    arrays = None
+    pos = 0
+    with tqdm.tqdm(total=nEvents) as tq:
+        for coordinates, features, labels in loader:
+            knn = {k: static_knn(coordinates, features, k) for k in args.knn_k}
+            done = 0
+            while done < len(labels):
+                shard_idx, j = divmod(pos, args.shard_size)
+                if j == 0:
+                    arrays = open_shard(shards[shard_idx])
+                n = min(len(labels) - done, shards[shard_idx]['num_events'] - j)
+                arrays['coordinates'][j:j+n] = coordinates[done:done+n]
+                arrays['features'][j:j+n]    = features[done:done+n]
+                arrays['label'][j:j+n]       = labels[done:done+n]
+                arrays['extra_label'][j:j+n] = data.extra_labels[pos:pos+n]
+                for branch in args.obs_branches:
+                    arrays['obs_' + branch][j:j+n] = obs_data[branch][pos:pos+n]
+                for k in args.knn_k:
+                    arrays['knn%d' % k][j:j+n] = knn[k][done:done+n]
+                if j + n == shards[shard_idx]['num_events']:
+                    for arr in arrays.values():
+                        arr.flush()
+                done += n
+                pos += n
+            tq.update(len(labels))
+    assert(pos == nEvents)
+
+    index = {
+        'num_events': nEvents,
+        'shard_size': args.shard_size,
+        'shards': shards,
+        'nRegions': args.num_regions,
+        'num_features': data.num_features,
+        'max_num_hits': MAX_NUM_ECAL_HITS,
+        'detector_version': args.detector_version,
+        'obs_branches': args.obs_branches,
+        'knn_k': args.knn_k,
+        'siglist': {str(k): v for k, v in siglist.items()},
+        'bkglist': {str(k): v for k, v in bkglist.items()},
+        'load_range': args.load_range,
+        }
+    with open(os.path.join(args.output_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    print("Packed {} events into {} shards in {}".format(nEvents, len(shards), args.output_dir))
+
+
+if __name__ == '__main__':
+    pack(parser.parse_args())
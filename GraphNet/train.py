@@ -19,13 +19,20 @@ torch.set_default_dtype(torch.float32)
 import tqdm
 import os
 import sys
+import time
+import json
 import datetime
 import argparse
+import functools
 
 from utils.ParticleNet import ParticleNet
-from dataset import ECalHitsDataset
+from dataset import ECalHitsDataset, PackedECalHitsDataset, StreamingECalHitsDataset, FileBlockShuffleSampler
+from dataset import HitCountBucketBatchSampler, DistributedShardSampler, ResumableSampler, MAX_NUM_ECAL_HITS
 from dataset import collate_wrapper as collate_fn
+from dataset import collate_batches
 from utils.SplitNet import SplitNet
+from utils.step_timer import StepTimer
+from utils.checkpoint import AsyncCheckpointer
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--demo', action='store_true', default=False,
@@ -52,6 +59,57 @@ parser.add_argument('--device', type=str, default='cuda:0',
                     help='device for the training')
 parser.add_argument('--num-workers', type=int, default=2,
                     help='number of threads to load the dataset')
+parser.add_argument('--packed-dir', type=str, default='',
+                    help='read pre-packed inputs from <packed-dir>/train and <packed-dir>/val (made with pack_dataset.py) instead of the ROOT files')
+parser.add_argument('--max-open-files', type=int, default=64,
+                    help='max number of input files each data loading worker keeps open at once')
+parser.add_argument('--shuffle', type=str, default='file-block', choices=['file-block', 'random'],
+                    help='training sample order:  file-block shuffles blocks of consecutive events and then events within a window '
+                         '(mostly sequential reads, see dataset.FileBlockShuffleSampler), random is a full random permutation')
+parser.add_argument('--shuffle-block-size', type=int, default=1024,
+                    help='number of consecutive events of a file per block for --shuffle file-block')
+parser.add_argument('--shuffle-window', type=int, default=16384,
+                    help='number of events shuffled together for --shuffle file-block')
+parser.add_argument('--seed', type=int, default=0,
+                    help='random seed for the training sample order')
+parser.add_argument('--streaming', action='store_true', default=False,
+                    help='read the inputs in chunks with uproot and build whole batches at once (dataset.StreamingECalHitsDataset) '
+                         'instead of event by event with ROOT.  Shuffles chunks and events within --shuffle-window events')
+parser.add_argument('--stream-chunk-size', type=int, default=4096,
+                    help='number of consecutive events read at once with --streaming')
+parser.add_argument('--cache-mb', type=float, default=0,
+                    help='keep up to this many MB of featurized events of each of the train/val samples in shared memory, '
+                         'so they are only read from the ROOT files in the first epoch (0 to disable)')
+parser.add_argument('--bucket-by-hits', action='store_true', default=False,
+                    help='batch training events with similar numbers of hits together (dataset.HitCountBucketBatchSampler, '
+                         'replaces --shuffle) and trim the zero padding of every batch to its longest event.  '
+                         'With --streaming, batches are only trimmed')
+parser.add_argument('--bucket-width', type=int, default=8,
+                    help='number of hit counts per bucket for --bucket-by-hits')
+parser.add_argument('--static-knn', action='store_true', default=False,
+                    help='use precomputed first EdgeConv layer knn indices (stored by pack_dataset.py for --packed-dir, '
+                         'otherwise computed when the events are read and kept in the --cache-mb cache) instead of '
+                         'recomputing them every epoch; not available with --streaming')
+parser.add_argument('--profile-steps', type=int, default=0,
+                    help='record a torch.profiler trace of this many training steps of the first epoch (after the first 2 steps), '
+                         'saved to <save-model-path>_profile.json (0 to disable)')
+parser.add_argument('--resume', action='store_true', default=False,
+                    help='continue the training from <save-model-path>_checkpoint.pt (model, optimizer, lr schedule, RNG '
+                         'states and position in the epoch), if it exists')
+parser.add_argument('--checkpoint-minutes', type=float, default=30,
+                    help='also write <save-model-path>_checkpoint.pt every this many minutes within an epoch (it is always '
+                         'written after every epoch); 0 to disable.  Not available with --streaming')
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                    help='bf16:  run the forward passes under bfloat16 autocast (convolutions, BatchNorms and fc layers in '
+                         'bfloat16, knn in float32); the weights, loss and optimizer stay float32.  Fast on CPUs with '
+                         'AVX512-BF16/AMX; check the result with validate_precision.py')
+parser.add_argument('--distributed', action='store_true', default=False,
+                    help='data-parallel training over several CPU processes (gloo backend); launch with torchrun, e.g. '
+                         'torchrun --nproc_per_node 4 train.py --distributed --device cpu ...  --batch-size is the total over all '
+                         'processes; each one trains on its shard of every epoch and the gradients are averaged')
+parser.add_argument('--threads', type=int, default=0,
+                    help='torch CPU threads per process (0:  the torch default, or with --distributed the CPU cores of the '
+                         'node divided by the number of processes on it)')
 
 parser.add_argument('--predict', action='store_true', default=False,
                     help='run prediction instead of training')
@@ -67,6 +125,8 @@ parser.add_argument('--test-output-path', type=str, default='test-outputs/partic
                     help='path to save the prediction output')
 parser.add_argument('--num-regions', type=int, default=1,
                     help='Number of regions for SplitNet')
+parser.add_argument('--batched-regions', action='store_true', default=False,
+                    help='run the SplitNet regions in one batched pass instead of one after another (same parameters and outputs)')
 print(sys.argv)
 args = parser.parse_args()
 
@@ -91,8 +151,7 @@ siglist = {
     # 10:   ('/home/pmasterson/GraphNet_input/v13/training/*0.01*.root',  200000),
     # 100:  ('/home/pmasterson/GraphNet_input/v13/training/*0.1*.root',   200000),
     # 1000: ('/home/pmasterson/GraphNet_input/v13/training/*1.0*.root',   200000),
-    # }
-/home/pmasterson/events/v3.0.0_tag_standard_skimmed/signal
+    }
 
 # if args.demo:
 #     bkglist = {
@@ -100,7 +159,7 @@ siglist = {
 #         0: ('/home/pmasterson/GraphNet_input/v13/training/*pn*.root', 800)
 #         }
 
-    siglist = {
+#     siglist = {
         # (filepath, num_events_for_training)
         # 1:    ('/home/pmasterson/GraphNet_input/v13/training/*0.001*.root', 200),
         # 10:   ('/home/pmasterson/GraphNet_input/v13/training/*0.01*.root',  200),
@@ -212,32 +271,121 @@ elif args.network == 'particle-net-k7':
 print('conv_params: %s' % conv_params)
 print('fc_params: %s' % fc_params)
 
+# k of the first EdgeConv layer, if its knn indices are precomputed
+knn_k = conv_params[0][0] if args.static_knn else None
+assert(not (args.static_knn and args.streaming)), "--static-knn isn't available with --streaming"
+
+if args.bucket_by_hits:
+    # Trim the padding of every batch, keeping enough points for the knn of every EdgeConv layer
+    min_nodes = max(k for k, _ in conv_params) + 1
+    collate_fn = functools.partial(collate_fn, min_nodes=min_nodes)
+    collate_batches = functools.partial(collate_batches, min_nodes=min_nodes)
+
 # device
 dev = torch.device(args.device)
 
+# data-parallel processes (torchrun sets the environment read by init_process_group)
+rank, world_size = 0, 1
+if args.distributed:
+    import torch.distributed as dist
+    assert(training_mode), '--distributed is for training only'
+    assert(not args.streaming), "--distributed isn't available with --streaming"
+    assert(dev.type == 'cpu'), '--distributed trains on CPU (gloo backend); use --device cpu'
+    dist.init_process_group('gloo')
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    assert(args.batch_size % world_size == 0), '--batch-size must be divisible by the number of processes'
+    if args.threads == 0:
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+        args.threads = max(1, (os.cpu_count() or 1) // local_world_size)
+    print('Process %d of %d, %d events per batch' % (rank, world_size, args.batch_size // world_size))
+if args.threads > 0:
+    torch.set_num_threads(args.threads)
+# Events per training/validation batch of this process
+batch_size = args.batch_size // world_size
+
 # load data
 if training_mode:
     # for training: we use the first 0-20% for testing, and 20-80% for training
     # Create one EcalHitsDatset storing the testing/validation sample...
-    train_data = ECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=(0.2, 1), nRegions=args.num_regions)
-    # ...and one storing the training sample.
-    val_data = ECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=(0, 0.2), nRegions=args.num_regions)
-    train_loader = DataLoader(train_data, num_workers=args.num_workers, batch_size=args.batch_size,
-                              collate_fn=collate_fn, shuffle=True, drop_last=True, pin_memory=True)
-    val_loader = DataLoader(val_data, num_workers=args.num_workers, batch_size=args.batch_size,
-                            collate_fn=collate_fn, shuffle=False, drop_last=False, pin_memory=True)
-    print('Train: %d events, Val: %d events' % (len(train_data), len(val_data)))
+    if args.packed_dir:
+        train_data = PackedECalHitsDataset(os.path.join(args.packed_dir, 'train'), knn_k=knn_k)
+        val_data = PackedECalHitsDataset(os.path.join(args.packed_dir, 'val'), knn_k=knn_k)
+    elif args.streaming:
+        # Shuffled in groups of chunks covering about --shuffle-window events
+        train_data = StreamingECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=(0.2, 1), nRegions=args.num_regions,
+                                              batch_size=args.batch_size, chunk_size=args.stream_chunk_size, shuffle=True,
+                                              shuffle_chunks=max(1, args.shuffle_window // args.stream_chunk_size),
+                                              drop_last=True, seed=args.seed)
+        val_data = StreamingECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=(0, 0.2), nRegions=args.num_regions,
+                                            batch_size=args.batch_size, chunk_size=args.stream_chunk_size)
+    else:
+        train_data = ECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=(0.2, 1), nRegions=args.num_regions,
+                                     max_open_files=args.max_open_files, cache_mb=args.cache_mb, knn_k=knn_k)
+        # ...and one storing the training sample.
+        val_data = ECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=(0, 0.2), nRegions=args.num_regions,
+                                   max_open_files=args.max_open_files, cache_mb=args.cache_mb, knn_k=knn_k)
+    assert(train_data.nRegions == args.num_regions)
+    if args.streaming and not args.packed_dir:
+        # The dataset shuffles and batches by itself
+        train_sampler = train_data
+        train_loader = DataLoader(train_data, num_workers=args.num_workers, batch_size=None,
+                                  collate_fn=collate_batches, pin_memory=True)
+        val_loader = DataLoader(val_data, num_workers=args.num_workers, batch_size=None,
+                                collate_fn=collate_batches, pin_memory=True)
+    elif args.bucket_by_hits:
+        train_sampler = HitCountBucketBatchSampler(train_data.hit_counts(), batch_size, bucket_width=args.bucket_width,
+                                                   drop_last=True, seed=args.seed)
+        if args.distributed:
+            train_sampler = DistributedShardSampler(train_sampler, rank, world_size)
+        train_sampler = ResumableSampler(train_sampler)
+        train_loader = DataLoader(train_data, num_workers=args.num_workers, batch_sampler=train_sampler,
+                                  collate_fn=collate_fn, pin_memory=True)
+        val_loader = DataLoader(val_data, num_workers=args.num_workers, batch_size=args.batch_size,
+                                collate_fn=collate_fn, shuffle=False, drop_last=False, pin_memory=True)
+    else:
+        if args.shuffle == 'file-block':
+            train_sampler = FileBlockShuffleSampler(train_data, block_size=args.shuffle_block_size,
+                                                    window_size=args.shuffle_window, seed=args.seed)
+        else:
+            train_sampler = torch.utils.data.RandomSampler(train_data, generator=torch.Generator().manual_seed(args.seed))
+        if args.distributed:
+            # Same seed in every process, so they all draw the same order and take different shards of it
+            train_sampler = DistributedShardSampler(train_sampler, rank, world_size)
+        train_sampler = ResumableSampler(train_sampler)
+        train_loader = DataLoader(train_data, num_workers=args.num_workers, batch_size=batch_size, sampler=train_sampler,
+                                  collate_fn=collate_fn, drop_last=True, pin_memory=True)
+        val_loader = DataLoader(val_data, num_workers=args.num_workers, batch_size=args.batch_size,
+                                collate_fn=collate_fn, shuffle=False, drop_last=False, pin_memory=True)
+    print('Train: %d events, Val: %d events' % (len(train_data.label), len(val_data.label)))
     print('Using val sample for testing!')
     test_data = val_data
     test_loader = val_loader
+    if args.distributed:
+        # Each process validates its share of the val sample (the accuracy is summed over the processes in evaluate());
+        # the test evaluation after training runs over all of it, in process 0
+        val_shard = np.array_split(np.arange(len(val_data.label)), world_size)[rank].tolist()
+        val_loader = DataLoader(val_data, num_workers=args.num_workers, batch_size=batch_size, sampler=val_shard,
+                                collate_fn=collate_fn, drop_last=False, pin_memory=True)
 
 else:
     # If not in training mode, don't need to bother with the second training dataset.
     test_frac = (0, 1) if args.test_sig or args.test_bkg else (0, 0.2)
-    test_data = ECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=test_frac, 
-                                obs_branches=obs_branches, nRegions=args.num_regions)
-    test_loader = DataLoader(test_data, num_workers=args.num_workers, batch_size=args.batch_size,
-                             collate_fn=collate_fn, shuffle=False, drop_last=False, pin_memory=True)
+    if args.packed_dir and not (args.test_sig or args.test_bkg):
+        # Packed validation sample; obs branches were saved when packing
+        test_data = PackedECalHitsDataset(os.path.join(args.packed_dir, 'val'), knn_k=knn_k)
+    elif args.streaming:
+        test_data = StreamingECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=test_frac, obs_branches=obs_branches,
+                                             nRegions=args.num_regions, batch_size=args.batch_size, chunk_size=args.stream_chunk_size)
+    else:
+        test_data = ECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=test_frac, 
+                                    obs_branches=obs_branches, nRegions=args.num_regions, max_open_files=args.max_open_files,
+                                    knn_k=knn_k)
+    if isinstance(test_data, StreamingECalHitsDataset):
+        test_loader = DataLoader(test_data, num_workers=args.num_workers, batch_size=None,
+                                 collate_fn=collate_batches, pin_memory=True)
+    else:
+        test_loader = DataLoader(test_data, num_workers=args.num_workers, batch_size=args.batch_size,
+                                 collate_fn=collate_fn, shuffle=False, drop_last=False, pin_memory=True)
 
 input_dims = test_data.num_features
 
@@ -248,7 +396,8 @@ model = SplitNet(input_dims=input_dims, num_classes=2,
                  conv_params=conv_params,
                  fc_params=fc_params,
                  use_fusion=True,
-                 nRegions=args.num_regions)
+                 nRegions=args.num_regions,
+                 batched_regions=args.batched_regions)
 # Tell python to run the model on the specified device (usually GPU)
 model = model.to(dev)
 # ...and this function does the same thing for the three SplitNets.
@@ -256,23 +405,56 @@ model = model.to(dev)
 #model.particle_nets_to(dev)
 
 
-def train(model, opt, scheduler, train_loader, dev):
+def cache_postfix(dataset):
+    # Feature cache hit rate and size for the tqdm postfix (empty if the dataset has no cache)
+    stats = dataset.cache_stats() if hasattr(dataset, 'cache_stats') else None
+    if stats is None:
+        return {}
+    lookups = stats['hits'] + stats['misses']
+    return {'CacheHit': '%.3f' % (stats['hits'] / lookups if lookups else 0),
+            'CacheMB': '%.0f' % stats['mb']}
+
+
+def autocast():
+    # Context for the forward passes:  bfloat16 autocast with --precision bf16, nothing otherwise
+    return torch.autocast(dev.type, dtype=torch.bfloat16, enabled=args.precision == 'bf16')
+
+
+def train(model, opt, scheduler, train_loader, dev, timer=None, profiler=None, on_step=None):
+    # timer:  StepTimer for the step phases (a new one if None); profiler:  started torch.profiler.profile to step;
+    # on_step:  called with the number of steps done after every step (e.g. to write a checkpoint)
+    # model may be wrapped in DistributedDataParallel (--distributed), net is the SplitNet itself
     model.train()
+    net = getattr(model, 'module', model)
+    timer = timer if timer is not None else StepTimer(dev)
 
     total_loss = 0
     num_batches = 0
     total_correct = 0
     count = 0
-    with tqdm.tqdm(train_loader) as tq:
-        for batch in tq:
+    flops = 0  # Forward pass FLOPs of the (possibly trimmed) batches, see SplitNet.flops()
+    start_time = time.time()
+    with tqdm.tqdm(train_loader, disable=rank != 0) as tq:
+        for batch in timer.batches(tq):
             label = batch.label
             num_examples = label.shape[0]
-            label = label.to(dev).squeeze().long()
+            flops += net.flops(batch.features.shape[-1]) * num_examples
+            with timer.phase('to_device'):
+                label = label.to(dev).squeeze().long()
+                knn_idx = batch.knn_idx.to(dev) if batch.knn_idx is not None else None
+                coordinates, features = batch.coordinates.to(dev), batch.features.to(dev)
             opt.zero_grad()
-            logits = model(batch.coordinates.to(dev), batch.features.to(dev))
-            loss = loss_func(logits, label)
-            loss.backward()
-            opt.step()
+            with timer.phase('forward'):
+                with autocast():
+                    logits = model(coordinates, features, pad_to=MAX_NUM_ECAL_HITS, knn_idx=knn_idx)
+                logits = logits.float()  # The loss is computed in float32
+                loss = loss_func(logits, label)
+            with timer.phase('backward'):
+                loss.backward()
+            with timer.phase('optimizer'):
+                opt.step()
+            if profiler is not None:
+                profiler.step()
 
             _, preds = logits.max(1)
 
@@ -287,29 +469,63 @@ def train(model, opt, scheduler, train_loader, dev):
                 'Loss': '%.5f' % loss,
                 'AvgLoss': '%.5f' % (total_loss / num_batches),
                 'Acc': '%.5f' % (correct / num_examples),
-                'AvgAcc': '%.5f' % (total_correct / count)})
-
+                'AvgAcc': '%.5f' % (total_correct / count),
+                **cache_postfix(train_loader.dataset)})
+            if on_step is not None:
+                on_step(num_batches)
+
+    elapsed = time.time() - start_time
+    padded_flops = net.flops(MAX_NUM_ECAL_HITS) * count
+    # events/s of all processes together
+    print('Train: %d events in %.1f s (%.0f events/s), forward pass %.4g GFLOP (%.1f%% of the %.4g GFLOP with full padding)' % (
+        count, elapsed, count * world_size / elapsed, flops / 1e9, 100. * flops / max(padded_flops, 1), padded_flops / 1e9))
+    print('Train ' + timer.format())
     scheduler.step()
+    if hasattr(train_loader.dataset, 'reset_cache_stats'):
+        train_loader.dataset.reset_cache_stats()
+
+
+def print_pool_stats(name, dataset):
+    # Report how many file opens the dataset's open-file pool saved since the last call
+    if not hasattr(dataset, 'pool_stats'):  # e.g. packed inputs
+        return
+    stats = dataset.pool_stats()
+    total = stats['hits'] + stats['misses']
+    if total > 0:
+        print('%s file pool: %d events, %d file opens (%.2f%% of opens saved)' % (
+            name, total, stats['misses'], 100. * stats['hits'] / total))
+    dataset.reset_pool_stats()
 
 
-def evaluate(model, test_loader, dev, return_scores=False):
+def evaluate(model, test_loader, dev, return_scores=False, timer=None):
+    # timer:  StepTimer for the step phases (a new one if None)
     model.eval()
+    timer = timer if timer is not None else StepTimer(dev)
 
     total_correct = 0
     count = 0
     scores = []
+    indices = []
 
     with torch.no_grad():
-        with tqdm.tqdm(test_loader) as tq:
-            for batch in tq:
+        with tqdm.tqdm(test_loader, disable=rank != 0) as tq:
+            for batch in timer.batches(tq):
                 label = batch.label
                 num_examples = label.shape[0]
-                label = label.to(dev).squeeze().long()
-                logits = model(batch.coordinates.to(dev), batch.features.to(dev))
+                with timer.phase('to_device'):
+                    label = label.to(dev).squeeze().long()
+                    knn_idx = batch.knn_idx.to(dev) if batch.knn_idx is not None else None
+                    coordinates, features = batch.coordinates.to(dev), batch.features.to(dev)
+                with timer.phase('forward'):
+                    with autocast():
+                        logits = model(coordinates, features, pad_to=MAX_NUM_ECAL_HITS, knn_idx=knn_idx)
+                    logits = logits.float()
                 _, preds = logits.max(1)
 
                 if return_scores:
                     scores.append(torch.softmax(logits, dim=1).cpu().detach().numpy())
+                    if hasattr(batch, 'index'):
+                        indices.append(batch.index)
 
                 correct = (preds == label).sum().item()
                 total_correct += correct
@@ -317,15 +533,67 @@ def evaluate(model, test_loader, dev, return_scores=False):
 
                 tq.set_postfix({
                     'Acc': '%.5f' % (correct / num_examples),
-                    'AvgAcc': '%.5f' % (total_correct / count)})
+                    'AvgAcc': '%.5f' % (total_correct / count),
+                    **cache_postfix(test_loader.dataset)})
+
+    print('Eval ' + timer.format())
+    if hasattr(test_loader.dataset, 'reset_cache_stats'):
+        test_loader.dataset.reset_cache_stats()
+
+    if world_size > 1 and not return_scores:
+        # Validation shards of all processes (see val_loader)
+        totals = torch.tensor([total_correct, count], dtype=torch.float64)
+        dist.all_reduce(totals)
+        total_correct, count = totals.tolist()
 
     if return_scores:
-        return np.concatenate(scores)
+        scores = np.concatenate(scores)
+        if indices:
+            # Streaming batches arrive in no particular order; put the scores back in dataset order
+            ordered = np.empty_like(scores)
+            ordered[np.concatenate(indices)] = scores
+            scores = ordered
+        return scores
     else:
         return total_correct / count
 
 
+def profile_steps(num_steps, trace_path):
+    # torch.profiler.profile recording num_steps steps (after 1 skipped and 1 warm-up step) of the loop it's stepped
+    # in.  When they're done (or the loop ends first), the trace is saved to trace_path (chrome://tracing or https://ui.perfetto.dev) and the
+    # ops taking the most time are printed.
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if dev.type == 'cuda':
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    def trace_ready(profiler):
+        dirname = os.path.dirname(trace_path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        profiler.export_chrome_trace(trace_path)
+        sort_by = 'self_cuda_time_total' if dev.type == 'cuda' else 'self_cpu_time_total'
+        print(profiler.key_averages().table(sort_by=sort_by, row_limit=20))
+        print('Saved profiler trace to %s' % trace_path)
+
+    return torch.profiler.profile(activities=activities, on_trace_ready=trace_ready,
+                                  schedule=torch.profiler.schedule(wait=1, warmup=1, active=num_steps, repeat=1))
+
+
+def write_timing_report(report, path):
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
 if training_mode:
+    if args.distributed:
+        # Broadcasts the parameters of process 0 and averages the gradients over the processes in backward().  The fc
+        # layers of the per-region ParticleNets are never used (SplitNet has its own); static_graph lets DDP find them
+        # once, in the first step, instead of searching the graph for unused parameters in every step.
+        model = torch.nn.parallel.DistributedDataParallel(model, static_graph=True)
+
     # loss function
     if args.focal_loss_gamma > 0:
         print('Using focal loss w/ gamma=%s' % args.focal_loss_gamma)
@@ -346,29 +614,100 @@ if training_mode:
         lr_decay_rate = 0.01 ** (1. / lr_decay_epochs)
         scheduler = torch.optim.lr_scheduler.MultiStepLR(opt, milestones=list(range(args.num_epochs - lr_decay_epochs, args.num_epochs)), gamma=lr_decay_rate)
 
-    # training loop
+    # Per-epoch step timing report (see utils/step_timer.py), rewritten after every epoch
+    timing_report = {'config': {k: getattr(args, k) for k in ['network', 'num_regions', 'batch_size', 'device', 'num_workers',
+                                                              'packed_dir', 'streaming', 'cache_mb', 'bucket_by_hits',
+                                                              'static_knn', 'batched_regions', 'threads', 'precision']},
+                     'epochs': []}
+    timing_report['config']['world_size'] = world_size
+
+    # Checkpoints are written in a background thread (see utils/checkpoint.py), by process 0.  <save-model-path>_checkpoint.pt
+    # holds everything needed to continue the training (--resume); it's written after every epoch and, except with
+    # --streaming (whose order can't be replayed from the middle), every --checkpoint-minutes within an epoch.
+    checkpointer = AsyncCheckpointer() if rank == 0 else None
+    checkpoint_path = args.save_model_path + '_checkpoint.pt'
+    mid_epoch_checkpoints = args.checkpoint_minutes > 0 and isinstance(train_sampler, ResumableSampler)
+    # Items of train_sampler per training step:  batches for a batch sampler, events otherwise
+    sampler_items_per_step = 1 if args.bucket_by_hits else batch_size
+
+    def save_checkpoint(epoch, num_steps):
+        # State after num_steps training steps of epoch
+        net = getattr(model, 'module', model)
+        sampler_state = train_sampler.state_dict(num_steps * sampler_items_per_step) if isinstance(train_sampler, ResumableSampler) else None
+        checkpointer.save({'epoch': epoch, 'num_steps': num_steps, 'model': net.state_dict(), 'optimizer': opt.state_dict(),
+                           'scheduler': scheduler.state_dict(), 'best_valid_acc': best_valid_acc,
+                           'timing_epochs': timing_report['epochs'], 'sampler': sampler_state,
+                           'rng': {'torch': torch.get_rng_state(), 'numpy': np.random.get_state()}}, checkpoint_path)
+
+    def on_step(num_steps):
+        # Mid-epoch checkpoint every --checkpoint-minutes
+        global last_checkpoint_time
+        if checkpointer is not None and time.time() - last_checkpoint_time > 60 * args.checkpoint_minutes:
+            save_checkpoint(epoch, epoch_start_steps + num_steps)
+            last_checkpoint_time = time.time()
+
     best_valid_acc = 0
-    for epoch in range(args.num_epochs):
-        train(model, opt, scheduler, train_loader, dev)
+    start_epoch, start_steps = 0, 0
+    if args.resume:
+        if os.path.exists(checkpoint_path):
+            checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+            getattr(model, 'module', model).load_state_dict(checkpoint['model'])
+            opt.load_state_dict(checkpoint['optimizer'])
+            scheduler.load_state_dict(checkpoint['scheduler'])
+            best_valid_acc = checkpoint['best_valid_acc']
+            timing_report['epochs'] = checkpoint['timing_epochs']
+            if checkpoint['sampler'] is not None:
+                train_sampler.load_state_dict(checkpoint['sampler'])
+            torch.set_rng_state(checkpoint['rng']['torch'])
+            np.random.set_state(checkpoint['rng']['numpy'])
+            start_epoch, start_steps = checkpoint['epoch'], checkpoint['num_steps']
+            print('Resuming from %s:  epoch %d after %d steps' % (checkpoint_path, start_epoch, start_steps))
+        else:
+            print('No checkpoint %s; starting from scratch' % checkpoint_path)
+
+    # training loop
+    for epoch in range(start_epoch, args.num_epochs):
+        if hasattr(train_sampler, 'set_epoch'):
+            train_sampler.set_epoch(epoch)
+        epoch_start_steps = start_steps if epoch == start_epoch else 0
+        last_checkpoint_time = time.time()
+        train_timer, val_timer = StepTimer(dev), StepTimer(dev)
+        if args.profile_steps > 0 and epoch == 0 and rank == 0:
+            with profile_steps(args.profile_steps, args.save_model_path + '_profile.json') as profiler:
+                train(model, opt, scheduler, train_loader, dev, timer=train_timer, profiler=profiler,
+                      on_step=on_step if mid_epoch_checkpoints else None)
+        else:
+            train(model, opt, scheduler, train_loader, dev, timer=train_timer, on_step=on_step if mid_epoch_checkpoints else None)
+        print_pool_stats('Train', train_data)
 
         print('Epoch #%d Validating' % epoch)
-        valid_acc = evaluate(model, val_loader, dev)
+        # Without the DistributedDataParallel wrapper, whose forward pass would wait for the other processes
+        net = getattr(model, 'module', model)
+        valid_acc = evaluate(net, val_loader, dev, timer=val_timer)
+        print_pool_stats('Val', val_data)
+        timing_report['epochs'].append({'epoch': epoch, 'train': train_timer.summary(), 'val': val_timer.summary()})
+        if args.save_model_path and rank == 0:
+            write_timing_report(timing_report, args.save_model_path + '_timing.json')
         if valid_acc > best_valid_acc:
             best_valid_acc = valid_acc
-            if args.save_model_path:
-                dirname = os.path.dirname(args.save_model_path)
-                if dirname and not os.path.exists(dirname):
-                    os.makedirs(dirname)
-                torch.save(model.state_dict(), args.save_model_path + '_state.pt')
-                torch.save(model, args.save_model_path + '_full.pt')
-        torch.save(model.state_dict(), args.save_model_path + '_state_epoch-%d_acc-%.4f.pt' % (epoch, valid_acc))
+            if args.save_model_path and rank == 0:
+                checkpointer.save(net.state_dict(), args.save_model_path + '_state.pt')
+                checkpointer.save(net, args.save_model_path + '_full.pt')
+        if rank == 0:
+            checkpointer.save(net.state_dict(), args.save_model_path + '_state_epoch-%d_acc-%.4f.pt' % (epoch, valid_acc))
+            save_checkpoint(epoch + 1, 0)
         print('Current validation acc: %.5f (best: %.5f)' % (valid_acc, best_valid_acc))
-else:
-    # NOTE: NEW
-    # Need to load obs_dict info otherwise, which can only be done by calling __getitem__() once on every event.  So:
-    for i in range(len(test_data)):
-        if i % 1000 == 0:  print("Getting event", i)
-        temp_var = test_data[i]
+
+    if checkpointer is not None:
+        checkpointer.close()  # The test evaluation below loads _state.pt
+
+    if args.distributed:
+        # The test evaluation below runs in process 0 only
+        model = model.module
+        dist.barrier()
+        dist.destroy_process_group()
+        if rank != 0:
+            sys.exit(0)
 
 
 # load saved model
@@ -423,7 +762,7 @@ print("SAVING OUTPUT")
 # save prediction output
 import awkward
 pred_file = os.path.splitext(args.test_output_path)[0] + '_OUTPUT'
-out_data = test_data.get_obs_data()  #test_data.obs_data
+out_data = test_data.get_obs_data()  # Read in bulk, in the same order as test_preds
 out_data['ParticleNet_extra_label'] = test_extra_labels
 out_data['ParticleNet_disc'] = test_preds[:, 1]
 # OUTDATED:
@@ -11,13 +11,26 @@ torch.set_default_dtype(torch.float32)
 
 
 def knn(x, k):
-    inner = -2 * torch.matmul(x.transpose(2, 1), x)
-    xx = torch.sum(x ** 2, dim=1, keepdim=True)
-    pairwise_distance = -xx - inner - xx.transpose(2, 1)
-    idx = pairwise_distance.topk(k=k + 1, dim=-1)[1][:, :, 1:]  # (batch_size, num_points, k)
+    # Always in float32, also under bfloat16 autocast (train.py/eval.py --precision bf16):  with 8 bits of mantissa,
+    # the distances of nearby points (next to the 9999 shifts of the padded ones) would round together and change
+    # the neighbours
+    with torch.autocast(x.device.type, enabled=False):
+        x = x.float()
+        inner = -2 * torch.matmul(x.transpose(2, 1), x)
+        xx = torch.sum(x ** 2, dim=1, keepdim=True)
+        pairwise_distance = -xx - inner - xx.transpose(2, 1)
+        idx = pairwise_distance.topk(k=k + 1, dim=-1)[1][:, :, 1:]  # (batch_size, num_points, k)
     return idx
 
 
+def first_layer_knn(points, features, k):
+    # Neighbour indices (batch_size, num_points, k) used by the first EdgeConv layer of ParticleNet.forward:  knn on
+    # the input coordinates, with the padded (all-0 feature) points shifted away as in forward().  These only depend
+    # on the event, so they can be computed once and passed to forward() as knn_idx.
+    mask = (features.abs().sum(dim=1, keepdim=True) != 0)
+    return knn(points + (mask == 0) * 9999., k)
+
+
 def get_graph_feature(x, k, idx):
     batch_size, num_dims, num_points = x.size()
 
@@ -92,9 +105,10 @@ class EdgeConvBlock(nn.Module):
         if activation:
             self.sc_act = Mish()
 
-    def forward(self, points, features):
+    def forward(self, points, features, knn_idx=None):
+        # knn_idx:  precomputed (N, P, K) neighbour indices (e.g. first_layer_knn) instead of knn on points
 
-        topk_indices = knn(points, self.k)
+        topk_indices = knn(points, self.k) if knn_idx is None else knn_idx
         x = get_graph_feature(features, self.k, topk_indices)
 
         for conv, bn, act in zip(self.convs, self.bns, self.acts):
@@ -155,7 +169,26 @@ class ParticleNet(nn.Module):
 
         self.return_softmax = return_softmax
 
-    def forward(self, points, features, mask=None):
+    def flops(self, num_points):
+        # Approximate FLOPs (2 per multiply-add) of one forward pass over one event with num_points (real or padded)
+        # points:  the knn distance matrices plus the convolutions, which dominate.  The cost grows with num_points
+        # even for 0-padded points, so this is used to report the savings from trimming the padding.
+        total = 0
+        for idx, conv in enumerate(self.edge_convs):
+            pts_dims = 3 if idx == 0 else conv.convs[0].in_channels // 2
+            total += 2 * num_points * num_points * pts_dims  # knn:  (P, d) x (d, P)
+            total += sum(2 * num_points * conv.k * c.in_channels * c.out_channels for c in conv.convs)
+            if conv.sc:
+                total += 2 * num_points * conv.sc.in_channels * conv.sc.out_channels
+        if self.use_fusion:
+            total += 2 * num_points * self.fusion_block[0].in_channels * self.fusion_block[0].out_channels
+        return total
+
+    def forward(self, points, features, mask=None, pad_to=None, knn_idx=None):
+        # pad_to:  number of points the inputs had before the batch was trimmed (see dataset._SimpleCustomBatch), if
+        # any.  The output then matches that of the fully padded inputs (in eval mode).
+        # knn_idx:  precomputed first layer neighbour indices (see first_layer_knn); the deeper layers always compute
+        # knn on the current features.
         if mask is None:
             mask = (features.abs().sum(dim=1, keepdim=True) != 0)  # (N, 1, P)
         coord_shift = (mask == 0) * 9999.
@@ -165,11 +198,19 @@ class ParticleNet(nn.Module):
         outputs = []
         for idx, conv in enumerate(self.edge_convs):
             pts = (points if idx == 0 else fts) + coord_shift
-            fts = conv(pts, fts) * mask
+            fts = conv(pts, fts, knn_idx=knn_idx if idx == 0 else None) * mask
             if self.use_fusion:
                 outputs.append(fts)
         if self.use_fusion:
-            fts = self.fusion_block(torch.cat(outputs, dim=1))
+            fusion_input = torch.cat(outputs, dim=1)
+            num_trimmed = 0 if pad_to is None else pad_to - fusion_input.shape[-1]
+            if num_trimmed > 0:
+                # The fusion block output isn't masked, so every 0-padded point adds the same (nonzero) vector to the
+                # sum below.  Add it back for the trimmed points:  one extra 0 point, weighted by their number.
+                fusion_input = torch.cat((fusion_input, torch.zeros_like(fusion_input[..., :1])), dim=-1)
+            fts = self.fusion_block(fusion_input)
+            if num_trimmed > 0:
+                fts = torch.cat((fts[..., :-1], fts[..., -1:] * num_trimmed), dim=-1)
         x = fts.sum(axis=-1) / counts  # divide by the real counts
         return x
         # TEMPORARILY COMMENTED--moving FC layer to SplitNet.
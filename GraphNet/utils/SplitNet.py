@@ -3,11 +3,73 @@ from __future__ import print_function
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from utils.ParticleNet import *
 
 torch.set_default_dtype(torch.float32)
 
+
+# Helpers for SplitNet(batched_regions=True).  Tensors with all regions have shape (N, nRegions*C, ...) with the
+# channels of region r at [r*C, (r+1)*C), which is the same memory as (N*nRegions, C, ...) with event n, region r at
+# n*nRegions + r.
+
+def _conv(x, convs):
+    # 1x1 Conv1d/Conv2d of every region with its own weights:  one batched matmul of the stacked (C_out, C_in)
+    # weights with the (C_in, P[*K]) inputs of every event and region
+    batch_size, num_regions, shape = x.shape[0], len(convs), x.shape[2:]
+    weight = torch.stack([conv.weight.view(conv.weight.shape[:2]) for conv in convs])  # (nRegions, C_out, C_in)
+    out = torch.matmul(weight, x.reshape(batch_size, num_regions, -1, shape.numel()))
+    out = out.view(batch_size, -1, *shape)
+    if convs[0].bias is not None:
+        out = out + torch.cat([conv.bias for conv in convs]).view(1, -1, *([1] * len(shape)))
+    return out
+
+
+def _batch_norm(x, bns):
+    # BatchNorm of every region with its own parameters and running stats.  BatchNorm is per channel, so the
+    # batch statistics are the same as for the separate regions; the updated running stats are copied back.
+    bn = bns[0]
+    running_mean = torch.cat([b.running_mean for b in bns])
+    running_var = torch.cat([b.running_var for b in bns])
+    out = F.batch_norm(x, running_mean, running_var, torch.cat([b.weight for b in bns]), torch.cat([b.bias for b in bns]),
+                       bn.training, bn.momentum, bn.eps)
+    if bn.training:
+        with torch.no_grad():
+            for b, mean, var in zip(bns, running_mean.chunk(len(bns)), running_var.chunk(len(bns))):
+                b.running_mean.copy_(mean)
+                b.running_var.copy_(var)
+                b.num_batches_tracked += 1
+    return out
+
+
+def _edge_conv(blocks, points, features, knn_idx=None):
+    # EdgeConvBlock.forward for all regions at once; points, features:  (N*nRegions, C, P), blocks:  one per region
+    block = blocks[0]
+    num_regions = len(blocks)
+    batch_size, num_dims, num_points = features.shape
+    topk_indices = knn(points, block.k) if knn_idx is None else knn_idx
+    x = get_graph_feature(features, block.k, topk_indices)  # (N*nRegions, 2*C, P, K)
+    x = x.view(batch_size // num_regions, -1, num_points, block.k)
+    for i in range(block.num_layers):
+        x = _conv(x, [b.convs[i] for b in blocks])
+        if block.batch_norm:
+            x = _batch_norm(x, [b.bns[i] for b in blocks])
+        if block.activation:
+            x = block.acts[i](x)
+
+    fts = torch.mean(x, axis=-1)  # (N, nRegions*C_out, P)
+
+    # shortcut
+    features = features.view(batch_size // num_regions, -1, num_points)
+    if block.sc:
+        sc = _batch_norm(_conv(features, [b.sc for b in blocks]), [b.sc_bn for b in blocks])
+    else:
+        sc = features
+
+    return block.sc_act(sc + fts).view(batch_size, -1, num_points)  # (N*nRegions, C_out, P)
+
+
 class SplitNet(nn.Module):
     # SplitNet class:
     # Consists of 3 ordinary ParticleNets, each one only examining data fom a single reigon of the ecal.
@@ -25,6 +87,7 @@ class SplitNet(nn.Module):
                  return_softmax=False,
                  nRegions=1,
                  regSizes = None, # List w/ len==nRegions
+                 batched_regions=False,
                  **kwargs):
         super(SplitNet, self).__init__(**kwargs)
         print("INITIALIZING SPLITNET")
@@ -57,6 +120,10 @@ class SplitNet(nn.Module):
 
         self.return_softmax = return_softmax
 
+        # If True, run all regions in one batched pass instead of calling pn0, pn1, ... one after another (see
+        # _forward_batched).  Uses the same parameters, so it can be switched on or off for any model/checkpoint.
+        self.batched_regions = batched_regions
+
         self.regSizes = None
         if regSizes:
             print("WARNING:  regSizes have not yet been enabled, but the parameter was passed!")
@@ -65,6 +132,11 @@ class SplitNet(nn.Module):
 
         print("FINISHED INIT")
 
+    def flops(self, num_points):
+        # Approximate FLOPs of one forward pass over one event with num_points points per region (see ParticleNet.flops)
+        total = sum(getattr(self, 'pn{}'.format(i)).flops(num_points) for i in range(self.nRegions))
+        return total + sum(2 * m.in_features * m.out_features for m in self.fc.modules() if isinstance(m, nn.Linear))
+
     """
     # No longer necessary after setattr() line above was added!
     def particle_nets_to(self, dev):  # Added separately--PNs in list aren't automatically put on gpu by to()
@@ -74,13 +146,22 @@ class SplitNet(nn.Module):
         #    self.particleNets[i] = self.particleNets[i].to(dev)
     """
 
-    def forward(self, points, features):
+    def forward(self, points, features, pad_to=None, knn_idx=None):
         # Divide up provided points+features, then hand them to the PNs, then feed the outputs to the fc layer.
         # Points are [nregions] x 128  x 3 x 50 (note: nregions axis is gone for 1 region)
         # Note:  points[:,0].shape = (128, 3, 50)
+        # pad_to:  number of points before the batch was trimmed, if it was (see ParticleNet.forward)
+        # knn_idx:  precomputed first layer neighbour indices, [nregions] x 128 x 50 x k (see first_layer_knn)
+
+        if self.batched_regions and not self.regSizes:
+            output = self.fc(self._forward_batched(points, features, pad_to=pad_to, knn_idx=knn_idx))
+            if self.return_softmax:
+                output = torch.softmax(output, dim=1)
+            return output
 
         if not self.regSizes:
-            xi = [getattr(self, 'pn{}'.format(i))(points[:,i], features[:,i]) for i in range(self.nRegions)]
+            xi = [getattr(self, 'pn{}'.format(i))(points[:,i], features[:,i], pad_to=pad_to,
+                                                  knn_idx=None if knn_idx is None else knn_idx[:,i]) for i in range(self.nRegions)]
         else:
             # NEW:  Each region now has a different size, defined in init
             # To avoid awkwardness, each region is sliced down to the correct size (number of hits) here.  The first regSizes[i] hits are the actual data.
@@ -93,4 +174,39 @@ class SplitNet(nn.Module):
             output = torch.softmax(output, dim=1)
         return output
 
-
+    def _forward_batched(self, points, features, pad_to=None, knn_idx=None):
+        # Same as torch.cat([pn0(points[:,0], features[:,0]), pn1(...), ...], dim=1), with the regions folded into the
+        # batch:  knn and the neighbour gathering run once over N*nRegions events, and the convolutions and
+        # BatchNorms run once over all regions with the per-region weights stacked (batched matmuls).
+        # The stacked weights are built from pn0, pn1, ... in every call, so gradients and running stats go to the
+        # usual parameters and the state_dict is unchanged.
+        pns = [getattr(self, 'pn{}'.format(i)) for i in range(self.nRegions)]
+        batch_size, num_regions, num_dims, num_points = features.shape
+        features = features.float()
+        mask = (features.abs().sum(dim=2, keepdim=True) != 0).view(batch_size * num_regions, 1, num_points)
+        coord_shift = (mask == 0) * 9999.
+        counts = mask.float().sum(dim=-1)
+        counts = torch.max(counts, torch.ones_like(counts))  # >=1
+        fts = _batch_norm(features.reshape(batch_size, -1, num_points), [pn.bn_fts for pn in pns])
+        fts = fts.view(batch_size * num_regions, num_dims, num_points)
+        outputs = []
+        for idx in range(len(pns[0].edge_convs)):
+            pts = (points.reshape(batch_size * num_regions, -1, num_points) if idx == 0 else fts) + coord_shift
+            first_knn = None if (knn_idx is None or idx > 0) else knn_idx.reshape(batch_size * num_regions, num_points, -1)
+            fts = _edge_conv([pn.edge_convs[idx] for pn in pns], pts, fts, knn_idx=first_knn) * mask
+            if self.use_fusion:
+                outputs.append(fts)
+        if self.use_fusion:
+            # See ParticleNet.forward for pad_to
+            fusion_input = torch.cat(outputs, dim=1)
+            num_trimmed = 0 if pad_to is None else pad_to - num_points
+            if num_trimmed > 0:
+                fusion_input = torch.cat((fusion_input, torch.zeros_like(fusion_input[..., :1])), dim=-1)
+            fusion_blocks = [pn.fusion_block for pn in pns]
+            x = _conv(fusion_input.view(batch_size, -1, fusion_input.shape[-1]), [fb[0] for fb in fusion_blocks])
+            x = fusion_blocks[0][2](_batch_norm(x, [fb[1] for fb in fusion_blocks]))
+            fts = x.view(batch_size * num_regions, -1, fusion_input.shape[-1])
+            if num_trimmed > 0:
+                fts = torch.cat((fts[..., :-1], fts[..., -1:] * num_trimmed), dim=-1)
+        x = fts.sum(axis=-1) / counts  # (N*nRegions, C)
+        return x.view(batch_size, -1)  # == torch.cat over the regions
@@ -0,0 +1,70 @@
+import os
+import copy
+import queue
+import threading
+import traceback
+
+import torch
+
+'''Checkpoint files written in a background thread, so the training loop only waits for an in-memory copy.
+
+Usage:
+    checkpointer = AsyncCheckpointer()
+    checkpointer.save(model.state_dict(), path)  # copies the object now, writes it to path later
+    ...
+    checkpointer.close()                          # waits for the pending writes
+
+Every file is written to <path>.tmp and renamed to path, so a job killed while writing leaves the previous version
+of the file (or none) behind, never a truncated one.'''
+
+
+def atomic_save(obj, path):
+    # torch.save to path through a temporary file
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class AsyncCheckpointer:
+    # One writer thread; saves are written in the order they were made.  save() blocks if a write is still pending
+    # from the one before the last, so at most two copies are held in memory.  A failed write is raised by the next
+    # save(), wait() or close().
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        for obj, path in iter(self._queue.get, None):
+            try:
+                atomic_save(obj, path)
+            except Exception:
+                self._error = 'Writing %s failed:\n%s' % (path, traceback.format_exc())
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError(self._error)
+
+    def save(self, obj, path):
+        # obj (e.g. a state dict, or a whole nn.Module) is deep-copied here, so training can go on modifying it
+        self._check()
+        self._queue.put((copy.deepcopy(obj), path))
+
+    def wait(self):
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._check()
@@ -0,0 +1,95 @@
+import numpy as np
+import awkward
+
+'''Vectorized (awkward/numpy) versions of per-event calculations on scoring plane hits.
+
+Each function takes jagged arrays with one list of hits per event and returns one value per event, reproducing the
+per-event loops previously used in file_processor.py and dataset.py.  Only numpy and awkward are needed, so these can
+be imported anywhere the same quantities are computed (e.g. by tree makers working on uproot arrays).'''
+
+# Beam energy and distance from the target to the ecal face (mm), used to project the photon trajectory
+E_BEAM = 4000.0
+TARGET_DIST = 241.5
+
+# Scalar branches written by file_processor.py to describe the projected electron/photon trajectories
+TRAJECTORY_BRANCHES = ['{}_sp_{}'.format(traj, v) for traj in ['etraj', 'enorm', 'ptraj', 'pnorm'] for v in ['x', 'y', 'z']]
+RADIUS_CATEGORY_BRANCH = 'radius_category'
+
+
+def max_pz_index(pdgID, z, pz, z_min, z_max):
+    # For each event, find the electron (pdgID 11) with z_min < z < z_max and the largest pz > 0.
+    # Returns (index, found):  index is 0 if there's no such electron, as in the original loops.
+    selected = (pdgID == 11) & (z > z_min) & (z < z_max) & (pz > 0)
+    found = awkward.to_numpy(awkward.any(selected, axis=1))
+    index = awkward.argmax(awkward.where(selected, pz, -np.inf), axis=1)  # First maximum if there are ties
+    index = awkward.to_numpy(awkward.fill_none(index, 0)).astype('int64')
+    return np.where(found, index, 0), found
+
+
+def _take(values, index):
+    # values[i][index[i]] for every event i (keeping the dtype of values); 0 where event i has no hit at index[i]
+    dtype = awkward.type(values).content.content.primitive
+    values = awkward.pad_none(values, np.max(index, initial=0) + 1, axis=1)
+    return awkward.to_numpy(awkward.fill_none(values[np.arange(len(index)), index], 0)).astype(dtype)
+
+
+def recoil_pt(pdgID, z, px, py, pz, z_min=0.176, z_max=0.178):
+    # pT of the recoil electron (largest pz, see max_pz_index) at the target scoring plane for every event.
+    # Computed in the input precision, like the original loop in file_processor.py.
+    index, _ = max_pz_index(pdgID, z, pz, z_min, z_max)
+    px_recoil = _take(px, index)
+    py_recoil = _take(py, index)
+    return np.sqrt(px_recoil**2 + py_recoil**2)
+
+
+def num_hits(values):
+    # Number of hits in every event
+    return awkward.to_numpy(awkward.num(values, axis=1))
+
+
+def num_positive(values):
+    # Number of hits with a value > 0 in every event (e.g. ecal rec hits with nonzero energy)
+    return awkward.to_numpy(awkward.sum(values > 0, axis=1))
+
+
+def radius_category(enorm_x, enorm_y, enorm_z, fiducial):
+    # Class of containment radii (index into dataset.radius_68) used for each event.
+    # Note that recoilangle is really cos(theta) and recoil_p is |enorm_sp| (~1), so this is normally 1.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        recoil_p = np.where(fiducial, np.sqrt(enorm_x**2 + enorm_y**2 + enorm_z**2), -999)
+        recoilangle = np.where(fiducial, enorm_z / recoil_p, -999)
+    return np.select([(recoilangle < 10) & (recoil_p < 500), (recoilangle < 10) & (recoil_p >= 500), recoilangle <= 20],
+                     [1, 2, 3], 4).astype('int32')
+
+
+def sp_trajectories(ecal_sp, target_sp):
+    # Projected electron/photon trajectories at the ecal for every event (see ECalHitsDataset._load_sp_data).
+    # ecal_sp/target_sp:  dicts of jagged arrays of EcalScoringPlaneHits/TargetScoringPlaneHits with keys
+    # 'pdgID_', 'x_', 'y_', 'z_', 'px_', 'py_', 'pz_'.
+    # Returns a dict with one float64 array per TRAJECTORY_BRANCHES entry (-999 if the event has no recoil electron
+    # at the ecal SP) plus the int32 RADIUS_CATEGORY_BRANCH.
+    r_ecal, has_e = max_pz_index(ecal_sp['pdgID_'], ecal_sp['z_'], ecal_sp['pz_'], 240, 241)
+    e = {v: _take(ecal_sp[v + '_'], r_ecal).astype('float64') for v in ['x', 'y', 'z', 'px', 'py', 'pz']}
+    # NOTE:  The target SP values are taken at the index of the recoil electron *at the ecal SP*, as in the
+    # training-time calculation (the target SP recoil search there is unused).  Kept as-is so stored values match.
+    t = {v: _take(target_sp[v + '_'], r_ecal).astype('float64') for v in ['x', 'y', 'z', 'px', 'py', 'pz']}
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = {
+            'etraj_sp_x': e['x'],
+            'etraj_sp_y': e['y'],
+            'etraj_sp_z': e['z'],
+            'enorm_sp_x': e['px'] / e['pz'],
+            'enorm_sp_y': e['py'] / e['pz'],
+            'enorm_sp_z': np.ones(len(r_ecal)),
+            'pnorm_sp_x': -t['px'] / (E_BEAM - t['pz']),
+            'pnorm_sp_y': -t['py'] / (E_BEAM - t['pz']),
+            'pnorm_sp_z': np.ones(len(r_ecal)),
+            }
+        out['ptraj_sp_x'] = t['x'] + TARGET_DIST * out['pnorm_sp_x']
+        out['ptraj_sp_y'] = t['y'] + TARGET_DIST * out['pnorm_sp_y']
+        out['ptraj_sp_z'] = t['z'] + TARGET_DIST
+    for k in TRAJECTORY_BRANCHES:
+        out[k] = np.where(has_e, out[k], -999.)
+    out[RADIUS_CATEGORY_BRANCH] = radius_category(out['enorm_sp_x'], out['enorm_sp_y'], out['enorm_sp_z'], has_e)
+    return out
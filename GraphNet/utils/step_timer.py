@@ -0,0 +1,81 @@
+import time
+import contextlib
+import collections
+
+import numpy as np
+import torch
+
+'''Per-step timing of training/evaluation loops, to tell whether the DataLoader or the model is the bottleneck.
+
+Usage:
+    timer = StepTimer(dev)
+    for batch in timer.batches(loader):      # time spent waiting for each batch -> 'data_wait'
+        with timer.phase('to_device'):
+            ...
+        with timer.phase('forward'):
+            ...
+    timer.summary()                          # per-phase percentiles, see below
+
+Every phase is also a torch.profiler.record_function range, so it shows up by name in profiler traces.'''
+
+# Percentiles reported by StepTimer.summary()
+PERCENTILES = [50, 90, 99]
+
+
+class StepTimer:
+    # Wall-clock time of the phases of every step.  On CUDA devices, each phase ends with a synchronize so that the
+    # (asynchronous) GPU work is counted in the phase that launched it; this costs some overlap between steps, like
+    # the .item() calls the loops already make.
+
+    def __init__(self, dev):
+        self.sync = torch.device(dev).type == 'cuda'
+        self.times = collections.OrderedDict()  # phase -> [seconds per step]
+
+    def _add(self, name, seconds):
+        self.times.setdefault(name, []).append(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        with torch.profiler.record_function(name):
+            start = time.perf_counter()
+            yield
+            if self.sync:
+                torch.cuda.synchronize()
+            self._add(name, time.perf_counter() - start)
+
+    def batches(self, iterable):
+        # Iterates iterable (e.g. a DataLoader), timing the wait for every item as 'data_wait'
+        iterator = iter(iterable)
+        while True:
+            with torch.profiler.record_function('data_wait'):
+                start = time.perf_counter()
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+                self._add('data_wait', time.perf_counter() - start)
+            yield batch
+
+    def summary(self):
+        # {phase: {'total_s', 'fraction' (of the total time of all phases), 'mean_ms', 'p50_ms', ..., 'max_ms'}},
+        # plus 'step':  the sum of the phases of each step (if every step went through the same phases)
+        times = collections.OrderedDict((name, np.array(t)) for name, t in self.times.items())
+        if times and len(set(len(t) for t in times.values())) == 1:
+            times['step'] = np.sum(list(times.values()), axis=0)
+        total = sum(t.sum() for name, t in times.items() if name != 'step')
+        summary = collections.OrderedDict()
+        for name, t in times.items():
+            summary[name] = {'steps': len(t), 'total_s': float(t.sum()), 'fraction': float(t.sum() / total) if total else 0.,
+                             'mean_ms': 1e3 * float(t.mean())}
+            summary[name].update(('p%d_ms' % p, 1e3 * float(v)) for p, v in zip(PERCENTILES, np.percentile(t, PERCENTILES)))
+            summary[name]['max_ms'] = 1e3 * float(t.max())
+        return summary
+
+    def format(self):
+        # One line:  median/p90/p99 of each phase in ms, and the share of the data wait
+        summary = self.summary()
+        phases = ', '.join('%s %s' % (name, '/'.join('%.1f' % s['p%d_ms' % p] for p in PERCENTILES))
+                           for name, s in summary.items())
+        wait = summary.get('data_wait', {}).get('fraction', 0.)
+        return 'step times in ms (p%s):  %s; waiting for data %.1f%% of the time' % (
+            '/p'.join(str(p) for p in PERCENTILES), phases, 100. * wait)
@@ -0,0 +1,143 @@
+from __future__ import print_function
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+import os
+import sys
+import time
+import argparse
+
+from dataset import PackedECalHitsDataset, StreamingECalHitsDataset
+from dataset import collate_wrapper as collate_fn
+from dataset import collate_batches
+from export_model import build_model, networks
+from utils.plot_utils import get_signal_effs
+
+"""
+validate_precision.py
+
+Purpose:  Check that --precision bf16 (bfloat16 autocast, see train.py and eval.py) doesn't change the physics
+performance, and measure its speedup.  Scores a labelled sample with a trained model in float32 (the reference) and
+in bfloat16 autocast, then compares the AUC and the signal efficiencies at the --mistags background efficiencies
+(plot_utils.get_signal_effs, on the ROC of all signal vs background events of the sample, without the preselection
+efficiencies) and prints the events/s of both.  Exits with status 1 if a difference exceeds its tolerance.
+
+To check a model trained with --precision bf16, pass it as --bf16-model-path:  the reference is then the float32
+model of --load-model-path in float32, the candidate the bf16-trained model in bfloat16.
+
+The efficiencies at 1e-5 need well over 1e5 background events to mean anything.
+
+Example:
+    python validate_precision.py --network particle-net-lite --num-regions 3 --load-model-path models/ecal_coord_state.pt \\
+        --packed-dir packed --threads 4
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--network', type=str, default='particle-net-lite', choices=list(networks))
+parser.add_argument('--num-regions', type=int, default=1)
+parser.add_argument('--batched-regions', action='store_true', default=False)
+parser.add_argument('--load-model-path', type=str, required=True,
+                    help='trained state dict (train.py output); _state.pt is appended if missing')
+parser.add_argument('--bf16-model-path', type=str, default='',
+                    help='model trained with --precision bf16 to run in bfloat16 (default:  --load-model-path)')
+parser.add_argument('--packed-dir', type=str, default='',
+                    help='use the validation sample <packed-dir>/val (pack_dataset.py output)')
+parser.add_argument('--test-sig', type=str, default='',
+                    help='signal files (file_processor.py outputs, glob), read with uproot if there is no --packed-dir')
+parser.add_argument('--test-bkg', type=str, default='',
+                    help='background files, as --test-sig')
+parser.add_argument('--stream-chunk-size', type=int, default=4096)
+parser.add_argument('--batch-size', type=int, default=1024)
+parser.add_argument('--threads', type=int, default=1)
+parser.add_argument('--mistags', type=str, default='1e-4,1e-5',
+                    help='background efficiencies to compare the signal efficiencies at')
+parser.add_argument('--auc-tolerance', type=float, default=1e-3,
+                    help='max |AUC difference|')
+parser.add_argument('--eff-tolerance', type=float, default=0.01,
+                    help='max |signal efficiency difference| at each of --mistags')
+
+
+def model_path(path):
+    return path if path.endswith('.pt') else path + '_state.pt'
+
+
+def make_loader(args):
+    if args.packed_dir:
+        data = PackedECalHitsDataset(os.path.join(args.packed_dir, 'val'))
+        return DataLoader(data, batch_size=args.batch_size, collate_fn=collate_fn, shuffle=False)
+    siglist = {1: (args.test_sig, -1)} if args.test_sig else {}
+    bkglist = {0: (args.test_bkg, -1)} if args.test_bkg else {}
+    data = StreamingECalHitsDataset(siglist=siglist, bkglist=bkglist, load_range=(0, 1), nRegions=args.num_regions,
+                                    batch_size=args.batch_size, chunk_size=args.stream_chunk_size)
+    return DataLoader(data, batch_size=None, collate_fn=collate_batches)
+
+
+def score(model, batch, bf16):
+    # Signal scores and seconds spent in the model
+    start = time.perf_counter()
+    with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+        logits = model(batch.coordinates, batch.features).float()
+    return torch.softmax(logits, dim=1)[:, 1].numpy(), time.perf_counter() - start
+
+
+def roc_metrics(labels, scores, mistags):
+    # AUC and [(background eff, signal eff) at each mistag]
+    from sklearn.metrics import auc, roc_curve
+    fpr, tpr, _ = roc_curve(labels, scores)
+    return auc(fpr, tpr), get_signal_effs(fpr, tpr, mistags)
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    mistags = [float(m) for m in args.mistags.split(',')]
+    conv_params, fc_params = networks[args.network]
+    config = {'conv_params': conv_params, 'fc_params': fc_params, 'num_regions': args.num_regions,
+              'batched_regions': args.batched_regions}
+    models = {'fp32': build_model(config, model_path(args.load_model_path)),
+              'bf16': build_model(config, model_path(args.bf16_model_path or args.load_model_path))}
+
+    labels, scores = [], {name: [] for name in models}
+    times = {name: 0. for name in models}
+    for i, batch in enumerate(make_loader(args)):
+        if i == 0:
+            for name, model in models.items():
+                score(model, batch, name == 'bf16')  # Warm up
+        labels.append(batch.label.numpy().ravel())
+        for name, model in models.items():
+            s, seconds = score(model, batch, name == 'bf16')
+            scores[name].append(s)
+            times[name] += seconds
+    labels = np.concatenate(labels)
+    scores = {name: np.concatenate(s) for name, s in scores.items()}
+    print('%d events:  %d signal, %d background' % (len(labels), (labels > 0).sum(), (labels == 0).sum()))
+
+    diff = np.abs(scores['bf16'] - scores['fp32'])
+    print('Signal score |bf16 - fp32|:  max %.2e, mean %.2e; %d events (%.3f%%) change class at 0.5' % (
+        diff.max(), diff.mean(), ((scores['bf16'] > 0.5) != (scores['fp32'] > 0.5)).sum(),
+        100. * ((scores['bf16'] > 0.5) != (scores['fp32'] > 0.5)).mean()))
+
+    metrics = {name: roc_metrics(labels, s, mistags) for name, s in scores.items()}
+    ok = True
+    auc_diff = abs(metrics['bf16'][0] - metrics['fp32'][0])
+    ok &= auc_diff <= args.auc_tolerance
+    print('AUC:  fp32 %.6f, bf16 %.6f, difference %.2e (%s the tolerance %.1e)' % (
+        metrics['fp32'][0], metrics['bf16'][0], auc_diff, 'within' if auc_diff <= args.auc_tolerance else 'EXCEEDS',
+        args.auc_tolerance))
+    for m, (fpr32, eff32), (fpr16, eff16) in zip(mistags, metrics['fp32'][1], metrics['bf16'][1]):
+        eff_diff = abs(eff16 - eff32)
+        ok &= eff_diff <= args.eff_tolerance
+        print('Signal eff. at bkg eff. %.0e:  fp32 %.4f (at %.2e), bf16 %.4f (at %.2e), difference %.4f (%s the tolerance %.3f)' % (
+            m, eff32, fpr32, eff16, fpr16, eff_diff, 'within' if eff_diff <= args.eff_tolerance else 'EXCEEDS',
+            args.eff_tolerance))
+
+    rates = {name: len(labels) / t for name, t in times.items()}
+    print('%d threads:  fp32 %.0f events/s, bf16 %.0f events/s, speedup %.2fx' % (
+        args.threads, rates['fp32'], rates['bf16'], rates['bf16'] / rates['fp32']))
+    print('PASSED' if ok else 'FAILED')
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if run(parser.parse_args()) else 1)